@@ -0,0 +1,118 @@
+import re
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+
+# A token is a run of ASCII letters/digits in the lowercased text
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# For pure-ASCII text: every non-alphanumeric character becomes a separator
+_ASCII_SEPARATORS = str.maketrans(
+    {c: " " for c in map(chr, range(128)) if not c.isalnum()}
+)
+
+
+class Analyzer:
+    """
+    The one tokenizer used by both indexing and querying.
+
+    Terms are interned into an integer vocabulary (term -> id, ids dense and
+    assigned in first-seen order), so postings and document term vectors are
+    plain int arrays.
+    """
+
+    def tokenize(self, text):
+        """Lowercased [a-z0-9]+ tokens, same output as the original regex tokenizer"""
+        text = text.lower()
+        if text.isascii():
+            # translate + split is about twice as fast as the regex
+            return text.translate(_ASCII_SEPARATORS).split()
+        # lower() can map non-ASCII characters to ASCII ones (e.g. the Kelvin sign)
+        return TOKEN_PATTERN.findall(text)
+
+    def term_vector(self, text, vocab):
+        """
+        (term ids, term frequencies) of a document, interning unseen terms
+        into `vocab`. Terms are listed in first-occurrence order.
+        """
+        counts = Counter(self.tokenize(text))
+        ids = np.empty(len(counts), dtype=np.int32)
+        for i, term in enumerate(counts):
+            term_id = vocab.get(term)
+            if term_id is None:
+                term_id = vocab[term] = len(vocab)
+            ids[i] = term_id
+        return ids, np.fromiter(counts.values(), dtype=np.int32, count=len(counts))
+
+    def query_term_ids(self, text, vocab):
+        """Ids of the query's known terms, in query order (repeats kept)"""
+        ids = []
+        for term in self.tokenize(text):
+            term_id = vocab.get(term)
+            if term_id is not None:
+                ids.append(term_id)
+        return ids
+
+
+analyzer = Analyzer()
+
+
+def regex_tokenize(text):
+    """The original indexer tokenizer, kept as the benchmark baseline"""
+    return re.findall(r"[a-zA-Z0-9]+", text.lower())
+
+
+def benchmark(texts, repeat=3):
+    """
+    Compare the regex tokenizer with the analyzer over `texts`.
+    Returns tokens/sec for tokenizing alone and for tokenizing + interning.
+    """
+    total_mb = sum(len(t) for t in texts) / 1e6
+
+    def timed(fn):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            num_tokens = fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return {
+            "seconds": round(best, 4),
+            "tokens_per_sec": round(num_tokens / best),
+            "mb_per_sec": round(total_mb / best, 2),
+        }
+
+    def intern_all():
+        vocab = {}
+        return sum(int(analyzer.term_vector(t, vocab)[1].sum()) for t in texts)
+
+    return {
+        "docs": len(texts),
+        "regex_tokenize": timed(lambda: sum(len(regex_tokenize(t)) for t in texts)),
+        "analyzer_tokenize": timed(
+            lambda: sum(len(analyzer.tokenize(t)) for t in texts)
+        ),
+        "analyzer_term_vectors": timed(intern_all),
+    }
+
+
+if __name__ == "__main__":
+    # python -m src.analysis [limit]
+    from src.data_loader import iter_corpus
+
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    texts = []
+    for batch in iter_corpus(("title", "body")):
+        texts.extend(
+            f"{title} {body}"
+            for title, body in zip(
+                batch.column("title").to_pylist(), batch.column("body").to_pylist()
+            )
+        )
+        if limit is not None and len(texts) >= limit:
+            break
+    texts = texts[:limit]
+    for name, value in benchmark(texts).items():
+        print(f"{name}: {value}")
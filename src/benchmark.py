@@ -0,0 +1,390 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+from src.data_loader import DB_PATH, append_article_batches
+from src.indexer import INDICES_DIR, build_indices, registry
+from src.result_cache import result_cache
+from src.search import search_bm25
+from src.semantic.encoder import EMB_DIR, build_embeddings, set_model
+from src.semantic.knn_graph import build_knn_graph
+from src.semantic.similarity import similar_articles
+from src.semantic.timeline import build_story_timeline
+from src.semantic.vector_store import get_store
+
+# Each corpus size is built and measured in its own directory under this one
+BENCH_DIR = Path("benchmarks")
+
+DEFAULT_SIZES = [10_000]
+
+# Requests per retrieval path: half replayed one at a time for latency, the
+# other half by CONCURRENCY clients at once for throughput
+NUM_QUERIES = 400
+CONCURRENCY = 8
+
+# Synthetic corpus: word frequencies follow a Zipf law over VOCAB_SIZE
+# pseudo-words; title and body lengths are uniform in these ranges
+VOCAB_SIZE = 50_000
+ZIPF_EXPONENT = 1.1
+TITLE_WORDS = (6, 14)
+BODY_WORDS = (80, 400)
+NUM_SITES = 200
+GENERATE_BATCH = 10_000
+
+# The kNN graph costs O(N^2) to build; above this many documents /similar
+# and /timeline are measured on their search fallback instead
+KNN_MAX_DOCS = 200_000
+
+# Stub encoder: vector size, hashed word vectors, words read per text
+STUB_DIM = 384
+STUB_BUCKETS = 1 << 16
+STUB_WORDS = 64
+
+SEED = 0
+
+SYLLABLES = [c + v for c in "bdfgklmnprstvz" for v in "aeiou"]
+
+
+class StubEncoder:
+    """
+    Offline stand-in for the sentence transformer. A text's vector is the
+    normalized sum of fixed random vectors of its first STUB_WORDS words
+    (hashed), so texts sharing words come out similar. It is far cheaper
+    than the model: embedding build times measure the pipeline, not the
+    encoder.
+    """
+
+    def __init__(self, dim=STUB_DIM, buckets=STUB_BUCKETS, seed=SEED):
+        rng = np.random.default_rng(seed)
+        self.table = rng.standard_normal((buckets, dim)).astype(np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return self.table.shape[1]
+
+    def encode(self, texts, normalize_embeddings=False, **kwargs):
+        vectors = np.zeros((len(texts), self.table.shape[1]), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = text.lower().split()[:STUB_WORDS]
+            rows = [zlib.crc32(w.encode()) % len(self.table) for w in words]
+            vectors[i] = self.table[rows].sum(axis=0)
+        if normalize_embeddings:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.maximum(norms, 1e-12)
+        return vectors
+
+
+def synthetic_vocabulary(size=VOCAB_SIZE):
+    """`size` distinct pronounceable pseudo-words, most frequent first"""
+    words = []
+    for i in range(size):
+        syllables = []
+        i += len(SYLLABLES)  # at least two syllables
+        while i:
+            i, r = divmod(i, len(SYLLABLES))
+            syllables.append(SYLLABLES[r])
+        words.append("".join(syllables))
+    return np.array(words, dtype=object)
+
+
+def generate_corpus(num_docs, seed=SEED):
+    """
+    Write `num_docs` synthetic articles into the corpus DB (in the current
+    directory). Deterministic for a seed. Returns the number stored.
+    """
+    rng = np.random.default_rng(seed)
+    vocab = synthetic_vocabulary()
+    weights = 1.0 / np.arange(1, len(vocab) + 1) ** ZIPF_EXPONENT
+    weights /= weights.sum()
+    sites = np.array([f"news{i}.example.com" for i in range(NUM_SITES)], object)
+
+    def _batches():
+        for start in range(0, num_docs, GENERATE_BATCH):
+            n = min(GENERATE_BATCH, num_docs - start)
+            title_lens = rng.integers(*TITLE_WORDS, size=n)
+            body_lens = rng.integers(*BODY_WORDS, size=n)
+            words = vocab[
+                rng.choice(len(vocab), title_lens.sum() + body_lens.sum(), p=weights)
+            ]
+            ends = np.cumsum(np.stack([title_lens, body_lens], axis=1).ravel())
+            texts = [" ".join(part) for part in np.split(words, ends[:-1])]
+            days = rng.integers(0, 365, size=n)
+            dates = (np.datetime64("2023-01-01") + days).astype(str)
+            yield pa.table(
+                {
+                    "title": pa.array(texts[0::2], pa.string()),
+                    "body": pa.array(texts[1::2], pa.string()),
+                    "date": pa.array(dates.tolist(), pa.string()),
+                    "site": pa.array(
+                        sites[rng.integers(0, NUM_SITES, n)].tolist(), pa.string()
+                    ),
+                    "language": pa.array(["en"] * n, pa.string()),
+                }
+            )
+
+    return append_article_batches(_batches())
+
+
+def query_mix(num_queries, seed=SEED):
+    """
+    Headline-like queries (1-4 consecutive title words of random documents)
+    and random doc_ids, drawn from the loaded index. No query repeats, so the
+    result cache does not answer any of them.
+    """
+    rng = np.random.default_rng(seed + 1)
+    snapshot = registry.get()
+    doc_ids = np.asarray(snapshot.bm25.segments[0].bm25.doc_ids)
+    queries = set()
+    while len(queries) < num_queries:
+        title = snapshot.docs.get(int(rng.choice(doc_ids)), ("title",))["title"]
+        words = title.split()
+        n = int(rng.integers(1, 5))
+        start = int(rng.integers(0, max(1, len(words) - n + 1)))
+        queries.add(" ".join(words[start : start + n]))
+    return sorted(queries), rng.choice(doc_ids, num_queries, replace=False).tolist()
+
+
+def percentiles(latencies):
+    """Latency summary in milliseconds"""
+    ms = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+def measure(call, inputs, concurrency=CONCURRENCY):
+    """
+    Latency of `call` over the first half of `inputs` one at a time, and
+    throughput over the second half with `concurrency` threads.
+    """
+    half = len(inputs) // 2
+    call(inputs[-1])  # warm-up: lazy loading is not part of the numbers
+    result_cache.clear()
+
+    latencies = []
+    for x in inputs[:half]:
+        start = time.perf_counter()
+        call(x)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, inputs[half:]))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(inputs),
+        **percentiles(latencies),
+        "qps": round((len(inputs) - half) / elapsed, 1),
+        "concurrency": concurrency,
+    }
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far (ru_maxrss is kB on Linux)"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return round(time.perf_counter() - start, 3)
+
+
+def _disk_mb(path):
+    return round(
+        sum(p.stat().st_size for p in Path(path).rglob("*") if p.is_file()) / 2**20, 1
+    )
+
+
+def run_size(
+    num_docs, num_queries=NUM_QUERIES, concurrency=CONCURRENCY, workers=None, http=True
+):
+    """
+    Build every index for a fresh synthetic corpus in the current directory
+    and replay the query mix. Returns the measurements.
+    """
+    set_model(StubEncoder())
+    for directory in (DB_PATH.parent, INDICES_DIR, EMB_DIR):
+        directory.mkdir(exist_ok=True)
+    report = {"docs": num_docs}
+
+    builds = {"corpus": _timed(generate_corpus, num_docs)}
+    builds["bm25"] = _timed(build_indices, workers=workers)
+    builds["embeddings"] = _timed(build_embeddings)
+    knn = num_docs <= KNN_MAX_DOCS
+    if knn:
+        builds["knn_graph"] = _timed(build_knn_graph, workers=workers)
+    report["build_seconds"] = builds
+    report["knn_graph"] = knn
+    report["disk_mb"] = {
+        "indices": _disk_mb(INDICES_DIR),
+        "semantic_store": _disk_mb(EMB_DIR),
+    }
+    report["peak_rss_mb_after_build"] = peak_rss_mb()
+
+    report["load_seconds"] = {
+        "bm25_index": _timed(registry.load),
+        "vector_store": _timed(get_store),
+    }
+
+    queries, doc_ids = query_mix(num_queries)
+    store = get_store()
+    vectors = list(store.queries_to_vectors(queries))
+    report["in_process"] = {
+        "search_bm25": measure(lambda q: search_bm25(q, 10), queries, concurrency),
+        "cosine_top_k": measure(
+            lambda v: store.cosine_top_k(v, 10), vectors, concurrency
+        ),
+        "similar_articles": measure(
+            lambda d: similar_articles(d, 5), doc_ids, concurrency
+        ),
+        "build_story_timeline": measure(
+            lambda d: build_story_timeline(d, 8), doc_ids, concurrency
+        ),
+    }
+    if http:
+        report["http"] = run_http(queries, doc_ids, concurrency)
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def run_http(queries, doc_ids, concurrency=CONCURRENCY):
+    """The same mix through the FastAPI app (routing, validation, lanes, JSON)"""
+    # Imported here: only the HTTP replay needs the app and its startup
+    from fastapi.testclient import TestClient
+
+    from src.main import app
+
+    with TestClient(app) as client:
+
+        def _get(path, **params):
+            client.get(path, params=params).raise_for_status()
+
+        return {
+            "/search": measure(lambda q: _get("/search", q=q), queries, concurrency),
+            "/semantic_search": measure(
+                lambda q: _get("/semantic_search", q=q), queries, concurrency
+            ),
+            "/similar": measure(
+                lambda d: _get("/similar", doc_id=d), doc_ids, concurrency
+            ),
+            "/timeline": measure(
+                lambda d: _get("/timeline", doc_id=d), doc_ids, concurrency
+            ),
+        }
+
+
+def machine_info():
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_benchmarks(
+    sizes=DEFAULT_SIZES,
+    output="benchmark.json",
+    workdir=BENCH_DIR,
+    num_queries=NUM_QUERIES,
+    concurrency=CONCURRENCY,
+    workers=None,
+    http=True,
+):
+    """
+    Benchmark each corpus size in its own process (so peak RSS and the
+    process-wide indices belong to that size alone) and write one JSON report.
+    """
+    workdir = Path(workdir).resolve()
+    report = {
+        "machine": machine_info(),
+        "config": {
+            "num_queries": num_queries,
+            "concurrency": concurrency,
+            "workers": workers,
+            "seed": SEED,
+            "encoder": "stub",
+        },
+        "sizes": {},
+    }
+    for size in sizes:
+        size_dir = workdir / str(size)
+        shutil.rmtree(size_dir, ignore_errors=True)
+        size_dir.mkdir(parents=True)
+        command = [
+            sys.executable,
+            "-m",
+            "src.benchmark",
+            "--single",
+            str(size),
+            "--workdir",
+            str(size_dir),
+            "--queries",
+            str(num_queries),
+            "--concurrency",
+            str(concurrency),
+        ]
+        if workers:
+            command += ["--workers", str(workers)]
+        if not http:
+            command.append("--no-http")
+        print(f"Benchmarking {size} docs...")
+        subprocess.run(command, check=True)
+        report["sizes"][str(size)] = json.loads((size_dir / "result.json").read_text())
+
+    Path(output).write_text(json.dumps(report, indent=2))
+    print(f"✓ Benchmark report written to {output}")
+    return report
+
+
+if __name__ == "__main__":
+    # python -m src.benchmark [--sizes 10000 100000 1000000] [--output benchmark.json]
+    parser = argparse.ArgumentParser(description="Latency / throughput benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--workdir", default=str(BENCH_DIR))
+    parser.add_argument("--queries", type=int, default=NUM_QUERIES)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-http", action="store_true")
+    # Internal: measure one size inside --workdir (run by run_benchmarks)
+    parser.add_argument("--single", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        os.chdir(args.workdir)
+        result = run_size(
+            args.single,
+            num_queries=args.queries,
+            concurrency=args.concurrency,
+            workers=args.workers,
+            http=not args.no_http,
+        )
+        Path("result.json").write_text(json.dumps(result, indent=2))
+    else:
+        run_benchmarks(
+            args.sizes,
+            output=args.output,
+            workdir=args.workdir,
+            num_queries=args.queries,
+            concurrency=args.concurrency,
+            workers=args.workers,
+            http=not args.no_http,
+        )
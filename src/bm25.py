@@ -0,0 +1,780 @@
+import heapq
+import math
+import threading
+from collections import Counter, OrderedDict, namedtuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# Postings per block-max entry (pruning skips or scores whole blocks)
+BLOCK_SIZE = 64
+
+# Queries scored per sparse product in batch search (bounds the query x
+# document score matrix held at once)
+QUERY_BATCH = 256
+
+# Bound, in postings, on the per-term impacts a RescoredIndex keeps computed
+# (8 bytes each, plus block maxima)
+RESCORE_CACHE_POSTINGS = 2_000_000
+
+# Relative slack on score upper bounds. Bounds and document scores are summed
+# in different orders, so a bound can undershoot the real score by a few ulps.
+BOUND_SLACK = 1e-9
+
+# Postings of one contiguous document range, built by one worker. `terms` is
+# sorted; `first_seen[i]` is the order in which terms[i] first appeared in the
+# range. Postings hold global document indices.
+PartialIndex = namedtuple(
+    "PartialIndex",
+    ["terms", "first_seen", "offsets", "postings", "tfs", "doc_ids", "doc_lens"],
+)
+
+
+class BM25Index:
+    """
+    BM25 (Okapi) over array-backed posting lists.
+
+    Postings are stored CSR-style: the postings of term `t` are
+    `postings[offsets[t]:offsets[t + 1]]` (document indices, ascending) with the
+    matching `tfs` and `impacts`. An impact is the full BM25 contribution of one
+    (term, doc) pair, so a query only sums the impacts of its own terms.
+
+    Scores are computed with exactly the formula and parameters of
+    `rank_bm25.BM25Okapi` (k1, b, epsilon and the average-idf floor), so
+    rankings match the previous engine.
+
+    For dynamic pruning each term also has its maximum impact, and each run of
+    BLOCK_SIZE postings has its maximum impact: the blocks of term `t` are
+    `block_max[block_offsets[t]:block_offsets[t + 1]]`.
+
+    `deleted` is an optional bool array over document indices (tombstones);
+    deleted documents are never returned.
+
+    The same arrays read as a sparse (terms x documents) matrix of impacts
+    score a whole batch of queries with one sparse product (`top_k_batch`).
+    """
+
+    def __init__(
+        self,
+        vocab,
+        offsets,
+        postings,
+        tfs,
+        impacts,
+        doc_ids,
+        doc_lens,
+        idf,
+        k1,
+        b,
+        epsilon,
+        max_impacts=None,
+        block_offsets=None,
+        block_max=None,
+        deleted=None,
+        idf_order=None,
+    ):
+        self.vocab = vocab  # term -> term id
+        self.offsets = offsets
+        self.postings = postings
+        self.tfs = tfs
+        self.impacts = impacts
+        self.doc_ids = doc_ids  # document index -> doc_id
+        self.doc_lens = doc_lens
+        self.idf = idf
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        # Corpus first-seen term order when built from postings (None: term
+        # id order, or not known); not persisted
+        self.idf_order = idf_order
+
+        if max_impacts is None:
+            max_impacts, block_offsets, block_max = block_metadata(offsets, impacts)
+        self.max_impacts = max_impacts
+        self.block_offsets = block_offsets
+        self.block_max = block_max
+        self.deleted = deleted
+        self._weights = None
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault("deleted", None)
+        self.__dict__.setdefault("_weights", None)
+        self.__dict__.setdefault("idf_order", None)
+        if "block_max" not in state:
+            # Pickled before block-max metadata existed
+            self.max_impacts, self.block_offsets, self.block_max = block_metadata(
+                self.offsets, self.impacts
+            )
+
+    @property
+    def num_docs(self):
+        return len(self.doc_ids)
+
+    @classmethod
+    def build(cls, term_vectors, doc_ids, vocab, k1=1.5, b=0.75, epsilon=0.25):
+        """
+        Build the postings from per-document (term ids, tfs) arrays, one per
+        doc_id, with ids from `vocab` (term -> dense id in first-seen order).
+        """
+        id_parts, tf_parts, doc_lens = [], [], []
+        for ids, tfs in term_vectors:
+            id_parts.append(ids)
+            tf_parts.append(tfs)
+            doc_lens.append(int(tfs.sum()))
+
+        lengths = np.array([len(ids) for ids in id_parts], dtype=np.int64)
+        return cls.from_triples(
+            vocab,
+            _concat(id_parts, np.int32),
+            np.repeat(np.arange(len(id_parts), dtype=np.int32), lengths),
+            _concat(tf_parts, np.int32),
+            np.asarray(doc_ids, dtype=np.int64),
+            np.array(doc_lens, dtype=np.int32),
+            k1=k1,
+            b=b,
+            epsilon=epsilon,
+        )
+
+    @classmethod
+    def from_okapi(cls, okapi, doc_ids):
+        """Convert a pickled `rank_bm25.BM25Okapi` into postings"""
+        vocab = {}
+        term_vectors = []
+        for freqs in okapi.doc_freqs:
+            ids = [vocab.setdefault(term, len(vocab)) for term in freqs]
+            term_vectors.append(
+                (
+                    np.array(ids, dtype=np.int32),
+                    np.array(list(freqs.values()), dtype=np.int32),
+                )
+            )
+
+        return cls.build(
+            term_vectors, doc_ids, vocab, k1=okapi.k1, b=okapi.b, epsilon=okapi.epsilon
+        )
+
+    @classmethod
+    def from_triples(
+        cls,
+        vocab,
+        term_col,
+        doc_col,
+        tf_col,
+        doc_ids,
+        doc_lens,
+        k1=1.5,
+        b=0.75,
+        epsilon=0.25,
+    ):
+        """
+        Build from parallel (term id, doc index, tf) arrays.
+        Triples must be in ascending doc index order; term ids must be dense.
+        """
+        # Group by term; the stable sort keeps each posting list in doc order
+        order = np.argsort(term_col, kind="stable")
+        dfs = np.bincount(term_col, minlength=len(vocab))
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(dfs, out=offsets[1:])
+
+        return cls.from_postings(
+            vocab,
+            offsets,
+            doc_col[order].astype(np.int32),
+            tf_col[order].astype(np.int32),
+            doc_ids,
+            doc_lens,
+            k1=k1,
+            b=b,
+            epsilon=epsilon,
+        )
+
+    @classmethod
+    def from_postings(
+        cls,
+        vocab,
+        offsets,
+        postings,
+        tfs,
+        doc_ids,
+        doc_lens,
+        idf_order=None,
+        k1=1.5,
+        b=0.75,
+        epsilon=0.25,
+    ):
+        """
+        Build from CSR postings (tfs only) by computing idf and impacts.
+
+        `idf_order` is the order terms were first seen in the corpus, when it
+        differs from term id order; the average idf is summed in that order,
+        as BM25Okapi does, so floored idfs match it bit for bit.
+        """
+        num_docs = len(doc_ids)
+        idf = compute_idf(np.diff(offsets), num_docs, epsilon, order=idf_order)
+        doc_lens = np.asarray(doc_lens, dtype=np.int32)
+        avgdl = int(doc_lens.sum()) / num_docs if num_docs else 0.0
+        impacts = compute_impacts(idf, offsets, postings, tfs, doc_lens, avgdl, k1, b)
+
+        return cls(
+            vocab,
+            offsets,
+            postings,
+            tfs,
+            impacts,
+            np.asarray(doc_ids, dtype=np.int64),
+            doc_lens,
+            idf,
+            k1,
+            b,
+            epsilon,
+            idf_order=idf_order,
+        )
+
+    def with_stats(self, idf, avgdl, deleted=None):
+        """
+        A copy of this index scored with other collection statistics (per-term
+        idf aligned with this vocabulary, average doc length). Impacts and
+        block maxima of every term are recomputed in memory, ready to be
+        written out; postings stay shared. To search with other statistics,
+        `rescored` computes only the terms queries use.
+        """
+        impacts = compute_impacts(
+            idf,
+            self.offsets,
+            self.postings,
+            self.tfs,
+            self.doc_lens,
+            avgdl,
+            self.k1,
+            self.b,
+        )
+        return BM25Index(
+            self.vocab,
+            self.offsets,
+            self.postings,
+            self.tfs,
+            impacts,
+            self.doc_ids,
+            self.doc_lens,
+            idf,
+            self.k1,
+            self.b,
+            self.epsilon,
+            deleted=deleted,
+        )
+
+    def rescored(self, idf, avgdl, deleted=None):
+        """This index searched with other collection statistics (a RescoredIndex)"""
+        return RescoredIndex(self, idf, avgdl, deleted=deleted)
+
+    def term_postings(self, term_id):
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.postings[start:end], self.impacts[start:end]
+
+    def term_bounds(self, term_id):
+        """A term's max impact and the max impacts of its posting blocks"""
+        start, end = self.block_offsets[term_id], self.block_offsets[term_id + 1]
+        return self.max_impacts[term_id], self.block_max[start:end]
+
+    def score(self, term_ids):
+        """
+        Score the documents matching any query term (ids, repeats counted).
+        Returns (document indices, scores) for matching documents only.
+        """
+        doc_parts, impact_parts = [], []
+        for term_id in term_ids:
+            docs, impacts = self.term_postings(term_id)
+            doc_parts.append(docs)
+            impact_parts.append(impacts)
+
+        if not doc_parts:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)
+        if len(doc_parts) == 1:
+            docs, scores = doc_parts[0], impact_parts[0]
+        else:
+            # Accumulate per document in query-token order, like BM25Okapi does
+            docs, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+            scores = np.bincount(
+                inverse, weights=np.concatenate(impact_parts), minlength=len(docs)
+            )
+
+        if self.deleted is not None:
+            live = ~self.deleted[docs]
+            docs, scores = docs[live], scores[live]
+        return docs, scores
+
+    def top_k(self, term_ids, k=10, exhaustive=False):
+        """
+        Return [(doc_id, score)] for the k best documents.
+
+        Multi-term queries use block-max pruning unless `exhaustive` is set;
+        both paths return the same documents in the same order.
+        """
+        if exhaustive:
+            top = self.top_k_exhaustive(term_ids, k)
+        else:
+            top, _ = self.top_k_pruned(term_ids, k)
+        return [(int(self.doc_ids[d]), float(s)) for d, s in top]
+
+    def weight_matrix(self):
+        """The postings as a sparse (terms x documents) impact matrix, built once"""
+        if self._weights is None:
+            self._weights = csr_matrix(
+                (self.impacts, self.postings, self.offsets),
+                shape=(len(self.offsets) - 1, self.num_docs),
+            )
+        return self._weights
+
+    def top_k_batch(self, queries, k=10):
+        """
+        `top_k` for many queries (lists of term ids, repeats counted) at once.
+        QUERY_BATCH queries at a time form a sparse (queries x terms) count
+        matrix, whose product with `weight_matrix` scores every document of
+        every query; each row then takes its own partial top-k.
+        """
+        results = []
+        for start in range(0, len(queries), QUERY_BATCH):
+            batch = queries[start : start + QUERY_BATCH]
+            lengths = [len(term_ids) for term_ids in batch]
+            rows = np.repeat(np.arange(len(batch)), lengths)
+            weights, cols = self._batch_weights(
+                np.fromiter(
+                    (t for term_ids in batch for t in term_ids), np.int64, sum(lengths)
+                )
+            )
+            # Repeated terms sum to their count
+            query_matrix = csr_matrix(
+                (np.ones(len(cols)), (rows, cols)), shape=(len(batch), weights.shape[0])
+            )
+            scores = (query_matrix @ weights).tocsr()
+
+            for i in range(len(batch)):
+                first, last = scores.indptr[i], scores.indptr[i + 1]
+                docs, row_scores = scores.indices[first:last], scores.data[first:last]
+                if self.deleted is not None:
+                    live = ~self.deleted[docs]
+                    docs, row_scores = docs[live], row_scores[live]
+                top = select_top_k(docs, row_scores, k)
+                results.append([(int(self.doc_ids[d]), float(s)) for d, s in top])
+        return results
+
+    def _batch_weights(self, term_ids):
+        """Impact matrix for a batch and the batch's term ids as its rows"""
+        return self.weight_matrix(), term_ids
+
+    def top_k_exhaustive(self, term_ids, k):
+        """Score every posting of the query terms: [(doc index, score)]"""
+        docs, scores = self.score(term_ids)
+        return select_top_k(docs, scores, k)
+
+    def top_k_pruned(self, term_ids, k):
+        """
+        Block-max pruned top-k: [(doc index, score)] and the number of
+        documents fully scored.
+
+        Every block of every query term gets an upper bound: its own block max
+        plus the max scores of the other query terms. Blocks are visited in
+        descending bound order, in rounds of doubling size; the documents of a
+        round are scored exactly and merged into the running top-k, whose k-th
+        score is the threshold.
+
+        As the threshold rises, the terms whose max scores together cannot
+        reach it become non-essential (MaxScore): a document has to contain an
+        essential term to qualify, so only essential terms' blocks are still
+        visited. Once the best remaining block bound is below the threshold no
+        unvisited document can enter the result and the loop stops.
+        """
+        weights = Counter(term_ids)
+        if k <= 0 or len(weights) < 2 or any(self.idf[t] <= 0 for t in weights):
+            # One posting list is already a single vectorized pass; bounds are
+            # only valid when every impact is positive.
+            docs, scores = self.score(term_ids)
+            return select_top_k(docs, scores, k), len(docs)
+
+        # Term slots ordered by ascending max score, for the MaxScore split
+        term_bounds = {t: self.term_bounds(t) for t in weights}
+        terms = sorted(weights, key=lambda t: weights[t] * term_bounds[t][0])
+        term_weights = np.array([weights[t] for t in terms], dtype=np.float64)
+        max_scores = term_weights * np.array(
+            [term_bounds[t][0] for t in terms], dtype=np.float64
+        )
+        other_max = max_scores.sum() - max_scores
+        max_prefix = np.cumsum(max_scores)
+
+        bound_parts, slot_parts, start_parts, end_parts = [], [], [], []
+        for slot, term_id in enumerate(terms):
+            block_max = term_bounds[term_id][1]
+            starts = self.offsets[term_id] + np.arange(len(block_max)) * BLOCK_SIZE
+            bound_parts.append(term_weights[slot] * block_max + other_max[slot])
+            slot_parts.append(np.full(len(block_max), slot))
+            start_parts.append(starts)
+            end_parts.append(np.minimum(starts + BLOCK_SIZE, self.offsets[term_id + 1]))
+        bounds = np.concatenate(bound_parts)
+        order = np.argsort(-bounds, kind="stable")
+        bounds = bounds[order]
+        block_slots = np.concatenate(slot_parts)[order]
+        block_starts = np.concatenate(start_parts)[order]
+        block_ends = np.concatenate(end_parts)[order]
+
+        top_docs = np.empty(0, dtype=np.int32)
+        top_scores = np.empty(0, dtype=np.float64)
+        seen = np.empty(0, dtype=np.int32)
+        threshold = -math.inf
+        num_essential = 0  # slots below this are non-essential
+
+        take = max(1, -(-k // BLOCK_SIZE))
+        while len(bounds):
+            if bounds[0] * (1 + BOUND_SLACK) < threshold:
+                break
+            batch = slice(0, take)
+            take *= 2
+
+            docs = np.unique(
+                gather_ranges(self.postings, block_starts[batch], block_ends[batch])
+            )
+            bounds, block_slots = bounds[batch.stop :], block_slots[batch.stop :]
+            block_starts, block_ends = (
+                block_starts[batch.stop :],
+                block_ends[batch.stop :],
+            )
+
+            docs = docs[~np.isin(docs, seen, assume_unique=True)]
+            seen = np.union1d(seen, docs)
+            if self.deleted is not None:
+                docs = docs[~self.deleted[docs]]
+            if len(docs):
+                pool_docs = np.concatenate([top_docs, docs])
+                pool_scores = np.concatenate(
+                    [top_scores, self._score_docs(term_ids, docs)]
+                )
+                chosen = _top_k_positions(pool_docs, pool_scores, k)
+                top_docs, top_scores = pool_docs[chosen], pool_scores[chosen]
+                if len(top_docs) == k:
+                    threshold = top_scores[-1]
+
+            # Drop the queued blocks of terms that just became non-essential
+            essential_from = int(
+                np.searchsorted(max_prefix * (1 + BOUND_SLACK), threshold)
+            )
+            if essential_from > num_essential:
+                num_essential = essential_from
+                keep = block_slots >= num_essential
+                bounds, block_slots = bounds[keep], block_slots[keep]
+                block_starts, block_ends = block_starts[keep], block_ends[keep]
+
+        top = list(zip(top_docs.tolist(), top_scores.tolist()))
+        return top, len(seen)
+
+    def _score_docs(self, term_ids, docs):
+        """
+        Exact scores of the given (sorted) document indices. Impacts are added
+        in query-token order, so results are bit-identical to `score()`.
+        """
+        impacts_by_term = {}
+        for term_id in set(term_ids):
+            postings, impacts = self.term_postings(term_id)
+            pos = np.searchsorted(postings, docs)
+            pos_clipped = np.minimum(pos, len(postings) - 1)
+            hit = postings[pos_clipped] == docs
+            impacts_by_term[term_id] = np.where(hit, impacts[pos_clipped], 0.0)
+
+        scores = np.zeros(len(docs), dtype=np.float64)
+        for term_id in term_ids:
+            scores += impacts_by_term[term_id]
+        return scores
+
+
+class RescoredIndex(BM25Index):
+    """
+    A BM25Index searched with other collection statistics (per-term idf
+    aligned with its vocabulary, average doc length), e.g. those of all
+    segments together, without rewriting its impacts.
+
+    A term's impacts and block maxima are computed from its tfs when a query
+    first needs them and kept in an LRU bounded by RESCORE_CACHE_POSTINGS.
+    Nothing proportional to the postings is computed up front, so the
+    index's arrays stay memory-mapped and shared between processes.
+    """
+
+    def __init__(
+        self, index, idf, avgdl, deleted=None, cache_postings=RESCORE_CACHE_POSTINGS
+    ):
+        self.vocab = index.vocab
+        self.offsets = index.offsets
+        self.postings = index.postings
+        self.tfs = index.tfs
+        self.doc_ids = index.doc_ids
+        self.doc_lens = index.doc_lens
+        self.block_offsets = index.block_offsets
+        self.idf = idf
+        self.avgdl = avgdl
+        self.k1 = index.k1
+        self.b = index.b
+        self.epsilon = index.epsilon
+        self.idf_order = None
+        self.deleted = deleted
+        self.cache_postings = cache_postings
+        self._terms = OrderedDict()  # term id -> (impacts, max impact, block max)
+        self._cached = 0
+        self._lock = threading.Lock()
+
+    def _term(self, term_id):
+        with self._lock:
+            entry = self._terms.get(term_id)
+            if entry is not None:
+                self._terms.move_to_end(term_id)
+                return entry
+
+        start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+        offsets = np.array([0, end - start], dtype=np.int64)
+        # The same element-wise formula as a full build: bit-identical impacts
+        impacts = compute_impacts(
+            self.idf[term_id : term_id + 1],
+            offsets,
+            self.postings[start:end],
+            self.tfs[start:end],
+            self.doc_lens,
+            self.avgdl,
+            self.k1,
+            self.b,
+        )
+        max_impacts, _, block_max = block_metadata(offsets, impacts)
+        entry = impacts, max_impacts[0], block_max
+
+        with self._lock:
+            if term_id not in self._terms and len(impacts) <= self.cache_postings:
+                self._terms[term_id] = entry
+                self._cached += len(impacts)
+                while self._cached > self.cache_postings:
+                    _, (evicted, _, _) = self._terms.popitem(last=False)
+                    self._cached -= len(evicted)
+        return entry
+
+    def term_postings(self, term_id):
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.postings[start:end], self._term(term_id)[0]
+
+    def term_bounds(self, term_id):
+        _, max_impact, block_max = self._term(term_id)
+        return max_impact, block_max
+
+    def weight_matrix(self):
+        raise NotImplementedError("A RescoredIndex computes impacts per term")
+
+    def _batch_weights(self, term_ids):
+        """Impact rows of only the batch's distinct terms, in term id order"""
+        terms = np.unique(term_ids)
+        impacts = [self._term(t)[0] for t in terms.tolist()]
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(part) for part in impacts], out=indptr[1:])
+        weights = csr_matrix(
+            (
+                _concat(impacts, np.float64),
+                gather_ranges(
+                    self.postings, self.offsets[terms], self.offsets[terms + 1]
+                ),
+                indptr,
+            ),
+            shape=(len(terms), self.num_docs),
+        )
+        return weights, np.searchsorted(terms, term_ids)
+
+
+def compute_idf(dfs, num_docs, epsilon, order=None):
+    """
+    BM25Okapi idf with its negative-idf floor (epsilon * average idf).
+    The average is summed in `order` (default: term id order), which is the
+    corpus first-seen order in BM25Okapi.
+    """
+    idf = np.empty(len(dfs), dtype=np.float64)
+    for term_id, df in enumerate(np.asarray(dfs).tolist()):
+        idf[term_id] = math.log(num_docs - df + 0.5) - math.log(df + 0.5)
+    if len(idf):
+        idf_sum = 0
+        for value in (idf if order is None else idf[order]).tolist():
+            idf_sum += value
+        average_idf = idf_sum / len(idf)
+        idf[idf < 0] = epsilon * average_idf
+    return idf
+
+
+def compute_impacts(idf, offsets, postings, tfs, doc_lens, avgdl, k1, b):
+    """Per-posting BM25 contributions"""
+    # Evaluated in the same operation order as BM25Okapi.get_scores so the
+    # per-(term, doc) contributions are bit-identical.
+    posting_terms = np.repeat(np.arange(len(idf)), np.diff(offsets))
+    q_freq = np.asarray(tfs).astype(np.int64)
+    doc_len = np.asarray(doc_lens)[postings].astype(np.int64)
+    return idf[posting_terms] * (
+        q_freq * (k1 + 1) / (q_freq + k1 * (1 - b + b * doc_len / avgdl))
+    )
+
+
+def build_partial(term_vectors, vocab, doc_ids, first_doc):
+    """
+    Build the PartialIndex of one document range.
+    `term_vectors` use ids from `vocab` (first-seen order, local to the range);
+    `first_doc` is the global document index of the range's first document.
+    """
+    id_parts = [ids for ids, _ in term_vectors]
+    tf_parts = [tfs for _, tfs in term_vectors]
+    lengths = np.array([len(ids) for ids in id_parts], dtype=np.int64)
+    doc_lens = np.array([int(tfs.sum()) for tfs in tf_parts], dtype=np.int32)
+
+    terms = list(vocab)
+    first_seen = np.array(
+        sorted(range(len(terms)), key=terms.__getitem__), dtype=np.int64
+    )
+    sorted_id = np.empty(len(terms), dtype=np.int64)
+    sorted_id[first_seen] = np.arange(len(terms))
+
+    term_col = sorted_id[_concat(id_parts, np.int32)]
+    order = np.argsort(term_col, kind="stable")
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_col, minlength=len(terms)), out=offsets[1:])
+    postings = first_doc + np.repeat(np.arange(len(lengths), dtype=np.int32), lengths)
+
+    return PartialIndex(
+        [terms[i] for i in first_seen],
+        first_seen,
+        offsets,
+        postings[order].astype(np.int32),
+        _concat(tf_parts, np.int32)[order],
+        np.asarray(doc_ids, dtype=np.int64),
+        doc_lens,
+    )
+
+
+def merge_partials(partials, k1=1.5, b=0.75, epsilon=0.25):
+    """
+    Merge PartialIndexes of consecutive document ranges (in range order) into
+    one BM25Index with a sorted vocabulary.
+
+    The sorted shard vocabularies are k-way merged; each term's postings are
+    then the concatenation of its shard posting lists in range order, copied
+    straight to their final position.
+    """
+    terms = []
+    for term in heapq.merge(*(p.terms for p in partials)):
+        if not terms or terms[-1] != term:
+            terms.append(term)
+    vocab = {term: i for i, term in enumerate(terms)}
+    num_terms = len(terms)
+
+    global_ids = [
+        np.array([vocab[t] for t in p.terms], dtype=np.int64) for p in partials
+    ]
+
+    dfs = np.zeros(num_terms, dtype=np.int64)
+    for p, ids in zip(partials, global_ids):
+        dfs[ids] += np.diff(p.offsets)
+    offsets = np.zeros(num_terms + 1, dtype=np.int64)
+    np.cumsum(dfs, out=offsets[1:])
+
+    # Next free position in each term's posting list
+    cursor = offsets[:-1].copy()
+    postings = np.empty(offsets[-1], dtype=np.int32)
+    tfs = np.empty(offsets[-1], dtype=np.int32)
+    for p, ids in zip(partials, global_ids):
+        local_dfs = np.diff(p.offsets)
+        dest = np.repeat(cursor[ids] - p.offsets[:-1], local_dfs)
+        dest += np.arange(len(p.postings))
+        postings[dest] = p.postings
+        tfs[dest] = p.tfs
+        cursor[ids] += local_dfs
+
+    # Corpus-wide first-seen order: first shard containing the term, then its
+    # first-seen rank within that shard
+    first_shard = np.full(num_terms, len(partials), dtype=np.int64)
+    first_rank = np.zeros(num_terms, dtype=np.int64)
+    for shard, (p, ids) in enumerate(zip(partials, global_ids)):
+        new = first_shard[ids] == len(partials)
+        first_shard[ids[new]] = shard
+        first_rank[ids[new]] = p.first_seen[new]
+    idf_order = np.lexsort((first_rank, first_shard))
+
+    return BM25Index.from_postings(
+        vocab,
+        offsets,
+        postings,
+        tfs,
+        _concat([p.doc_ids for p in partials], np.int64),
+        _concat([p.doc_lens for p in partials], np.int32),
+        idf_order=idf_order,
+        k1=k1,
+        b=b,
+        epsilon=epsilon,
+    )
+
+
+def _concat(parts, dtype):
+    return np.concatenate(parts).astype(dtype) if parts else np.empty(0, dtype=dtype)
+
+
+def gather_ranges(values, starts, ends):
+    """Concatenate values[starts[i]:ends[i]] for all i without a Python loop"""
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return values[:0]
+    shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return values[shifts + np.arange(total)]
+
+
+def block_metadata(offsets, impacts, block_size=BLOCK_SIZE):
+    """
+    Per-term max impacts and per-block max impacts.
+    Block `j` of term `t` covers postings
+    `offsets[t] + j * block_size` up to the next block (or the term's end).
+    Returns (max_impacts, block_offsets, block_max).
+    """
+    dfs = np.diff(offsets)
+    num_blocks = (dfs + block_size - 1) // block_size
+    block_offsets = np.zeros(len(dfs) + 1, dtype=np.int64)
+    np.cumsum(num_blocks, out=block_offsets[1:])
+
+    # Start position (in the postings) of every block of every term
+    block_terms = np.repeat(np.arange(len(dfs)), num_blocks)
+    block_rank = np.arange(block_offsets[-1]) - block_offsets[block_terms]
+    block_starts = offsets[block_terms] + block_rank * block_size
+
+    if len(block_starts):
+        block_max = np.maximum.reduceat(impacts, block_starts)
+    else:
+        block_max = np.empty(0, dtype=np.float64)
+
+    max_impacts = np.zeros(len(dfs), dtype=np.float64)
+    nonempty = dfs > 0
+    if nonempty.any():
+        max_impacts[nonempty] = np.maximum.reduceat(impacts, offsets[:-1][nonempty])
+    return max_impacts, block_offsets, block_max
+
+
+def _top_k_positions(docs, scores, k):
+    """Positions of the k best (score desc, doc asc) entries, in rank order"""
+    if k <= 0 or len(docs) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    if len(docs) > k:
+        # Everything strictly above the k-th score is in; fill the rest with
+        # the lowest document indices among the ties so results are stable.
+        kth = -np.partition(-scores, k - 1)[k - 1]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)
+        ties = ties[np.argsort(docs[ties], kind="stable")][: k - len(above)]
+        candidates = np.concatenate([above, ties])
+    else:
+        candidates = np.arange(len(docs))
+
+    order = np.lexsort((docs[candidates], -scores[candidates]))
+    return candidates[order]
+
+
+def select_top_k(docs, scores, k):
+    """
+    Pick the k highest-scoring (doc, score) pairs with a partial selection.
+    Ties are broken by ascending document index.
+    """
+    chosen = _top_k_positions(docs, scores, k)
+    return list(zip(docs[chosen].tolist(), scores[chosen].tolist()))
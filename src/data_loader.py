@@ -1,73 +1,162 @@
-from itertools import islice
 from pathlib import Path
 
 import duckdb
+import numpy as np
+import pyarrow as pa
 from datasets import load_dataset
 
 DB_PATH = Path("data/ccnews.db")
 DB_PATH.parent.mkdir(exist_ok=True)
 
+DATASET_NAME = "stanford-oval/ccnews"
+DATASET_CONFIG = "2023"
 
-def load_and_clean(limit=10000):
-    """Load dataset, clean, and store in DuckDB"""
-    con = duckdb.connect(str(DB_PATH))
+# Stream records buffered in memory before each append to DuckDB
+INGEST_BATCH_SIZE = 1000
+
+ARTICLE_COLUMNS = ["title", "body", "date", "site", "language"]
+
+# Columns of a corpus record, in record order
+CORPUS_COLUMNS = ("doc_id", "title", "body", "site", "date")
+
+# Rows per batch when streaming the corpus out of DuckDB
+CORPUS_BATCH_SIZE = 5000
 
-    # 1. Create RAW table (No IDs yet, just dump data)
+
+def _ensure_schema(con):
+    """
+    Create clean_news and the ingestion checkpoint table if missing, and add
+    the content_hash column to tables created before it existed.
+    """
     con.execute("""
-    CREATE TABLE IF NOT EXISTS news (
+    CREATE TABLE IF NOT EXISTS clean_news (
+        doc_id BIGINT,
         title TEXT,
         body TEXT,
         date TEXT,
         site TEXT,
-        language TEXT
+        language TEXT,
+        content_hash TEXT
+    );
+    """)
+    columns = {
+        row[1] for row in con.execute("PRAGMA table_info('clean_news')").fetchall()
+    }
+    if "content_hash" not in columns:
+        con.execute("ALTER TABLE clean_news ADD COLUMN content_hash TEXT")
+        con.execute("UPDATE clean_news SET content_hash = md5(title || chr(0) || body)")
+
+    # How far into each source stream ingestion got; updated in the same
+    # transaction as the rows, so a crash resumes right after the last batch
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS ingest_state (
+        source TEXT PRIMARY KEY,
+        stream_position BIGINT,
+        articles BIGINT
     );
     """)
 
-    # 2. Load dataset
-    print("Loading dataset...")
-    ds = load_dataset(
-        "stanford-oval/ccnews", name="2023", split="train", streaming=True
-    )
 
-    # Filter for English only
-    ds = (x for x in ds if x["language"] == "en")
-    sample = list(islice(ds, limit))
-
-    # 3. Insert into raw table
-    print(f"Inserting {len(sample)} articles...")
-    batch = [
-        (
-            x["title"],
-            x["plain_text"],
-            x["published_date"],
-            x["sitename"],
-            x["language"],
+def _append_batch(con, batch):
+    """
+    Append an Arrow table of articles (ARTICLE_COLUMNS) to clean_news in one
+    columnar insert. Rows without title or body and rows whose content hash
+    (title + body) is already stored, or repeated in the batch, are dropped.
+    New doc_ids continue after the current maximum, in batch order, so
+    existing ids never change. Returns the range of new doc_ids.
+    """
+    batch = batch.append_column("pos", pa.array(range(batch.num_rows), pa.int64()))
+    con.register("incoming", batch)
+    first_id = con.execute(
+        "SELECT COALESCE(MAX(doc_id), 0) + 1 FROM clean_news"
+    ).fetchone()[0]
+    con.execute(
+        """
+        INSERT INTO clean_news
+        SELECT
+            ? - 1 + row_number() OVER (ORDER BY pos) AS doc_id,
+            title, body, date, site, language, content_hash
+        FROM (
+            SELECT * FROM (
+                SELECT *, md5(title || chr(0) || body) AS content_hash
+                FROM incoming
+                WHERE title IS NOT NULL AND body IS NOT NULL
+            )
+            WHERE content_hash NOT IN (
+                SELECT content_hash FROM clean_news WHERE content_hash IS NOT NULL
+            )
+            QUALIFY row_number() OVER (PARTITION BY content_hash ORDER BY pos) = 1
         )
-        for x in sample
-    ]
-    con.executemany(
-        "INSERT INTO news (title, body, date, site, language) VALUES (?, ?, ?, ?, ?)",
-        batch,
+        """,
+        [first_id],
     )
+    con.unregister("incoming")
+    last_id = con.execute("SELECT COALESCE(MAX(doc_id), 0) FROM clean_news").fetchone()[
+        0
+    ]
+    return first_id, last_id
 
-    # 4. Clean & Generate IDs
-    # We dedup on content FIRST, then generate IDs using row_number()
-    print("Cleaning and generating IDs...")
-    con.execute("""
-    CREATE OR REPLACE TABLE clean_news AS
-    SELECT 
-        row_number() OVER () as doc_id,
-        title, 
-        body, 
-        date, 
-        site, 
-        language
-    FROM (
-        SELECT DISTINCT title, body, date, site, language
-        FROM news
-        WHERE title IS NOT NULL AND body IS NOT NULL
-    );
-    """)
+
+def load_and_clean(limit=10000, batch_size=INGEST_BATCH_SIZE):
+    """
+    Stream English articles from the dataset into DuckDB until `limit` have
+    been read, `batch_size` at a time, deduplicating on a content hash.
+
+    Memory stays bounded by one batch. Ingestion is resumable: progress is
+    checkpointed with every batch, and a re-run (after a crash, or with a
+    higher limit) continues from the checkpoint and keeps existing doc_ids.
+    """
+    con = duckdb.connect(str(DB_PATH))
+    _ensure_schema(con)
+
+    source = f"{DATASET_NAME}/{DATASET_CONFIG}/train"
+    state = con.execute(
+        "SELECT stream_position, articles FROM ingest_state WHERE source = ?",
+        [source],
+    ).fetchone()
+    position, articles = state or (0, 0)
+    if articles >= limit:
+        print(f"✓ Already ingested {articles} articles from {source}")
+        con.close()
+        return
+
+    print(f"Streaming dataset from record {position} ({articles} articles so far)...")
+    ds = load_dataset(DATASET_NAME, name=DATASET_CONFIG, split="train", streaming=True)
+    stream = iter(ds.skip(position))
+
+    inserted = 0
+    exhausted = False
+    while articles < limit and not exhausted:
+        # Filter for English only; position counts every record read
+        columns = {name: [] for name in ARTICLE_COLUMNS}
+        while len(columns["title"]) < min(batch_size, limit - articles):
+            x = next(stream, None)
+            if x is None:
+                exhausted = True
+                break
+            position += 1
+            if x["language"] != "en":
+                continue
+            columns["title"].append(x["title"])
+            columns["body"].append(x["plain_text"])
+            columns["date"].append(x["published_date"])
+            columns["site"].append(x["sitename"])
+            columns["language"].append(x["language"])
+
+        batch = pa.table(
+            {name: pa.array(values, pa.string()) for name, values in columns.items()}
+        )
+        articles += batch.num_rows
+
+        con.begin()
+        first_id, last_id = _append_batch(con, batch)
+        con.execute(
+            "INSERT OR REPLACE INTO ingest_state VALUES (?, ?, ?)",
+            [source, position, articles],
+        )
+        con.commit()
+        inserted += last_id - first_id + 1
+        print(f"  {articles}/{limit} articles read, {inserted} new")
 
     count = con.execute("SELECT COUNT(*) FROM clean_news").fetchone()[0]
     print(f"✓ Cleaned dataset: {count} unique articles")
@@ -75,11 +164,145 @@ def load_and_clean(limit=10000):
     con.close()
 
 
-def get_docs():
-    """Fetch all clean docs from DB"""
+def iter_corpus(
+    columns=CORPUS_COLUMNS, batch_size=CORPUS_BATCH_SIZE, doc_id_range=None
+):
+    """
+    Stream clean_news in doc_id order as Arrow record batches of at most
+    `batch_size` rows, reading only `columns` (any of CORPUS_COLUMNS),
+    optionally only doc_ids in [first, last].
+    """
+    unknown = set(columns) - set(CORPUS_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown corpus columns: {sorted(unknown)}")
+
+    query = f"SELECT {', '.join(columns)} FROM clean_news"
+    params = []
+    if doc_id_range is not None:
+        query += " WHERE doc_id BETWEEN ? AND ?"
+        params = [int(doc_id) for doc_id in doc_id_range]
+    query += " ORDER BY doc_id"
+
+    con = duckdb.connect(str(DB_PATH), read_only=True)
+    try:
+        yield from con.execute(query, params).fetch_record_batch(batch_size)
+    finally:
+        con.close()
+
+
+def iter_docs(doc_id_range=None, batch_size=CORPUS_BATCH_SIZE):
+    """Stream (doc_id, title, body, site, date) records in doc_id order"""
+    for batch in iter_corpus(batch_size=batch_size, doc_id_range=doc_id_range):
+        yield from zip(*(batch.column(name).to_pylist() for name in CORPUS_COLUMNS))
+
+
+def get_docs(doc_id_range=None):
+    """Fetch clean docs from DB, optionally only doc_ids in [first, last]"""
+    return list(iter_docs(doc_id_range))
+
+
+def get_doc_ids():
+    """All clean doc_ids, ascending"""
+    con = duckdb.connect(str(DB_PATH), read_only=True)
+    doc_ids = [
+        row[0]
+        for row in con.execute(
+            "SELECT doc_id FROM clean_news ORDER BY doc_id"
+        ).fetchall()
+    ]
+    con.close()
+    return doc_ids
+
+
+def get_text_lengths():
+    """(doc_ids, characters of "title body") arrays, in doc_id order"""
+    con = duckdb.connect(str(DB_PATH), read_only=True)
+    arrays = con.execute("""
+        SELECT doc_id, length(title) + 1 + length(body) AS length
+        FROM clean_news ORDER BY doc_id
+        """).fetchnumpy()
+    con.close()
+    return np.asarray(arrays["doc_id"]), np.asarray(arrays["length"])
+
+
+def get_texts(doc_ids):
+    """
+    "title body" texts of `doc_ids`, in the given order
+    (an empty string for ids no longer in clean_news)
+    """
+    wanted = pa.table(
+        {
+            "doc_id": pa.array(doc_ids, pa.int64()),
+            "pos": pa.array(range(len(doc_ids)), pa.int64()),
+        }
+    )
+    con = duckdb.connect(str(DB_PATH), read_only=True)
+    con.register("wanted", wanted)
+    texts = [row[0] for row in con.execute("""
+            SELECT COALESCE(c.title || ' ' || c.body, '')
+            FROM wanted w LEFT JOIN clean_news c USING (doc_id)
+            ORDER BY w.pos
+            """).fetchall()]
+    con.close()
+    return texts
+
+
+def append_articles(articles):
+    """
+    Insert new (title, body, site, date) articles into clean_news, deduplicated
+    like `load_and_clean` and with doc_ids after the current maximum.
+    Returns the inserted (doc_id, title, body, site, date) records.
+    """
+    articles = list(articles)
+    batch = pa.table(
+        {
+            "title": pa.array([a[0] for a in articles], pa.string()),
+            "body": pa.array([a[1] for a in articles], pa.string()),
+            "date": pa.array([a[3] for a in articles], pa.string()),
+            "site": pa.array([a[2] for a in articles], pa.string()),
+            "language": pa.array(["en"] * len(articles), pa.string()),
+        }
+    )
+
     con = duckdb.connect(str(DB_PATH))
-    docs = con.execute(
-        "SELECT doc_id, title, body, site, date FROM clean_news ORDER BY doc_id"
+    _ensure_schema(con)
+    con.begin()
+    first_id, last_id = _append_batch(con, batch)
+    con.commit()
+    records = con.execute(
+        """
+        SELECT doc_id, title, body, site, date FROM clean_news
+        WHERE doc_id BETWEEN ? AND ?
+        ORDER BY doc_id
+        """,
+        [first_id, last_id],
     ).fetchall()
     con.close()
-    return docs
+    return records
+
+
+def append_article_batches(batches):
+    """
+    Append Arrow tables of articles (ARTICLE_COLUMNS) to clean_news, one
+    transaction per table, deduplicated like `load_and_clean`.
+    Returns the number of articles stored.
+    """
+    con = duckdb.connect(str(DB_PATH))
+    _ensure_schema(con)
+    stored = 0
+    for batch in batches:
+        con.begin()
+        first_id, last_id = _append_batch(con, batch)
+        con.commit()
+        stored += last_id - first_id + 1
+    con.close()
+    return stored
+
+
+def delete_articles(doc_ids):
+    """Remove articles from clean_news"""
+    con = duckdb.connect(str(DB_PATH))
+    con.executemany(
+        "DELETE FROM clean_news WHERE doc_id = ?", [(int(d),) for d in doc_ids]
+    )
+    con.close()
@@ -0,0 +1,227 @@
+import json
+import mmap
+import threading
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+SNIPPET_CHARS = 150
+
+# Hot documents kept decoded in memory (per process)
+DOC_CACHE_SIZE = 10000
+
+# Fields served from the cache; "body" is always read from the body file
+CACHED_FIELDS = ("title", "snippet", "site", "date")
+
+
+def make_snippet(body, length=SNIPPET_CHARS):
+    return (body[:length] + "...") if len(body) > length else body
+
+
+def map_bytes(path):
+    """Read-only mmap of a whole file (empty files map to b"")"""
+    with open(path, "rb") as f:
+        if Path(path).stat().st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_strings(path, offsets_path, strings):
+    """Write UTF-8 strings back to back plus an offsets array (len + 1)"""
+    writer = _StringColumnWriter(path, offsets_path)
+    for s in strings:
+        writer.add(s)
+    writer.close()
+
+
+class _StringColumn:
+    """Memory-mapped UTF-8 strings stored back to back with an offsets array"""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def open(cls, directory, name):
+        return cls(
+            map_bytes(directory / f"{name}.bin"),
+            np.load(directory / f"{name}_offsets.npy", mmap_mode="r"),
+        )
+
+    def get(self, row, max_bytes=None):
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        if max_bytes is not None and end - start > max_bytes:
+            # A cut multi-byte character at the end is dropped
+            return (
+                self.data[start : start + max_bytes].decode("utf-8", errors="ignore"),
+                True,
+            )
+        return self.data[start:end].decode("utf-8"), False
+
+
+class _StringColumnWriter:
+    def __init__(self, path, offsets_path):
+        self.file = open(path, "wb")
+        self.offsets_path = offsets_path
+        self.offsets = array("q", [0])
+
+    def add(self, s):
+        data = s.encode("utf-8")
+        self.file.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def close(self):
+        self.file.close()
+        np.save(self.offsets_path, np.frombuffer(self.offsets, dtype=np.int64))
+
+
+class DocStore:
+    """
+    Lazy, read-only document store.
+
+    Bodies live in an append-only file addressed by an offset array; title and
+    date are separate string columns and site is dictionary-encoded. Nothing is
+    decoded until asked for, and a bounded LRU keeps the result-list fields
+    (title, snippet, site, date) of hot documents.
+    """
+
+    def __init__(
+        self,
+        doc_ids,
+        bodies,
+        titles,
+        dates,
+        site_codes,
+        sites,
+        cache_size=DOC_CACHE_SIZE,
+    ):
+        self.doc_ids = doc_ids  # sorted, row -> doc_id
+        self.bodies = bodies
+        self.titles = titles
+        self.dates = dates
+        self.site_codes = site_codes
+        self.sites = sites
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, directory, doc_ids, cache_size=DOC_CACHE_SIZE):
+        directory = Path(directory)
+        return cls(
+            doc_ids,
+            _StringColumn.open(directory, "bodies"),
+            _StringColumn.open(directory, "titles"),
+            _StringColumn.open(directory, "dates"),
+            np.load(directory / "site_codes.npy", mmap_mode="r"),
+            json.loads((directory / "sites.json").read_text()),
+            cache_size=cache_size,
+        )
+
+    def row(self, doc_id):
+        """Row of doc_id in this store, or None"""
+        row = int(np.searchsorted(self.doc_ids, doc_id))
+        if row < len(self.doc_ids) and self.doc_ids[row] == doc_id:
+            return row
+        return None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return self.row(doc_id) is not None
+
+    def __iter__(self):
+        return (int(doc_id) for doc_id in self.doc_ids)
+
+    def body(self, doc_id):
+        row = self.row(doc_id)
+        if row is None:
+            raise KeyError(doc_id)
+        return self.bodies.get(row)[0]
+
+    def get(self, doc_id, fields=CACHED_FIELDS):
+        """
+        Return {field: value} for one document, or None if it does not exist.
+        Fields: title, snippet, site, date, body.
+        """
+        with self._lock:
+            record = self._cache.get(doc_id)
+            if record is not None:
+                self._cache.move_to_end(doc_id)
+
+        if record is None:
+            row = self.row(doc_id)
+            if row is None:
+                return None
+            record = self._load(row)
+            with self._lock:
+                self._cache[doc_id] = record
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        result = {f: record[f] for f in fields if f != "body"}
+        if "body" in fields:
+            result["body"] = self.body(doc_id)
+        return result
+
+    def _load(self, row):
+        # A body longer than SNIPPET_CHARS characters has more than that many
+        # bytes, and SNIPPET_CHARS + 1 characters fit in 4x as many bytes.
+        prefix, cut = self.bodies.get(row, max_bytes=4 * (SNIPPET_CHARS + 1))
+        snippet = (prefix[:SNIPPET_CHARS] + "...") if cut else make_snippet(prefix)
+        return {
+            "title": self.titles.get(row)[0],
+            "snippet": snippet,
+            "site": self.sites[self.site_codes[row]],
+            "date": self.dates.get(row)[0],
+        }
+
+
+class DocStoreWriter:
+    """
+    Writes (doc_id, title, body, site, date) records, in doc_id order, as
+    column files in one pass. Missing values are stored as empty strings.
+    """
+
+    def __init__(self, directory):
+        directory = Path(directory)
+        self.directory = directory
+        self.bodies = _StringColumnWriter(
+            directory / "bodies.bin", directory / "bodies_offsets.npy"
+        )
+        self.titles = _StringColumnWriter(
+            directory / "titles.bin", directory / "titles_offsets.npy"
+        )
+        self.dates = _StringColumnWriter(
+            directory / "dates.bin", directory / "dates_offsets.npy"
+        )
+        self.sites = {}
+        self.site_codes = array("i")
+
+    def add(self, doc_id, title, body, site, date):
+        self.titles.add(title or "")
+        self.bodies.add(body or "")
+        self.dates.add(date or "")
+        self.site_codes.append(self.sites.setdefault(site or "", len(self.sites)))
+
+    def close(self):
+        for column in (self.bodies, self.titles, self.dates):
+            column.close()
+        np.save(
+            self.directory / "site_codes.npy",
+            np.frombuffer(self.site_codes, dtype=np.int32),
+        )
+        (self.directory / "sites.json").write_text(
+            json.dumps(list(self.sites), ensure_ascii=False)
+        )
+
+
+def write_docstore(directory, docs):
+    """Write an iterable of (doc_id, title, body, site, date) records"""
+    writer = DocStoreWriter(directory)
+    for doc in docs:
+        writer.add(*doc)
+    writer.close()
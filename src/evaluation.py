@@ -1,6 +1,9 @@
 import math
+from itertools import chain
 from typing import Dict, List, Set
 
+import numpy as np
+
 
 def precision_at_k(retrieved_ids: List[int], relevant_ids: Set[int], k: int) -> float:
     """
@@ -103,25 +106,84 @@ def ndcg_at_k(retrieved_ids: List[int], relevant_ids: Set[int], k: int) -> float
     return dcg / idcg
 
 
+def relevance_matrix(retrieved, relevant, depth=None):
+    """
+    Binary relevance of every ranked result, for many queries at once.
+    `retrieved[i]` is query i's ranked doc_ids and `relevant[i]` its relevant
+    doc_ids. Returns a (queries x depth) bool matrix, rows padded with
+    non-relevant entries, and the number of relevant documents per query.
+    """
+    if depth is None:
+        depth = max((len(ids) for ids in retrieved), default=0)
+    relevant = [set(ids) for ids in relevant]
+    num_queries = len(retrieved)
+
+    lengths = np.array([min(len(ids), depth) for ids in retrieved], dtype=np.int64)
+    rows = np.repeat(np.arange(num_queries), lengths)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    ranked = np.full((num_queries, depth), -1, dtype=np.int64)
+    ranked[rows, cols] = np.fromiter(
+        chain.from_iterable(ids[:depth] for ids in retrieved), np.int64, len(rows)
+    )
+
+    num_relevant = np.array([len(ids) for ids in relevant], dtype=np.int64)
+    relevant_rows = np.repeat(np.arange(num_queries), num_relevant)
+    relevant_ids = np.fromiter(
+        chain.from_iterable(relevant), np.int64, int(num_relevant.sum())
+    )
+
+    # One key per (query, doc_id) pair, so a single isin finds every hit
+    span = max(int(ranked.max(initial=0)), int(relevant_ids.max(initial=0))) + 2
+    keys = np.arange(num_queries)[:, None] * span + ranked + 1
+    hits = np.isin(keys, relevant_rows * span + relevant_ids + 1) & (ranked >= 0)
+    return hits, num_relevant
+
+
+def metrics_from_relevance(hits, num_relevant, k: int = 10) -> Dict[str, float]:
+    """
+    MAP, Precision@k, Recall@k and nDCG@k (binary relevance) averaged over
+    the rows of a relevance matrix from `relevance_matrix`, computed with
+    array operations over all queries together.
+    """
+    num_queries, depth = hits.shape
+    names = ["MAP", f"Mean Precision@{k}", f"Mean Recall@{k}", f"Mean nDCG@{k}"]
+    if num_queries == 0 or k <= 0:
+        return dict.fromkeys(names, 0.0)
+
+    hits = hits.astype(np.float64)
+    # Queries without relevant documents score 0 everywhere
+    denominator = np.maximum(num_relevant, 1)
+
+    ranks = np.arange(1, depth + 1)
+    average_precision = (hits * np.cumsum(hits, axis=1) / ranks).sum(axis=1)
+    average_precision /= denominator
+
+    top = hits[:, :k]
+    hits_at_k = top.sum(axis=1)
+    precision = hits_at_k / k
+    recall = hits_at_k / denominator
+
+    discounts = 1.0 / np.log2(np.arange(k) + 2)
+    dcg = top @ discounts[: top.shape[1]]
+    ideal = np.concatenate([[0.0], np.cumsum(discounts)])[np.minimum(num_relevant, k)]
+    ndcg = np.divide(dcg, ideal, out=np.zeros(num_queries), where=ideal > 0)
+
+    return dict(
+        zip(
+            names,
+            (float(m.mean()) for m in (average_precision, precision, recall, ndcg)),
+        )
+    )
+
+
 def evaluate_system(
     results: Dict[str, List[int]], ground_truth: Dict[str, Set[int]], k: int = 10
 ) -> Dict[str, float]:
     """
     Run full evaluation suite.
     """
-    precisions = []
-    recalls = []
-    ndcgs = []
-
-    for query, retrieved_ids in results.items():
-        relevant_ids = ground_truth.get(query, set())
-        precisions.append(precision_at_k(retrieved_ids, relevant_ids, k))
-        recalls.append(recall_at_k(retrieved_ids, relevant_ids, k))
-        ndcgs.append(ndcg_at_k(retrieved_ids, relevant_ids, k))
-
-    return {
-        "MAP": mean_average_precision(results, ground_truth),
-        f"Mean Precision@{k}": sum(precisions) / len(precisions) if precisions else 0.0,
-        f"Mean Recall@{k}": sum(recalls) / len(recalls) if recalls else 0.0,
-        f"Mean nDCG@{k}": sum(ndcgs) / len(ndcgs) if ndcgs else 0.0,
-    }
+    queries = list(results)
+    hits, num_relevant = relevance_matrix(
+        [results[q] for q in queries], [ground_truth.get(q, set()) for q in queries]
+    )
+    return metrics_from_relevance(hits, num_relevant, k)
@@ -0,0 +1,71 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.evaluation import metrics_from_relevance, relevance_matrix
+from src.hybrid import hybrid_top_k_batch
+from src.search import bm25_top_k_batch
+from src.semantic.semantic_search import semantic_top_k_batch
+
+# Queries per retriever call; the chunks of a query set run in parallel
+EVAL_CHUNK = 256
+
+# Threads retrieving chunks (the retrievers' numpy work releases the GIL)
+EVAL_WORKERS = 4
+
+# name -> retrieve(queries, top_k) returning one ranked doc_id list per query
+RETRIEVERS = {}
+
+
+def register_retriever(name, retrieve):
+    """Make a batch retriever available to `evaluate_systems` under `name`"""
+    RETRIEVERS[name] = retrieve
+
+
+def _ids(batch_results):
+    return [[doc_id for doc_id, *_ in results] for results in batch_results]
+
+
+register_retriever("bm25", lambda queries, k: _ids(bm25_top_k_batch(queries, k)))
+register_retriever(
+    "semantic", lambda queries, k: _ids(semantic_top_k_batch(queries, k))
+)
+register_retriever("hybrid", lambda queries, k: _ids(hybrid_top_k_batch(queries, k)))
+
+
+def retrieve_all(system, queries, top_k=10, workers=EVAL_WORKERS):
+    """Ranked doc_ids of every query from a registered retriever, chunks in parallel"""
+    if system not in RETRIEVERS:
+        raise ValueError(f"Unknown retriever {system!r}; one of {sorted(RETRIEVERS)}")
+    retrieve = RETRIEVERS[system]
+    chunks = [queries[i : i + EVAL_CHUNK] for i in range(0, len(queries), EVAL_CHUNK)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(lambda chunk: retrieve(chunk, top_k), chunks))
+    return [ids for part in parts for ids in part]
+
+
+def evaluate_systems(
+    ground_truth, systems=("bm25",), top_k=10, k=None, workers=EVAL_WORKERS
+):
+    """
+    Several retrievers on one query set, side by side.
+    `ground_truth` maps each query to its relevant doc_ids. Each system
+    retrieves `top_k` results per query; metrics are cut at `k` (top_k by
+    default). Returns {system: {metric: value, ..., "seconds": wall time}}.
+    """
+    unknown = [system for system in systems if system not in RETRIEVERS]
+    if unknown:
+        raise ValueError(f"Unknown retrievers {unknown}; one of {sorted(RETRIEVERS)}")
+    k = k or top_k
+    queries = list(ground_truth)
+    relevant = [ground_truth[q] for q in queries]
+
+    report = {}
+    for system in systems:
+        start_time = time.time()
+        retrieved = retrieve_all(system, queries, top_k, workers)
+        hits, num_relevant = relevance_matrix(retrieved, relevant, depth=top_k)
+        report[system] = {
+            **metrics_from_relevance(hits, num_relevant, k),
+            "seconds": round(time.time() - start_time, 3),
+        }
+    return report
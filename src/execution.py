@@ -0,0 +1,149 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+# Per lane: (concurrent calls, callers allowed to queue, timeout in seconds,
+# "thread" or "process" pool). Each value can be overridden with an
+# environment variable LANE_<NAME>_<CONCURRENCY|QUEUE|TIMEOUT>.
+LANE_SETTINGS = {
+    "search": (8, 64, 5.0, "thread"),
+    "semantic": (4, 32, 10.0, "thread"),
+    "rag": (2, 8, 60.0, "thread"),
+    "evaluate": (1, 4, 120.0, "thread"),
+    "batch": (1, 4, 60.0, "thread"),
+    # Pure-Python text analysis: processes, so it does not hold the GIL
+    "seo": (2, 16, 5.0, "process"),
+}
+
+# Seconds a shed client is told to wait before retrying
+RETRY_AFTER = 1
+
+
+class Lane:
+    """
+    Bounded execution for one group of endpoints.
+
+    At most `concurrency` calls run at once, on the lane's own pool, off the
+    event loop. Up to `max_queue` more wait for a slot; beyond that requests
+    are shed with 503 straight away. A request that has not finished within
+    `timeout` seconds (queueing included) gets 504. Its call still runs to
+    completion and keeps its slot until then, so the limit holds even for
+    abandoned work.
+    """
+
+    def __init__(self, name, concurrency, max_queue, timeout, kind="thread"):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.kind = kind
+        self._executor = None
+        self._slots = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+        self.active = 0
+        self.counts = {"completed": 0, "failed": 0, "shed": 0, "timed_out": 0}
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                # spawn: forking a process that already runs threads can deadlock
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.concurrency,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.concurrency, thread_name_prefix=self.name
+                )
+        return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` in the lane; raises 503 / 504 HTTPExceptions"""
+        if self._slots.locked() and self.waiting >= self.max_queue:
+            self.counts["shed"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail=f"{self.name} is overloaded, retry later",
+                headers={"Retry-After": str(RETRY_AFTER)},
+            )
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            # Waited the whole timeout for a slot: a timeout, not a shed request
+            self.counts["timed_out"] += 1
+            raise HTTPException(
+                status_code=504, detail=f"{self.name} timed out after {self.timeout}s"
+            )
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        future = loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs)
+        )
+        future.add_done_callback(self._release)
+        try:
+            # shield: a timeout abandons the call but does not cancel it
+            return await asyncio.wait_for(
+                asyncio.shield(future), max(deadline - loop.time(), 0)
+            )
+        except asyncio.TimeoutError:
+            self.counts["timed_out"] += 1
+            raise HTTPException(
+                status_code=504, detail=f"{self.name} timed out after {self.timeout}s"
+            )
+
+    def _release(self, future):
+        self.active -= 1
+        self._slots.release()
+        if future.cancelled() or future.exception() is not None:
+            self.counts["failed"] += 1
+        else:
+            self.counts["completed"] += 1
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "timeout": self.timeout,
+            "kind": self.kind,
+            "active": self.active,
+            "waiting": self.waiting,
+            **self.counts,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _setting(name, key, default, cast):
+    value = os.getenv(f"LANE_{name.upper()}_{key}")
+    return default if value is None else cast(value)
+
+
+def make_lanes(settings=LANE_SETTINGS):
+    """One Lane per entry of `settings`, with environment overrides applied"""
+    lanes = {}
+    for name, (concurrency, max_queue, timeout, kind) in settings.items():
+        lanes[name] = Lane(
+            name,
+            concurrency=_setting(name, "CONCURRENCY", concurrency, int),
+            max_queue=_setting(name, "QUEUE", max_queue, int),
+            timeout=_setting(name, "TIMEOUT", timeout, float),
+            kind=kind,
+        )
+    return lanes
+
+
+lanes = make_lanes()
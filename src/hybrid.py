@@ -0,0 +1,148 @@
+import asyncio
+
+from src.execution import lanes
+from src.indexer import registry
+from src.search import bm25_top_k, bm25_top_k_batch
+from src.semantic.semantic_search import semantic_top_k, semantic_top_k_batch
+
+FUSION_METHODS = ("rrf", "weighted")
+
+# RRF constant: a document at rank r in a list contributes 1 / (RRF_K + r)
+RRF_K = 60
+
+# Weight of the semantic scores in weighted fusion (BM25 gets the rest)
+SEMANTIC_WEIGHT = 0.5
+
+# Candidates taken from each retriever before fusing, at least top_k
+CANDIDATE_DEPTH = 50
+
+
+def rrf_fuse(ranked_lists, k=RRF_K):
+    """
+    Reciprocal-rank fusion of [(doc_id, score)] lists: {doc_id: fused score}.
+    Only ranks matter, so the retrievers' score scales need not agree.
+    """
+    fused = {}
+    for ranked in ranked_lists:
+        for rank, (doc_id, _) in enumerate(ranked, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return fused
+
+
+def weighted_fuse(ranked_lists, weights):
+    """
+    Weighted sum of min-max normalized scores: {doc_id: fused score}.
+    A document missing from a list gets 0 from it.
+    """
+    fused = {}
+    for ranked, weight in zip(ranked_lists, weights):
+        if not ranked:
+            continue
+        scores = [score for _, score in ranked]
+        low, high = min(scores), max(scores)
+        for doc_id, score in ranked:
+            normalized = (score - low) / (high - low) if high > low else 1.0
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * normalized
+    return fused
+
+
+async def hybrid_top_k(
+    query: str,
+    top_k: int = 10,
+    fusion: str = "rrf",
+    semantic_weight: float = SEMANTIC_WEIGHT,
+    rrf_k: int = RRF_K,
+    nprobe: int | None = None,
+    exact: bool = False,
+    indices=None,
+):
+    """
+    BM25 and semantic retrieval run concurrently, each in its own execution
+    lane ("search" and "semantic"), and fused. Returns [(doc_id, fused score,
+    bm25 rank, semantic rank)], ranks 1-based or None where the document was
+    not retrieved by that system.
+    """
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"fusion must be one of {FUSION_METHODS}, not {fusion!r}")
+    indices = indices or registry.get()
+    depth = max(top_k, CANDIDATE_DEPTH)
+
+    ranked_lists = await asyncio.gather(
+        lanes["search"].run(bm25_top_k, query, depth, indices=indices),
+        lanes["semantic"].run(semantic_top_k, query, depth, nprobe=nprobe, exact=exact),
+    )
+    return _fuse(ranked_lists, top_k, fusion, semantic_weight, rrf_k)
+
+
+def hybrid_top_k_batch(
+    queries,
+    top_k: int = 10,
+    fusion: str = "rrf",
+    semantic_weight: float = SEMANTIC_WEIGHT,
+    rrf_k: int = RRF_K,
+    nprobe: int | None = None,
+    exact: bool = False,
+):
+    """
+    `hybrid_top_k` for many queries: both retrievers score the whole batch,
+    one after the other in the caller's thread, then each query's lists are
+    fused.
+    """
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"fusion must be one of {FUSION_METHODS}, not {fusion!r}")
+    depth = max(top_k, CANDIDATE_DEPTH)
+
+    lexical = bm25_top_k_batch(queries, depth)
+    semantic = semantic_top_k_batch(queries, depth, nprobe=nprobe, exact=exact)
+    return [
+        _fuse(ranked_lists, top_k, fusion, semantic_weight, rrf_k)
+        for ranked_lists in zip(lexical, semantic)
+    ]
+
+
+def _fuse(ranked_lists, top_k, fusion, semantic_weight, rrf_k):
+    """[(doc_id, fused score, bm25 rank, semantic rank)] of (bm25, semantic) lists"""
+    if fusion == "rrf":
+        fused = rrf_fuse(ranked_lists, k=rrf_k)
+    else:
+        fused = weighted_fuse(ranked_lists, [1.0 - semantic_weight, semantic_weight])
+
+    ranks = [
+        {doc_id: rank for rank, (doc_id, _) in enumerate(ranked, start=1)}
+        for ranked in ranked_lists
+    ]
+    best = sorted(fused.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+    return [
+        (doc_id, score, ranks[0].get(doc_id), ranks[1].get(doc_id))
+        for doc_id, score in best
+    ]
+
+
+async def hybrid_search(query: str, top_k: int = 10, **params):
+    """
+    Hybrid search results with document fields. Fields are fetched once per
+    fused result, however many retrievers returned the document.
+    """
+    indices = registry.get()
+    fused = await hybrid_top_k(query, top_k, indices=indices, **params)
+    return await lanes["search"].run(_with_fields, indices, fused)
+
+
+def _with_fields(indices, fused):
+    results = []
+    for doc_id, score, bm25_rank, semantic_rank in fused:
+        fields = indices.docs.get(doc_id, ("title", "snippet", "site", "date"))
+        if fields is None:
+            # The semantic side can return documents deleted since its store
+            # was published
+            continue
+        results.append(
+            {
+                "doc_id": doc_id,
+                **fields,
+                "score": score,
+                "bm25_rank": bm25_rank,
+                "semantic_rank": semantic_rank,
+            }
+        )
+    return results
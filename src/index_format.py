@@ -0,0 +1,167 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from src.bm25 import BM25Index, gather_ranges
+from src.docstore import DocStore, map_bytes, write_docstore, write_strings
+
+# Bump whenever the set of files or their meaning changes
+FORMAT_VERSION = 2
+
+# Flat arrays of a BM25Index, each stored as <name>.npy
+ARRAY_FILES = [
+    "offsets",
+    "postings",
+    "tfs",
+    "impacts",
+    "idf",
+    "max_impacts",
+    "block_offsets",
+    "block_max",
+    "doc_ids",
+    "doc_lens",
+]
+
+
+class Vocabulary:
+    """
+    Read-only term -> term id mapping over a sorted, memory-mapped term list.
+    Term ids are ranks in UTF-8 byte order; lookups are a binary search.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def term(self, term_id):
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.data[start:end].decode("utf-8")
+
+    def get(self, term, default=None):
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = self.data[self.offsets[mid] : self.offsets[mid + 1]]
+            if probe < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.data[self.offsets[lo] : self.offsets[lo + 1]] == key:
+            return lo
+        return default
+
+    def __getitem__(self, term):
+        term_id = self.get(term)
+        if term_id is None:
+            raise KeyError(term)
+        return term_id
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __iter__(self):
+        return (self.term(i) for i in range(len(self)))
+
+
+def write_index(directory, bm25, docs):
+    """
+    Write `bm25` and the matching (doc_id, title, body, site, date) records,
+    in doc_ids order, as flat files.
+    The vocabulary is re-numbered into sorted order on the way out.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True)
+
+    arrays = {name: np.asarray(getattr(bm25, name)) for name in ARRAY_FILES}
+    if isinstance(bm25.vocab, Vocabulary):
+        terms = list(bm25.vocab)
+    else:
+        terms = sorted(bm25.vocab)
+        perm = np.array([bm25.vocab[t] for t in terms], dtype=np.int64)
+        if not np.array_equal(perm, np.arange(len(perm))):
+            _permute_terms(arrays, perm)
+
+    write_strings(directory / "vocab.bin", directory / "vocab_offsets.npy", terms)
+    for name, array in arrays.items():
+        np.save(directory / f"{name}.npy", array)
+
+    write_docstore(directory, docs)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "num_docs": len(arrays["doc_ids"]),
+        "num_terms": len(terms),
+        "num_postings": len(arrays["postings"]),
+        "k1": bm25.k1,
+        "b": bm25.b,
+        "epsilon": bm25.epsilon,
+    }
+    (directory / "manifest.json").write_text(json.dumps(manifest, indent=2))
+
+
+def _permute_terms(arrays, perm):
+    """Reorder every per-term array so that new term id i is old term id perm[i]"""
+    offsets = arrays["offsets"]
+    dfs = np.diff(offsets)[perm]
+    positions = gather_ranges(np.arange(offsets[-1]), offsets[perm], offsets[perm + 1])
+    for name in ("postings", "tfs", "impacts"):
+        arrays[name] = arrays[name][positions]
+    arrays["offsets"] = np.concatenate([[0], np.cumsum(dfs)]).astype(np.int64)
+
+    block_offsets = arrays["block_offsets"]
+    num_blocks = np.diff(block_offsets)[perm]
+    blocks = gather_ranges(
+        np.arange(block_offsets[-1]), block_offsets[perm], block_offsets[perm + 1]
+    )
+    arrays["block_max"] = arrays["block_max"][blocks]
+    arrays["block_offsets"] = np.concatenate([[0], np.cumsum(num_blocks)]).astype(
+        np.int64
+    )
+
+    arrays["idf"] = arrays["idf"][perm]
+    arrays["max_impacts"] = arrays["max_impacts"][perm]
+
+
+def open_index(directory):
+    """
+    Memory-map an index written by `write_index`.
+    Returns (bm25, docs); nothing is deserialized up front.
+    """
+    directory = Path(directory)
+    manifest = json.loads((directory / "manifest.json").read_text())
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(
+            f"Index at {directory} has format version {manifest.get('format_version')}, "
+            f"expected {FORMAT_VERSION}; rebuild it with build_indices()"
+        )
+
+    arrays = {
+        name: np.load(directory / f"{name}.npy", mmap_mode="r") for name in ARRAY_FILES
+    }
+    vocab = Vocabulary(
+        map_bytes(directory / "vocab.bin"),
+        np.load(directory / "vocab_offsets.npy", mmap_mode="r"),
+    )
+    bm25 = BM25Index(
+        vocab,
+        arrays["offsets"],
+        arrays["postings"],
+        arrays["tfs"],
+        arrays["impacts"],
+        arrays["doc_ids"],
+        arrays["doc_lens"],
+        arrays["idf"],
+        manifest["k1"],
+        manifest["b"],
+        manifest["epsilon"],
+        max_impacts=arrays["max_impacts"],
+        block_offsets=arrays["block_offsets"],
+        block_max=arrays["block_max"],
+    )
+    docs = DocStore.open(directory, arrays["doc_ids"])
+    return bm25, docs
@@ -1,69 +1,461 @@
+import os
 import pickle
-import re
-from collections import defaultdict
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
-from rank_bm25 import BM25Okapi
+import numpy as np
 
-from src.data_loader import get_docs
+from src.analysis import analyzer
+from src.bm25 import BM25Index, build_partial, merge_partials
+from src.data_loader import (
+    append_articles,
+    delete_articles,
+    get_doc_ids,
+    iter_corpus,
+    iter_docs,
+    load_and_clean,
+)
+from src.segments import (
+    load_deletes,
+    merge_segments,
+    open_commit,
+    read_commit,
+    remove_unreferenced,
+    write_commit,
+    write_deletes,
+    write_segment,
+)
 
 INDICES_DIR = Path("indices")
 INDICES_DIR.mkdir(exist_ok=True)
 
+# Holds the name of the active commit file under INDICES_DIR; the commit lists
+# the live segments, and its name is the index version
+CURRENT_PATH = INDICES_DIR / "CURRENT"
 
-def tokenize(text):
-    """Simple tokenizer"""
-    return re.findall(r"[a-zA-Z0-9]+", text.lower())
+# Commits kept on disk (the active one plus the previous ones), together with
+# the segments they reference
+KEEP_VERSIONS = 2
 
+# Merge the ingested segments into one once there are this many
+MERGE_FACTOR = 8
 
-def build_indices():
-    """Build and persist inverted index + BM25"""
-    print("Fetching docs from DB...")
-    docs = get_docs()  # (doc_id, title, body, site, date)
+# Serializes commits (ingest, delete, merge, rebuild) within the process
+_commit_lock = threading.Lock()
+_merge_lock = threading.Lock()
 
-    print(f"Building indices for {len(docs)} docs...")
+IndexSnapshot = namedtuple("IndexSnapshot", ["bm25", "docs", "version"])
 
-    # Map doc_id to doc content
-    doc_map = {doc[0]: doc for doc in docs}  # doc_id -> full record
 
-    # Inverted index: word -> set of doc_ids
-    inverted_index = defaultdict(set)
-    documents_text = []  # For BM25
+# Documents per build shard; several shards per worker keeps cores busy
+# while the slowest shard finishes
+SHARD_DOCS = 20000
 
-    for doc_id, title, body, site, date in docs:
-        text = f"{title} {body}"
-        documents_text.append(text)
 
-        words = tokenize(text)
-        for word in set(words):
-            inverted_index[word].add(doc_id)
+def _index_range(first_doc, doc_id_range):
+    """Worker: tokenize one doc_id range once and build its partial postings"""
+    vocab = {}
+    doc_ids, term_vectors = [], []
+    for batch in iter_corpus(("doc_id", "title", "body"), doc_id_range=doc_id_range):
+        doc_ids.extend(batch.column("doc_id").to_pylist())
+        term_vectors.extend(
+            analyzer.term_vector(f"{title} {body}", vocab)
+            for title, body in zip(
+                batch.column("title").to_pylist(), batch.column("body").to_pylist()
+            )
+        )
+    return build_partial(term_vectors, vocab, doc_ids, first_doc)
 
-    # Build BM25
-    tokenized_docs = [tokenize(text) for text in documents_text]
-    bm25 = BM25Okapi(tokenized_docs)
 
-    # Persist
-    with open(INDICES_DIR / "inverted_index.pkl", "wb") as f:
-        pickle.dump(dict(inverted_index), f)
+def build_bm25(doc_ids, workers):
+    """
+    BM25 index over the (sorted) `doc_ids`: contiguous doc_id ranges are
+    tokenized by worker processes into partial postings, which are merged.
+    """
+    num_shards = max(1, -(-len(doc_ids) // SHARD_DOCS))
+    shard_size = -(-len(doc_ids) // num_shards) if doc_ids else 0
+    shards = [
+        (start, (doc_ids[start], doc_ids[min(start + shard_size, len(doc_ids)) - 1]))
+        for start in range(0, len(doc_ids), max(shard_size, 1))
+    ]
 
-    with open(INDICES_DIR / "bm25.pkl", "wb") as f:
-        pickle.dump(bm25, f)
+    start_time = time.time()
+    partials = {}
+    indexed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_index_range, *shard): shard[0] for shard in shards}
+        for future in as_completed(futures):
+            partial = future.result()
+            partials[futures[future]] = partial
+            indexed += len(partial.doc_ids)
+            elapsed = time.time() - start_time
+            print(
+                f"  shard {len(partials)}/{len(shards)} done: "
+                f"{indexed}/{len(doc_ids)} docs, {indexed / max(elapsed, 1e-9):.0f} docs/s"
+            )
 
-    with open(INDICES_DIR / "doc_map.pkl", "wb") as f:
-        pickle.dump(doc_map, f)
+    print("Merging shards...")
+    return merge_partials([partials[start] for start in sorted(partials)])
 
-    print(f"✓ Indices saved. Vocab size: {len(inverted_index)}")
 
+def build_indices(workers=None):
+    """
+    Build and persist BM25 postings + document store as a new index version.
 
-def load_indices():
-    """Load persisted indices"""
-    with open(INDICES_DIR / "inverted_index.pkl", "rb") as f:
-        inverted_index = pickle.load(f)
+    The corpus is split into doc_id ranges that worker processes tokenize (once
+    per document) into partial postings; the partials are then merged.
+    """
+    workers = workers or os.cpu_count() or 1
+    doc_ids = get_doc_ids()
+    print(f"Building indices for {len(doc_ids)} docs with {workers} workers...")
 
-    with open(INDICES_DIR / "bm25.pkl", "rb") as f:
-        bm25 = pickle.load(f)
+    start_time = time.time()
+    bm25 = build_bm25(doc_ids, workers)
+
+    with _commit_lock:
+        previous = index_version()
+        # Only the indexed range, in case articles were ingested meanwhile
+        doc_id_range = (doc_ids[0], doc_ids[-1]) if doc_ids else None
+        version = publish_index(bm25, iter_docs(doc_id_range))
+        if previous is not None:
+            _carry_segment_embeddings(previous, bm25.doc_ids)
+
+    print(
+        f"✓ Indices saved as {version} in {time.time() - start_time:.1f}s. "
+        f"Vocab size: {len(bm25.vocab)}"
+    )
+
+    registry.reload_in_background()
+
+
+def publish_index(bm25, docs):
+    """
+    Write `bm25` and its documents as a single base segment and commit it,
+    replacing every existing segment.
+    Files are written under a temp name and renamed into place before CURRENT
+    switches to the new commit, so readers never open a partial index.
+    """
+    spec = write_segment(INDICES_DIR, bm25, docs, base=True)
+    version = write_commit(INDICES_DIR, [spec])
+    remove_unreferenced(INDICES_DIR, KEEP_VERSIONS)
+    return version
+
+
+def _carry_segment_embeddings(previous, doc_ids):
+    """After a full rebuild, keep the embeddings of documents ingested since"""
+    from src.semantic.encoder import rebase_embeddings
+
+    segments, _ = open_commit(INDICES_DIR, previous)
+    extra = [(ids, np.load(path)) for ids, path in segments.segment_embeddings()]
+    rebase_embeddings(np.asarray(doc_ids), extra)
+
+
+def index_version():
+    """Version of the index currently on disk (None if never built)"""
+    try:
+        return CURRENT_PATH.read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
+def index_exists():
+    return index_version() is not None
+
+
+def load_indices(version=None):
+    """
+    Memory-map the segments of a persisted index version (the current one by
+    default). Returns (SegmentedIndex, SegmentedDocs).
+    """
+    version = version or index_version()
+    if version is None:
+        raise FileNotFoundError(f"No index in {INDICES_DIR}; run build_indices()")
+    return open_commit(INDICES_DIR, version)
+
+
+def ingest_articles(articles, embed=True):
+    """
+    Add new (title, body, site, date) articles without a rebuild: they are
+    stored in clean_news and indexed as one new small segment (postings, doc
+    store and, if `embed`, embeddings). Returns the new doc_ids.
+    """
+    start_time = time.time()
+    records = append_articles(articles)
+    if not records:
+        return []
+
+    vocab = {}
+    term_vectors = [
+        analyzer.term_vector(f"{title} {body}", vocab)
+        for _, title, body, _, _ in records
+    ]
+    doc_ids = [record[0] for record in records]
+    bm25 = BM25Index.build(term_vectors, doc_ids, vocab)
+
+    embeddings = None
+    if embed:
+        from src.semantic.encoder import encode_texts
+
+        embeddings = encode_texts(f"{title} {body}" for _, title, body, _, _ in records)
+
+    spec = write_segment(INDICES_DIR, bm25, records, embeddings=embeddings)
+    with _commit_lock:
+        specs = read_commit(INDICES_DIR, index_version())
+        write_commit(INDICES_DIR, specs + [spec])
+        remove_unreferenced(INDICES_DIR, KEEP_VERSIONS)
+
+    print(
+        f"✓ Ingested {len(records)} articles as {spec['name']} "
+        f"in {time.time() - start_time:.1f}s"
+    )
+    registry.reload_in_background()
+    maybe_merge_in_background()
+    if embeddings is not None:
+        from src.semantic.knn_graph import update_knn_graph_in_background
+
+        update_knn_graph_in_background(doc_ids, embeddings)
+    return doc_ids
+
+
+def delete_documents(doc_ids):
+    """
+    Delete documents: each affected segment gets a new tombstone bitmap in a
+    new commit, and the rows are removed from clean_news.
+    Returns how many indexed documents were deleted.
+    """
+    doc_ids = np.unique(np.asarray(list(doc_ids), dtype=np.int64))
+    deleted_count = 0
+    with _commit_lock:
+        segments, _ = load_indices()
+        specs = []
+        for segment in segments.segments:
+            seg_doc_ids = np.asarray(segment.bm25.doc_ids)
+            hits = np.isin(seg_doc_ids, doc_ids)
+            if segment.deleted is not None:
+                hits &= ~segment.deleted
+            if hits.any():
+                deleted = hits if segment.deleted is None else segment.deleted | hits
+                segment.deletes = write_deletes(segment.path, deleted)
+                deleted_count += int(hits.sum())
+            specs.append(segment.spec())
+        if deleted_count:
+            write_commit(INDICES_DIR, specs)
+            remove_unreferenced(INDICES_DIR, KEEP_VERSIONS)
+
+    delete_articles(doc_ids.tolist())
+    if deleted_count:
+        print(f"✓ Deleted {deleted_count} documents")
+        registry.reload_in_background()
+    return deleted_count
+
+
+def merge_segments_now(min_segments=MERGE_FACTOR):
+    """
+    Merge policy: once there are `min_segments` or more ingested segments,
+    rewrite the `min_segments` smallest as one segment without their deleted
+    documents.
+    The base segment is left alone; a full rebuild replaces it.
+    Returns the merged segment's name, or None if nothing was merged.
+    """
+    with _commit_lock:
+        segments, _ = load_indices()
+    # Merging the smallest segments first keeps big segments from being
+    # rewritten on every merge (sizes grow roughly by MERGE_FACTOR per tier)
+    small = sorted(
+        (s for s in segments.segments if not s.base), key=lambda s: s.num_live_docs
+    )[:min_segments]
+    if len(small) < max(min_segments, 2):
+        return None
+
+    start_time = time.time()
+    bm25, records, embeddings = merge_segments(small)
+    spec = write_segment(INDICES_DIR, bm25, records, embeddings=embeddings)
+
+    merged = {s.name: s for s in small}
+    with _commit_lock:
+        specs = read_commit(INDICES_DIR, index_version())
+        if not merged.keys() <= {old["name"] for old in specs}:
+            # A rebuild replaced the segments meanwhile; the merged copy is
+            # unreferenced and removed by the next cleanup
+            return None
+
+        # Documents deleted while the merge ran are deleted again in the result
+        late_deletes = []
+        for old in specs:
+            segment = merged.get(old["name"])
+            if segment is not None and old["deletes"] != segment.deletes:
+                deleted = load_deletes(segment.path / old["deletes"], segment.num_docs)
+                late_deletes.append(np.asarray(segment.bm25.doc_ids)[deleted])
+        if late_deletes:
+            deleted = np.isin(np.asarray(bm25.doc_ids), np.concatenate(late_deletes))
+            spec["deletes"] = write_deletes(INDICES_DIR / spec["name"], deleted)
+
+        kept = [old for old in specs if old["name"] not in merged]
+        write_commit(INDICES_DIR, kept + [spec])
+        remove_unreferenced(INDICES_DIR, KEEP_VERSIONS)
 
+    print(
+        f"✓ Merged {len(small)} segments into {spec['name']} "
+        f"in {time.time() - start_time:.1f}s"
+    )
+    registry.reload_in_background()
+    return spec["name"]
+
+
+def maybe_merge_in_background():
+    """Run the merge policy in a thread (one merge at a time)"""
+    if not _merge_lock.acquire(blocking=False):
+        return
+
+    def _run():
+        try:
+            merge_segments_now()
+        except Exception as e:
+            print(f"Segment merge failed: {e}")
+        finally:
+            _merge_lock.release()
+
+    threading.Thread(target=_run, name="segment-merge", daemon=True).start()
+
+
+def ensure_indices():
+    """Convert or build the indices if there are none on disk"""
+    if not index_exists() and legacy_pickles_exist():
+        print("Converting pickled indices...")
+        convert_pickles()
+    elif not index_exists():
+        print("Building indices for first time...")
+        load_and_clean(limit=10000)
+        build_indices()
+    else:
+        print("Indices found, loading...")
+
+
+def legacy_pickles_exist():
+    return (INDICES_DIR / "bm25.pkl").exists() and (
+        INDICES_DIR / "doc_map.pkl"
+    ).exists()
+
+
+def convert_pickles():
+    """One-shot conversion of the old bm25.pkl / doc_map.pkl into the flat format"""
     with open(INDICES_DIR / "doc_map.pkl", "rb") as f:
         doc_map = pickle.load(f)
 
-    return inverted_index, bm25, doc_map
+    with open(INDICES_DIR / "bm25.pkl", "rb") as f:
+        bm25 = pickle.load(f)
+
+    if not isinstance(bm25, BM25Index):
+        # Indices written before the native engine hold a rank_bm25.BM25Okapi
+        bm25 = BM25Index.from_okapi(bm25, list(doc_map))
+
+    docs = [doc_map[doc_id] for doc_id in bm25.doc_ids.tolist()]
+    with _commit_lock:
+        version = publish_index(bm25, docs)
+    print(f"✓ Converted pickled indices to {version}")
+    registry.reload_in_background()
+    return version
+
+
+class IndexRegistry:
+    """
+    Process-wide holder of the loaded indices.
+
+    Readers call `get()` and keep the returned snapshot for the whole request.
+    Reloads build a complete new snapshot first and then replace the reference
+    in a single assignment, so a query never sees a half-loaded index.
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._reloading = False
+        self._reload_pending = False
+        self._watcher = None
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._load_snapshot()
+                snapshot = self._snapshot
+        return snapshot
+
+    def load(self):
+        """Load indices from disk and swap them in (blocking)"""
+        snapshot = self._load_snapshot()
+        with self._lock:
+            self._snapshot = snapshot
+        print(f"✓ Index registry loaded version {snapshot.version}")
+        return snapshot
+
+    def reload_in_background(self):
+        """
+        Load the on-disk indices in a thread; current readers keep the old
+        snapshot. A request made while a reload runs queues one more reload,
+        so a commit landing mid-load is picked up as soon as it finishes.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                # Nothing loaded yet: the next get() will load the fresh files
+                return
+            if self._reloading:
+                self._reload_pending = True
+                return
+            self._reloading = True
+
+        def _run():
+            while True:
+                try:
+                    self.load()
+                except Exception as e:
+                    print(f"Index reload failed, keeping current version: {e}")
+                finally:
+                    with self._lock:
+                        again = self._reload_pending
+                        self._reload_pending = False
+                        self._reloading = again
+                if not again:
+                    return
+
+        threading.Thread(target=_run, name="index-reload", daemon=True).start()
+
+    def watch(self, interval=5.0):
+        """Poll the version file and hot-swap when another process rebuilds"""
+        if self._watcher is not None:
+            return
+
+        def _run():
+            while True:
+                time.sleep(interval)
+                snapshot = self._snapshot
+                if snapshot is not None and index_version() != snapshot.version:
+                    self.reload_in_background()
+
+        self._watcher = threading.Thread(target=_run, name="index-watch", daemon=True)
+        self._watcher.start()
+
+    @property
+    def version(self):
+        snapshot = self._snapshot
+        return snapshot.version if snapshot is not None else None
+
+    def _load_snapshot(self):
+        version = index_version()
+        bm25, docs = load_indices(version)
+        return IndexSnapshot(bm25, docs, version)
+
+
+registry = IndexRegistry()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["convert"]:
+        convert_pickles()
+    else:
+        build_indices()
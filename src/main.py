@@ -1,24 +1,33 @@
 import os
-from typing import Dict, List
+from typing import Dict, List, Literal, Optional
 
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from src.data_loader import load_and_clean
-from src.evaluation import evaluate_system
-from src.indexer import build_indices, load_indices
+from src.evaluation_engine import evaluate_systems
+from src.execution import lanes
+from src.hybrid import RRF_K, SEMANTIC_WEIGHT, hybrid_search
+from src.indexer import ensure_indices, registry
 from src.models import SearchResponse, SearchResult
 from src.rag.rag_pipeline import RAGPipeline
-from src.search import search_bm25
-from src.semantic.semantic_search import semantic_search
+from src.result_cache import decode_cursor, encode_cursor, result_cache
+from src.search import search_bm25_batch, search_bm25_page
+from src.semantic.query_encoder import query_encoder
+from src.semantic.semantic_search import semantic_search_batch, semantic_search_page
 from src.semantic.similarity import similar_articles
 from src.semantic.timeline import build_story_timeline
 from src.seo import analyze_seo
+from src.serve import process_memory
+from src.sharding import SHARD_MAX_DEPTH, ShardCoordinator
 
 app = FastAPI(title="News Search Engine")
 rag = RAGPipeline()
 
+# Sharded mode: SHARDS=url,url,... (shard servers started with
+# `python -m src.sharding start`) makes /search and /semantic_search fan out
+coordinator = ShardCoordinator.from_env()
+
 # Set up CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -33,41 +42,217 @@ app.add_middleware(
 @app.on_event("startup")
 async def startup():
     """Load/build indices on startup"""
-    if not os.path.exists("indices/bm25.pkl"):
-        print("Building indices for first time...")
-        load_and_clean(limit=10000)
-        build_indices()
+    if coordinator is not None:
+        # The shards hold the corpus: nothing is built or mapped here. Routes
+        # that are not sharded load the local index on first use (the
+        # watcher only reloads an index that was loaded).
+        print(f"✓ Coordinating {len(coordinator.urls)} shards")
     else:
-        print("Indices found, loading...")
+        ensure_indices()
+        registry.load()
+    registry.watch()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for lane in lanes.values():
+        lane.shutdown()
+    if coordinator is not None:
+        await coordinator.close()
+
+
+def _cursor_offset(cursor):
+    try:
+        return decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _document(doc_id, fields):
+    """Fields of a document in the current index, or None"""
+    return registry.get().docs.get(doc_id, fields)
+
+
+def _shard_depth(offset, top_k):
+    """
+    Results to ask every shard for to serve a page: offset + top_k, capped at
+    what a shard returns (SHARD_MAX_DEPTH). Pages past that are a 400.
+    """
+    if offset >= SHARD_MAX_DEPTH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Sharded search pages through at most {SHARD_MAX_DEPTH} results",
+        )
+    return min(offset + top_k, SHARD_MAX_DEPTH)
+
 
+def _shard_page(merged, offset, depth):
+    """A page of results merged from shards asked for `depth` each"""
+    more = len(merged) == depth < SHARD_MAX_DEPTH
+    return merged[offset:], (depth if more else None)
 
+
+# cursor: next_cursor of the previous page; pages of a recent query come from
+# the result cache instead of being scored again
 @app.get("/search", response_model=SearchResponse)
 async def search(
     q: str = Query(..., min_length=1, max_length=200),
     top_k: int = Query(10, ge=1, le=100),
+    exhaustive: bool = False,
+    cursor: Optional[str] = None,
 ):
     """Search articles by keyword"""
-    results = search_bm25(q, top_k=top_k)
+    offset = _cursor_offset(cursor)
+    failed = []
+    if coordinator is not None:
+        depth = _shard_depth(offset, top_k)
+        merged, failed = await coordinator.search(q, depth, exhaustive)
+        results, next_offset = _shard_page(merged, offset, depth)
+    else:
+        results, next_offset = await lanes["search"].run(
+            search_bm25_page, q, top_k=top_k, exhaustive=exhaustive, offset=offset
+        )
     return SearchResponse(
         query=q,
         total_results=len(results),
         results=[SearchResult(**r) for r in results],
+        next_cursor=encode_cursor(next_offset),
+        partial=bool(failed),
+        failed_shards=failed,
     )
 
 
+class SearchBatchRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=10000)
+    top_k: int = Field(10, ge=1, le=100)
+
+
+@app.post("/search/batch")
+async def search_batch_route(req: SearchBatchRequest):
+    """Keyword search for many queries, scored together (query-log replays)"""
+    results = await lanes["batch"].run(search_bm25_batch, req.queries, req.top_k)
+    return {
+        "results": [{"query": q, "results": r} for q, r in zip(req.queries, results)]
+    }
+
+
+# nprobe: ANN lists probed per query (higher = better recall, slower);
+# exact: skip the ANN index and score every document
+# Lane calls run concurrently, so concurrent queries can share an encoder batch
 @app.get("/semantic_search")
-async def semantic_route(q: str, top_k: int = 10):
-    return {"query": q, "results": semantic_search(q, top_k)}
+async def semantic_route(
+    q: str,
+    top_k: int = 10,
+    nprobe: Optional[int] = Query(None, ge=1),
+    exact: bool = False,
+    cursor: Optional[str] = None,
+):
+    offset = _cursor_offset(cursor)
+    if coordinator is not None:
+        # Encoded once here; every shard scores the same vector
+        depth = _shard_depth(offset, top_k)
+        vector = await lanes["semantic"].run(query_encoder.encode, q)
+        merged, failed = await coordinator.semantic_search(
+            vector, depth, nprobe=nprobe, exact=exact
+        )
+        results, next_offset = _shard_page(merged, offset, depth)
+        return {
+            "query": q,
+            "results": results,
+            "next_cursor": encode_cursor(next_offset),
+            "partial": bool(failed),
+            "failed_shards": failed,
+        }
+    results, next_offset = await lanes["semantic"].run(
+        semantic_search_page, q, top_k, nprobe=nprobe, exact=exact, offset=offset
+    )
+    return {"query": q, "results": results, "next_cursor": encode_cursor(next_offset)}
+
+
+class SemanticBatchRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=256)
+    top_k: int = Field(10, ge=1, le=100)
+    nprobe: Optional[int] = Field(None, ge=1)
+    exact: bool = False
+
+
+@app.post("/semantic_search/batch")
+async def semantic_batch_route(req: SemanticBatchRequest):
+    """Semantic search for many queries, encoded and scored as one batch"""
+    results = await lanes["semantic"].run(
+        semantic_search_batch,
+        req.queries,
+        req.top_k,
+        nprobe=req.nprobe,
+        exact=req.exact,
+    )
+    return {
+        "results": [{"query": q, "results": r} for q, r in zip(req.queries, results)]
+    }
+
+
+@app.get("/semantic_search/stats")
+async def semantic_stats_route():
+    """Query encoder batching and cache statistics"""
+    return query_encoder.stats()
+
+
+@app.get("/cache/stats")
+async def result_cache_stats_route():
+    """Result cache size, hits, misses and evictions"""
+    return result_cache.stats()
+
+
+# fusion: "rrf" (reciprocal-rank fusion, tuned by rrf_k) or "weighted"
+# (min-max normalized scores, semantic_weight for the semantic side)
+@app.get("/hybrid_search")
+async def hybrid_route(
+    q: str = Query(..., min_length=1, max_length=200),
+    top_k: int = Query(10, ge=1, le=100),
+    fusion: Literal["rrf", "weighted"] = "rrf",
+    semantic_weight: float = Query(SEMANTIC_WEIGHT, ge=0.0, le=1.0),
+    rrf_k: int = Query(RRF_K, ge=1),
+    nprobe: Optional[int] = Query(None, ge=1),
+    exact: bool = False,
+):
+    """Keyword and semantic search run concurrently and fused into one list"""
+    results = await hybrid_search(
+        q,
+        top_k,
+        fusion=fusion,
+        semantic_weight=semantic_weight,
+        rrf_k=rrf_k,
+        nprobe=nprobe,
+        exact=exact,
+    )
+    return {"query": q, "fusion": fusion, "results": results}
 
 
 @app.get("/similar")
-async def similar_route(doc_id: int, top_k: int = 5):
-    return {"doc_id": doc_id, "results": similar_articles(doc_id, top_k)}
+async def similar_route(
+    doc_id: int,
+    top_k: int = 5,
+    nprobe: Optional[int] = Query(None, ge=1),
+    exact: bool = False,
+):
+    return {
+        "doc_id": doc_id,
+        "results": await lanes["semantic"].run(
+            similar_articles, doc_id, top_k, nprobe=nprobe, exact=exact
+        ),
+    }
 
 
 @app.get("/timeline")
-async def timeline_route(doc_id: int, top_k: int = 8):
-    return build_story_timeline(doc_id, top_k)
+async def timeline_route(
+    doc_id: int,
+    top_k: int = 8,
+    nprobe: Optional[int] = Query(None, ge=1),
+    exact: bool = False,
+):
+    return await lanes["semantic"].run(
+        build_story_timeline, doc_id, top_k, nprobe=nprobe, exact=exact
+    )
 
 
 @app.get("/health")
@@ -75,18 +260,42 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/shards")
+async def shards_route():
+    """Status of every shard in sharded mode"""
+    if coordinator is None:
+        return {"sharded": False, "shards": []}
+    return {"sharded": True, "shards": await coordinator.health()}
+
+
+@app.get("/memory")
+async def memory_route():
+    """Memory of the worker that answers (rss / pss / shared / private MB)"""
+    return {"pid": os.getpid(), **process_memory()}
+
+
+@app.get("/executor/stats")
+async def executor_stats_route():
+    """Per-lane concurrency, queue depth and shed / timed-out request counts"""
+    return {name: lane.stats() for name, lane in lanes.items()}
+
+
 @app.get("/rag/search")
-def rag_search(query: str, top_k: int = 5):
+async def rag_search(query: str, top_k: int = 5):
     """
     RAG-powered search:
     Semantic retrieval + Gemini summarization
     """
-    return rag.run(query, top_k)
+    return await lanes["rag"].run(rag.run, query, top_k)
 
 
 class EvaluationRequest(BaseModel):
     ground_truth: Dict[str, List[int]]
-    top_k: int = 10
+    top_k: int = Field(10, ge=1, le=1000)
+    # Retrieval system to score; hybrid uses RRF fusion
+    system: Literal["bm25", "semantic", "hybrid"] = "bm25"
+    # Several registered systems to compare side by side (overrides `system`)
+    systems: Optional[List[str]] = Field(None, min_length=1)
 
 
 @app.post("/evaluate")
@@ -94,23 +303,18 @@ async def evaluate_route(req: EvaluationRequest):
     """
     Run evaluation metrics on the provided ground truth.
     """
-    results = {}
-    # Convert list to set for ground truth
-    # print(req.ground_truth)
-    gt_sets = {k: set(v) for k, v in req.ground_truth.items()}
-
-    # print(gt_sets)
-    for query in req.ground_truth.keys():
-        # print(query)
-        # print(gt_sets[query])
-        # Run search for each query
-        # We use BM25 for now as the baseline
-        search_res = search_bm25(query, top_k=req.top_k)
-        # print(search_res)
-        results[query] = [r["doc_id"] for r in search_res]
-        print(results)
-    metrics = evaluate_system(results, gt_sets, k=req.top_k)
-    return metrics
+    try:
+        report = await lanes["evaluate"].run(
+            evaluate_systems,
+            req.ground_truth,
+            req.systems or [req.system],
+            top_k=req.top_k,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if req.systems is None:
+        return report[req.system]
+    return {"queries": len(req.ground_truth), "top_k": req.top_k, "systems": report}
 
 
 @app.get("/seo/analyze")
@@ -118,14 +322,9 @@ async def seo_route(doc_id: int):
     """
     Analyze SEO factors for a specific document.
     """
-    _, _, doc_map = load_indices()
-    if doc_id not in doc_map:
+    # The lookup reads the body from disk (and may load the index): search lane
+    doc = await lanes["search"].run(_document, doc_id, ("title", "body"))
+    if doc is None:
         return {"error": "Document not found"}
 
-    doc = doc_map[doc_id]
-    # doc structure: (doc_id, title, body, site, date)
-
-    title = doc[1]
-    body = doc[2]
-
-    return analyze_seo(title, body)
+    return await lanes["seo"].run(analyze_seo, doc["title"], doc["body"])
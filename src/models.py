@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -22,3 +22,8 @@ class SearchResponse(BaseModel):
     query: str
     total_results: int
     results: List[SearchResult]
+    # Pass as `cursor` to get the next page; None after the last page
+    next_cursor: Optional[str] = None
+    # Sharded mode: set when some shards did not answer in time
+    partial: bool = False
+    failed_shards: List[int] = []
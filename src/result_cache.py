@@ -0,0 +1,128 @@
+import base64
+import binascii
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+# Ranked results computed per cache miss; later pages up to this depth are
+# served from the entry (deeper pages rescore to the depth they need)
+CACHE_DEPTH = 100
+
+# Bound on the cache, in (doc_id, score) pairs over all entries; least
+# recently used entries are evicted first
+CACHE_MAX_RESULTS = 500_000
+
+# doc_ids (int64) and scores (float64) of one ranking, best first; complete
+# when the retriever had no more results than these
+RankedResults = namedtuple("RankedResults", ["doc_ids", "scores", "complete"])
+
+
+class ResultCache:
+    """
+    Ranked result lists of recent queries.
+
+    Keys hold the retriever, the normalized query, the retrieval parameters
+    and the version of the data searched, so a new index or embedding store
+    version simply stops matching the entries computed before it; those age
+    out like any unused entry.
+    """
+
+    def __init__(self, max_results=CACHE_MAX_RESULTS, depth=CACHE_DEPTH):
+        self.max_results = max_results
+        self.depth = depth
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.counts = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def ranked(self, key, depth, compute):
+        """
+        RankedResults for `key`, at least `depth` deep unless the ranking is
+        shorter. On a miss `compute(n)` must return the top-n [(doc_id,
+        score)]; n is at least CACHE_DEPTH so that later pages hit.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry.complete or len(entry.doc_ids) >= depth):
+                self._entries.move_to_end(key)
+                self.counts["hits"] += 1
+                return entry
+            self.counts["misses"] += 1
+
+        fetch = max(depth, self.depth)
+        if entry is not None:
+            # Paging past a cached ranking: deepen it geometrically
+            fetch = max(fetch, 2 * len(entry.doc_ids))
+        results = compute(fetch)
+        entry = RankedResults(
+            np.fromiter((doc_id for doc_id, _ in results), np.int64, len(results)),
+            np.fromiter((score for _, score in results), np.float64, len(results)),
+            len(results) < fetch,
+        )
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old.doc_ids)
+            self._entries[key] = entry
+            self._size += len(entry.doc_ids)
+            while self._size > self.max_results and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.doc_ids)
+                self.counts["evictions"] += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counts["hits"] + self.counts["misses"]
+            return {
+                "entries": len(self._entries),
+                "cached_results": self._size,
+                "max_results": self.max_results,
+                "depth": self.depth,
+                **self.counts,
+                "hit_rate": round(self.counts["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+def page(ranked, offset, top_k):
+    """
+    One page of a ranking: ([(doc_id, score)], offset of the next page or
+    None when this is the last one).
+    """
+    end = offset + top_k
+    results = list(
+        zip(ranked.doc_ids[offset:end].tolist(), ranked.scores[offset:end].tolist())
+    )
+    more = end < len(ranked.doc_ids) or not ranked.complete
+    return results, (end if more and results else None)
+
+
+def encode_cursor(offset):
+    """Opaque pagination cursor for the page starting at `offset`"""
+    if offset is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Offset of a cursor from `encode_cursor` (0 for none); ValueError if invalid"""
+    if not cursor:
+        return 0
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))["offset"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    return offset
+
+
+result_cache = ResultCache()
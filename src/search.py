@@ -1,28 +1,112 @@
-from src.indexer import load_indices
+from src.analysis import analyzer
+from src.indexer import registry
+from src.result_cache import page, result_cache
 
 
-def search_bm25(query: str, top_k: int = 10):
-    """BM25 search"""
-    inverted_index, bm25, doc_map = load_indices()
+def bm25_ranked(query: str, depth: int, exhaustive: bool = False, indices=None):
+    """
+    The BM25 ranking of a query, at least `depth` deep, from the result
+    cache. Entries are keyed on the analyzed term sequence (the analyzer's
+    lowercased tokens, in query order), so queries differing only in case or
+    punctuation share one.
+    """
+    indices = indices or registry.get()
+    terms = analyzer.tokenize(query)
+    return result_cache.ranked(
+        ("bm25", tuple(terms), exhaustive, indices.version),
+        depth,
+        lambda n: indices.bm25.top_k(terms, k=n, exhaustive=exhaustive),
+    )
 
-    query_tokens = query.lower().split()
-    scored_docs = bm25.get_top_n(query_tokens, list(range(len(doc_map))), n=top_k)
+
+def bm25_top_k(query: str, top_k: int = 10, exhaustive: bool = False, indices=None):
+    """
+    [(doc_id, score)] of the BM25 top-k, without document fields.
+    `indices` is the registry snapshot to search (the current one by default).
+    """
+    return page(bm25_ranked(query, top_k, exhaustive, indices), 0, top_k)[0]
+
+
+def search_bm25(query: str, top_k: int = 10, exhaustive: bool = False):
+    """BM25 search (block-max pruned unless `exhaustive` is set)"""
+    return search_bm25_page(query, top_k, exhaustive)[0]
+
+
+def search_bm25_page(
+    query: str, top_k: int = 10, exhaustive: bool = False, offset: int = 0
+):
+    """
+    Results `offset` to `offset + top_k` of a BM25 search, and the offset of
+    the next page (None after the last). Later pages of a cached query are
+    served without scoring again.
+    """
+    indices = registry.get()
+    docs = indices.docs
+    ranked = bm25_ranked(query, offset + top_k, exhaustive, indices=indices)
+    scored_docs, next_offset = page(ranked, offset, top_k)
 
     results = []
-    for doc_id in scored_docs:
-        full_doc = doc_map[doc_id + 1]  # BM25 returns indices, convert to doc_ids
-        title, body = full_doc[1], full_doc[2]
-
-        snippet = (body[:150] + "...") if len(body) > 150 else body
-
-        results.append(
-            {
-                "doc_id": full_doc[0],
-                "title": title,
-                "snippet": snippet,
-                "site": full_doc[3],
-                "date": full_doc[4],
-            }
-        )
-
-    return results
+    for doc_id, _ in scored_docs:
+        fields = docs.get(doc_id, ("title", "snippet", "site", "date"))
+        results.append({"doc_id": doc_id, **fields})
+
+    return results, next_offset
+
+
+def bm25_top_k_batch(queries, top_k: int = 10, indices=None):
+    """
+    [(doc_id, score)] top-k lists for many queries, scored together with one
+    sparse product per segment instead of one pass per query. Bypasses the
+    result cache: replays of query logs would only evict live entries.
+    """
+    indices = indices or registry.get()
+    return indices.bm25.top_k_batch(
+        [analyzer.tokenize(query) for query in queries], k=top_k
+    )
+
+
+def search_bm25_batch(queries, top_k: int = 10):
+    """BM25 search for many queries: one result list (with scores) per query"""
+    indices = registry.get()
+    docs = indices.docs
+    fields = ("title", "snippet", "site", "date")
+    return [
+        [
+            {"doc_id": doc_id, **docs.get(doc_id, fields), "score": score}
+            for doc_id, score in scored_docs
+        ]
+        for scored_docs in bm25_top_k_batch(queries, top_k, indices=indices)
+    ]
+
+
+def verify_pruning(queries, top_k: int = 10):
+    """
+    Run each query with and without dynamic pruning, in every segment, and
+    compare the top-k.
+    Returns the mismatching queries and how many documents each path scored.
+    """
+    segments = registry.get().bm25.segments
+
+    mismatches = []
+    scored_exhaustive = 0
+    scored_pruned = 0
+    for query in queries:
+        for segment in segments:
+            bm25 = segment.bm25
+            term_ids = analyzer.query_term_ids(query, bm25.vocab)
+            docs, _ = bm25.score(term_ids)
+            expected = bm25.top_k_exhaustive(term_ids, top_k)
+            pruned, scored = bm25.top_k_pruned(term_ids, top_k)
+
+            scored_exhaustive += len(docs)
+            scored_pruned += scored
+            if [d for d, _ in expected] != [d for d, _ in pruned]:
+                mismatches.append(query)
+                break
+
+    return {
+        "queries": len(queries),
+        "mismatches": mismatches,
+        "docs_scored_exhaustive": scored_exhaustive,
+        "docs_scored_pruned": scored_pruned,
+    }
@@ -0,0 +1,399 @@
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.bm25 import BM25Index, compute_idf
+from src.index_format import open_index, write_index
+
+# Bump whenever the commit file layout changes
+COMMIT_FORMAT_VERSION = 1
+
+# Optional per-segment embedding matrix, rows aligned with the segment's doc_ids
+SEGMENT_EMBEDDINGS = "embeddings.npy"
+
+
+class Segment:
+    """
+    One immutable index segment: BM25 postings, a document store and, for
+    ingested segments, their embeddings. Deletes are a tombstone bitmap that is
+    replaced (never modified) by newer commits.
+
+    The base segment is the one written by a full `build_indices()`; its
+    embeddings live in the semantic store instead of the segment directory.
+    """
+
+    def __init__(self, name, path, bm25, docs, deletes=None, base=False):
+        self.name = name
+        self.path = path
+        self.bm25 = bm25
+        self.docs = docs
+        self.deletes = deletes  # tombstone file name, or None
+        self.base = base
+        self.deleted = load_deletes(path / deletes, bm25.num_docs) if deletes else None
+
+    @property
+    def num_docs(self):
+        return self.bm25.num_docs
+
+    @property
+    def num_live_docs(self):
+        if self.deleted is None:
+            return self.num_docs
+        return self.num_docs - int(self.deleted.sum())
+
+    @property
+    def embeddings_path(self):
+        path = self.path / SEGMENT_EMBEDDINGS
+        return path if path.exists() else None
+
+    def spec(self):
+        """This segment's entry in a commit file"""
+        return {"name": self.name, "deletes": self.deletes, "base": self.base}
+
+
+class SegmentedIndex:
+    """
+    BM25 search across all segments of a commit.
+
+    With more than one segment, every segment is re-scored with corpus-global
+    statistics (document count, average length and document frequencies over
+    all segments), so a document scores the same whichever segment holds it.
+    Like Lucene, the statistics still count deleted documents until a merge
+    drops them.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        if len(segments) > 1:
+            bind_global_stats(segments)
+        else:
+            for segment in segments:
+                segment.bm25.deleted = segment.deleted
+
+    @property
+    def num_docs(self):
+        return sum(s.num_live_docs for s in self.segments)
+
+    def top_k(self, terms, k=10, exhaustive=False):
+        """[(doc_id, score)] of the k best live documents for analyzed query terms"""
+        results = []
+        for segment in self.segments:
+            vocab = segment.bm25.vocab
+            term_ids = [vocab.get(t) for t in terms]
+            term_ids = [t for t in term_ids if t is not None]
+            if term_ids:
+                results.extend(segment.bm25.top_k(term_ids, k=k, exhaustive=exhaustive))
+        if len(self.segments) > 1:
+            results.sort(key=lambda r: (-r[1], r[0]))
+        return results[:k]
+
+    def top_k_batch(self, queries_terms, k=10):
+        """`top_k` for many analyzed queries: one sparse product per segment"""
+        merged = [[] for _ in queries_terms]
+        for segment in self.segments:
+            # Each distinct term is looked up once for the whole batch
+            vocab = segment.bm25.vocab
+            term_ids = {
+                term: vocab.get(term)
+                for term in {term for terms in queries_terms for term in terms}
+            }
+            queries = [
+                [term_ids[term] for term in terms if term_ids[term] is not None]
+                for terms in queries_terms
+            ]
+            for results, segment_results in zip(
+                merged, segment.bm25.top_k_batch(queries, k=k)
+            ):
+                results.extend(segment_results)
+        if len(self.segments) > 1:
+            for results in merged:
+                results.sort(key=lambda r: (-r[1], r[0]))
+        return [results[:k] for results in merged]
+
+    def deleted_doc_ids(self):
+        parts = [
+            np.asarray(s.bm25.doc_ids)[s.deleted]
+            for s in self.segments
+            if s.deleted is not None
+        ]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def segment_embeddings(self):
+        """[(doc_ids, embeddings path)] of segments that carry their own embeddings"""
+        return [
+            (np.asarray(s.bm25.doc_ids), s.embeddings_path)
+            for s in self.segments
+            if s.embeddings_path is not None
+        ]
+
+
+class SegmentedDocs:
+    """Document lookups across segments; deleted documents are not found"""
+
+    def __init__(self, segments):
+        self.segments = segments
+
+    def _locate(self, doc_id):
+        for segment in self.segments:
+            row = segment.docs.row(doc_id)
+            if row is not None:
+                if segment.deleted is not None and segment.deleted[row]:
+                    return None
+                return segment.docs
+        return None
+
+    def __len__(self):
+        return sum(s.num_live_docs for s in self.segments)
+
+    def __contains__(self, doc_id):
+        return self._locate(doc_id) is not None
+
+    def get(self, doc_id, fields=None):
+        docs = self._locate(doc_id)
+        if docs is None:
+            return None
+        return docs.get(doc_id) if fields is None else docs.get(doc_id, fields)
+
+    def body(self, doc_id):
+        docs = self._locate(doc_id)
+        if docs is None:
+            raise KeyError(doc_id)
+        return docs.body(doc_id)
+
+
+def bind_global_stats(segments):
+    """
+    Search every segment with statistics over all segments. Impacts are
+    recomputed per query term (`BM25Index.rescored`), never for a whole
+    segment, so the base segment stays memory-mapped.
+    """
+    idfs, avgdl = collection_stats([s.bm25 for s in segments])
+    for segment, idf in zip(segments, idfs):
+        segment.bm25 = segment.bm25.rescored(idf, avgdl, deleted=segment.deleted)
+
+
+def collection_stats(indexes, orders=None):
+    """
+    Statistics of several BM25 indexes taken as one collection: each one's
+    per-term idf (aligned with its own vocabulary) and the average doc length.
+
+    `orders` are the indexes' first-seen term orders (`BM25Index.idf_order`).
+    Given them, for indexes over consecutive document ranges in corpus order,
+    the idf floor's average is summed in corpus first-seen order, so the idfs
+    are bit for bit those of one index built over the whole collection.
+    """
+    num_docs = sum(len(bm25.doc_ids) for bm25 in indexes)
+    total_len = sum(int(np.sum(bm25.doc_lens)) for bm25 in indexes)
+    avgdl = total_len / num_docs if num_docs else 0.0
+
+    index_terms = [list(bm25.vocab) for bm25 in indexes]
+    orders = orders or [None] * len(indexes)
+    # Terms are added in first-seen order: the first index holding a term,
+    # then the term's rank within that index
+    dfs = {}
+    for bm25, terms, order in zip(indexes, index_terms, orders):
+        term_dfs = np.diff(bm25.offsets)
+        if order is None:
+            order = np.arange(len(terms))
+        for term_id in np.asarray(order).tolist():
+            term = terms[term_id]
+            dfs[term] = dfs.get(term, 0) + int(term_dfs[term_id])
+
+    idf_values = compute_idf(
+        np.fromiter(dfs.values(), dtype=np.int64, count=len(dfs)),
+        num_docs,
+        indexes[0].epsilon,
+    )
+    idf = dict(zip(dfs, idf_values.tolist()))
+    idfs = [
+        np.array([idf[t] for t in terms], dtype=np.float64) for terms in index_terms
+    ]
+    return idfs, avgdl
+
+
+def load_deletes(path, num_docs):
+    return np.unpackbits(np.load(path))[:num_docs].astype(bool)
+
+
+def write_deletes(segment_path, deleted):
+    """Write a new tombstone bitmap for a segment; returns its file name"""
+    name = f"deletes_{time.time_ns()}.npy"
+    np.save(segment_path / name, np.packbits(deleted))
+    return name
+
+
+def new_segment_name():
+    return f"seg_{time.time_ns()}"
+
+
+def write_segment(directory, bm25, docs, embeddings=None, base=False):
+    """
+    Write a segment directory atomically (temp name, then rename).
+    Returns its commit spec.
+    """
+    name = new_segment_name()
+    tmp_dir = directory / f".{name}.tmp"
+    write_index(tmp_dir, bm25, docs)
+    if embeddings is not None:
+        np.save(tmp_dir / SEGMENT_EMBEDDINGS, np.asarray(embeddings, dtype=np.float32))
+    os.rename(tmp_dir, directory / name)
+    return {"name": name, "deletes": None, "base": base}
+
+
+def write_commit(directory, segment_specs):
+    """
+    Write a commit file listing the live segments and switch CURRENT to it.
+    Returns the commit name, which is also the index version.
+    """
+    name = f"commit_{time.time_ns()}.json"
+    commit = {"format_version": COMMIT_FORMAT_VERSION, "segments": segment_specs}
+    tmp_path = directory / f".{name}.tmp"
+    tmp_path.write_text(json.dumps(commit, indent=2))
+    os.replace(tmp_path, directory / name)
+
+    tmp_current = directory / "CURRENT.tmp"
+    tmp_current.write_text(name)
+    os.replace(tmp_current, directory / "CURRENT")
+    return name
+
+
+def read_commit(directory, name):
+    """Segment specs of a commit"""
+    path = Path(directory) / name
+    if path.is_dir():
+        # Single-version layout from before segments: the version is the segment
+        return [{"name": name, "deletes": None, "base": True}]
+
+    commit = json.loads(path.read_text())
+    if commit.get("format_version") != COMMIT_FORMAT_VERSION:
+        raise ValueError(
+            f"Commit {path} has format version {commit.get('format_version')}, "
+            f"expected {COMMIT_FORMAT_VERSION}; rebuild it with build_indices()"
+        )
+    return commit["segments"]
+
+
+def open_commit(directory, name):
+    """Memory-map every segment of a commit: (SegmentedIndex, SegmentedDocs)"""
+    directory = Path(directory)
+    segments = []
+    for spec in read_commit(directory, name):
+        path = directory / spec["name"]
+        bm25, docs = open_index(path)
+        segments.append(
+            Segment(
+                spec["name"],
+                path,
+                bm25,
+                docs,
+                deletes=spec["deletes"],
+                base=spec["base"],
+            )
+        )
+    return SegmentedIndex(segments), SegmentedDocs(segments)
+
+
+def merge_segments(segments):
+    """
+    Merge segments into one BM25Index, in doc_id order, with deleted documents
+    dropped. Postings are remapped rather than re-tokenized.
+    Returns (bm25, doc records iterator, embeddings or None).
+    """
+    lives = [
+        np.ones(s.num_docs, dtype=bool) if s.deleted is None else ~s.deleted
+        for s in segments
+    ]
+    doc_ids = np.concatenate(
+        [np.asarray(s.bm25.doc_ids)[live] for s, live in zip(segments, lives)]
+    )
+    doc_lens = np.concatenate(
+        [np.asarray(s.bm25.doc_lens)[live] for s, live in zip(segments, lives)]
+    )
+    # Segments may hold interleaving doc_id ranges: order documents globally
+    order = np.argsort(doc_ids, kind="stable")
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+
+    vocab = {}
+    term_cols, doc_cols, tf_cols = [], [], []
+    first = 0
+    for segment, live in zip(segments, lives):
+        bm25 = segment.bm25
+        new_index = np.full(bm25.num_docs, -1, dtype=np.int32)
+        new_index[live] = rank[first : first + int(live.sum())]
+        first += int(live.sum())
+
+        dfs = np.diff(bm25.offsets)
+        postings = np.asarray(bm25.postings)
+        keep = live[postings]
+        posting_terms = np.repeat(np.arange(len(dfs)), dfs)[keep]
+        # Terms left with no live postings are dropped from the vocabulary
+        present = np.bincount(posting_terms, minlength=len(dfs)) > 0
+        term_ids = np.full(len(dfs), -1, dtype=np.int64)
+        for term_id in np.flatnonzero(present).tolist():
+            term_ids[term_id] = vocab.setdefault(bm25.vocab.term(term_id), len(vocab))
+
+        term_cols.append(term_ids[posting_terms])
+        doc_cols.append(new_index[postings[keep]])
+        tf_cols.append(np.asarray(bm25.tfs)[keep])
+
+    doc_col = np.concatenate(doc_cols)
+    by_doc = np.argsort(doc_col, kind="stable")
+    first_index = segments[0].bm25
+    merged = BM25Index.from_triples(
+        vocab,
+        np.concatenate(term_cols)[by_doc],
+        doc_col[by_doc],
+        np.concatenate(tf_cols)[by_doc],
+        doc_ids[order],
+        doc_lens[order],
+        k1=first_index.k1,
+        b=first_index.b,
+        epsilon=first_index.epsilon,
+    )
+
+    # (segment, row) of every merged document, in merged order
+    source_segment = np.repeat(
+        np.arange(len(segments)), [int(live.sum()) for live in lives]
+    )[order]
+    source_row = np.concatenate([np.flatnonzero(live) for live in lives])[order]
+
+    def records():
+        for seg, row in zip(source_segment.tolist(), source_row.tolist()):
+            segment = segments[seg]
+            doc_id = int(segment.bm25.doc_ids[row])
+            d = segment.docs.get(doc_id, ("title", "body", "site", "date"))
+            yield doc_id, d["title"], d["body"], d["site"], d["date"]
+
+    embeddings = None
+    if all(s.embeddings_path is not None for s in segments):
+        embeddings = np.concatenate(
+            [np.load(s.embeddings_path)[live] for s, live in zip(segments, lives)]
+        )[order]
+    return merged, records(), embeddings
+
+
+def remove_unreferenced(directory, keep_commits):
+    """
+    Keep the newest `keep_commits` commits and delete older commits and any
+    segment directory none of the kept commits reference.
+    """
+    directory = Path(directory)
+    commits = sorted(
+        directory.glob("commit_*.json"), key=lambda p: int(p.stem.split("_")[1])
+    )
+    for path in commits[:-keep_commits]:
+        path.unlink(missing_ok=True)
+
+    referenced = set()
+    for path in commits[-keep_commits:]:
+        referenced.update(spec["name"] for spec in read_commit(directory, path.name))
+
+    for path in list(directory.glob("seg_*")) + list(directory.glob("v*")):
+        if path.is_dir() and path.name not in referenced:
+            # Open memory maps of a removed segment stay valid until unmapped
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,291 @@
+import json
+import os
+import shutil
+import sys
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from src.semantic.encoder import EMB_DIR, open_embeddings
+
+ANN_DIR = EMB_DIR / "ivf"
+
+# Lists probed per query by default; more lists = higher recall, more work
+DEFAULT_NPROBE = 8
+
+KMEANS_ITERATIONS = 10
+
+# Training vectors per list for k-means (the rest are only assigned)
+TRAIN_PER_LIST = 64
+
+# Rows per block when scoring all vectors against the centroids
+ASSIGN_BLOCK = 65536
+
+ARRAY_NAMES = ("centroids", "list_offsets", "list_rows", "vectors")
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF-Flat) index over normalized embeddings.
+
+    Vectors are clustered by spherical k-means into `nlist` lists; a query
+    scores the centroids, then only the vectors of the `nprobe` closest lists.
+    Vectors are stored grouped by list, so every probed list is one
+    contiguous slice: list i is `vectors[list_offsets[i]:list_offsets[i + 1]]`
+    and `list_rows` maps each of them back to its embedding row.
+    """
+
+    def __init__(self, centroids, list_offsets, list_rows, vectors):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.vectors = vectors
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings, nlist=None, iterations=KMEANS_ITERATIONS, seed=0):
+        """Cluster `embeddings` (rows normalized) and group them by list"""
+        num_docs = len(embeddings)
+        if nlist is None:
+            nlist = int(4 * np.sqrt(num_docs))
+        nlist = max(1, min(nlist, num_docs))
+
+        rng = np.random.default_rng(seed)
+        sample_size = min(num_docs, nlist * TRAIN_PER_LIST)
+        sample = np.asarray(
+            embeddings[np.sort(rng.choice(num_docs, sample_size, replace=False))],
+            dtype=np.float32,
+        )
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assign = _nearest(sample, centroids)
+            counts = np.bincount(assign, minlength=nlist)
+            order = np.argsort(assign, kind="stable")
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            nonempty = counts > 0
+            centroids[nonempty] = np.add.reduceat(
+                sample[order], starts[nonempty], axis=0
+            )
+            # Re-seed empty lists with random training vectors
+            empty = np.flatnonzero(~nonempty)
+            centroids[empty] = sample[rng.choice(sample_size, len(empty))]
+            centroids /= np.maximum(
+                np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12
+            )
+
+        assign = np.concatenate(
+            [
+                _nearest(np.asarray(embeddings[i : i + ASSIGN_BLOCK]), centroids)
+                for i in range(0, num_docs, ASSIGN_BLOCK)
+            ]
+        )
+        list_rows = np.argsort(assign, kind="stable")
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=list_offsets[1:])
+        vectors = np.asarray(embeddings)[list_rows]
+        return cls(centroids, list_offsets, list_rows, vectors)
+
+    def search(self, vector, k=10, nprobe=DEFAULT_NPROBE, exclude=None):
+        """
+        Approximate top-k rows by inner product: (rows, scores), best first.
+        `exclude` is an optional bool mask over rows that must not be returned.
+        """
+        nprobe = max(1, min(nprobe, self.nlist))
+        centroid_scores = self.centroids @ vector
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        starts, ends = self.list_offsets[probe], self.list_offsets[probe + 1]
+        rows = np.concatenate([self.list_rows[s:e] for s, e in zip(starts, ends)])
+        scores = np.concatenate(
+            [self.vectors[s:e] @ vector for s, e in zip(starts, ends)]
+        ).astype(np.float32)
+        if exclude is not None:
+            keep = ~exclude[rows]
+            rows, scores = rows[keep], scores[keep]
+
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return rows[order], scores[order]
+
+    def save(self, directory, doc_ids):
+        """Write the index, tied to the embedding rows of `doc_ids`"""
+        write_array_dir(
+            directory,
+            {name: getattr(self, name) for name in ARRAY_NAMES},
+            {
+                "nlist": self.nlist,
+                "num_docs": len(doc_ids),
+                # Embedding rows this index was built from
+                "doc_ids_crc": doc_ids_checksum(doc_ids),
+            },
+        )
+
+    @classmethod
+    def open(cls, directory, doc_ids):
+        """
+        Memory-map a saved index, or None if there is none or it was built
+        for other embeddings than the rows of `doc_ids`.
+        """
+        directory = Path(directory)
+        try:
+            manifest = json.loads((directory / "manifest.json").read_text())
+        except FileNotFoundError:
+            return None
+        if manifest["doc_ids_crc"] != doc_ids_checksum(doc_ids):
+            print(f"ANN index in {directory} is stale; using exact search")
+            return None
+
+        arrays = {
+            name: np.load(directory / f"{name}.npy", mmap_mode="r")
+            for name in ARRAY_NAMES
+            if name != "centroids"
+        }
+        # Centroids are scored on every query: keep them in memory
+        centroids = np.load(directory / "centroids.npy")
+        return cls(centroids, **arrays)
+
+
+def write_array_dir(directory, arrays, manifest):
+    """
+    Write .npy arrays plus manifest.json as `directory`, replacing any
+    previous version only once everything is written.
+    """
+    directory = Path(directory)
+    tmp_dir = directory.with_name(f".{directory.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+    for name, array in arrays.items():
+        np.save(tmp_dir / f"{name}.npy", array)
+    (tmp_dir / "manifest.json").write_text(json.dumps(manifest, indent=2))
+
+    old_dir = directory.with_name(f".{directory.name}.old")
+    if directory.exists():
+        os.rename(directory, old_dir)
+    os.rename(tmp_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _nearest(vectors, centroids):
+    return np.argmax(vectors @ centroids.T, axis=1)
+
+
+def top_k_per_row(scores, k):
+    """
+    Per row of a (num_queries, n) score matrix, the column indices and scores
+    of its k highest entries, best first. Partial selection: O(n) per query
+    rather than a full sort.
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return (
+            np.empty((len(scores), 0), dtype=np.intp),
+            np.empty((len(scores), 0), dtype=scores.dtype),
+        )
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return (
+        np.take_along_axis(top, order, axis=1),
+        np.take_along_axis(top_scores, order, axis=1),
+    )
+
+
+class DocIdLookup:
+    """
+    doc_id -> position in a doc_id array (e.g. memory-mapped), by binary
+    search. A sorted array, the usual case, needs no extra memory; otherwise
+    a sort order is kept alongside.
+    """
+
+    def __init__(self, doc_ids):
+        self.doc_ids = doc_ids
+        self._sorter = None
+        if len(doc_ids) > 1 and not np.all(doc_ids[1:] > doc_ids[:-1]):
+            self._sorter = np.argsort(doc_ids, kind="stable")
+
+    def rows(self, doc_ids):
+        """Positions of `doc_ids`, -1 where absent"""
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if not len(self.doc_ids):
+            return np.full(len(doc_ids), -1, dtype=np.intp)
+        i = np.searchsorted(self.doc_ids, doc_ids, sorter=self._sorter)
+        i = np.minimum(i, len(self.doc_ids) - 1)
+        rows = i if self._sorter is None else self._sorter[i]
+        return np.where(self.doc_ids[rows] == doc_ids, rows, -1).astype(np.intp)
+
+    def row(self, doc_id):
+        """Position of doc_id, or None"""
+        row = int(self.rows([doc_id])[0])
+        return None if row < 0 else row
+
+
+def doc_ids_checksum(doc_ids):
+    return zlib.crc32(np.asarray(doc_ids, dtype=np.int64).tobytes())
+
+
+def build_ann_index(nlist=None):
+    """Build the IVF index over the saved embeddings and persist it"""
+    embeddings, doc_ids = open_embeddings()
+    start_time = time.time()
+    index = IVFIndex.build(embeddings, nlist=nlist)
+    index.save(ANN_DIR, doc_ids)
+    print(
+        f"✓ Built IVF index: {index.nlist} lists over {len(doc_ids)} vectors "
+        f"in {time.time() - start_time:.1f}s"
+    )
+    return index
+
+
+def benchmark_recall(
+    index, embeddings, k=10, nprobes=(1, 2, 4, 8, 16, 32), num_queries=200, seed=0
+):
+    """
+    Recall@k of the IVF index against exact search, per nprobe, with mean
+    query latency. Queries are embeddings of randomly chosen documents.
+    """
+    rng = np.random.default_rng(seed)
+    num_queries = min(num_queries, len(embeddings))
+    queries = np.asarray(
+        embeddings[rng.choice(len(embeddings), num_queries, replace=False)],
+        dtype=np.float32,
+    )
+
+    start = time.perf_counter()
+    exact = []
+    for q in queries:
+        scores = embeddings @ q
+        exact.append(set(np.argsort(-scores)[:k].tolist()))
+    exact_ms = (time.perf_counter() - start) * 1000 / num_queries
+
+    results = {"queries": num_queries, "k": k, "exact_ms": round(exact_ms, 3)}
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        found = [set(index.search(q, k, nprobe)[0].tolist()) for q in queries]
+        ann_ms = (time.perf_counter() - start) * 1000 / num_queries
+        recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])
+        results[f"nprobe={nprobe}"] = {
+            "recall": round(float(recall), 4),
+            "ms": round(ann_ms, 3),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    # python -m src.semantic.ann build [nlist] | bench [k]
+    command = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if command == "build":
+        build_ann_index(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    else:
+        embeddings, doc_ids = open_embeddings()
+        index = IVFIndex.open(ANN_DIR, doc_ids) or build_ann_index()
+        k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        for name, value in benchmark_recall(index, embeddings, k=k).items():
+            print(f"{name}: {value}")
@@ -1,44 +1,272 @@
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
 from pathlib import Path
-from sentence_transformers import SentenceTransformer
 
-from src.data_loader import get_docs
+from src.data_loader import get_text_lengths, get_texts
 
 EMB_DIR = Path("semantic_store")
 EMB_DIR.mkdir(exist_ok=True)
 
+EMB_PATH = EMB_DIR / "embeddings.npy"
+ID_PATH = EMB_DIR / "doc_ids.npy"
+
+# In-progress builds live here until every chunk is done
+BUILD_DIR = EMB_DIR / "build"
+
 MODEL_NAME = "all-MiniLM-L6-v2"
 
+# Documents encoded per checkpoint; a restart redoes at most the chunks that
+# were in flight
+CHUNK_DOCS = 4096
+
+# Storage type of the embedding matrix; "float16" halves disk and page cache
+STORE_DTYPE = "float32"
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """The sentence encoder, loaded on first use"""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                # Imported here: serving precomputed vectors needs no torch
+                from sentence_transformers import SentenceTransformer
+
+                _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+
+def set_model(model):
+    """
+    Use `model` instead of loading MODEL_NAME: anything with the
+    SentenceTransformer `encode` / `get_sentence_embedding_dimension`
+    methods, e.g. an offline stub for benchmarks.
+    """
+    global _model
+    with _model_lock:
+        _model = model
+
+
+def encode_texts(texts):
+    """Normalized embeddings of `texts`, shape (len(texts), 384)"""
+    return get_model().encode(list(texts), normalize_embeddings=True)
+
 
 def load_or_create_embeddings():
     """
     Creates or loads sentence embeddings for all documents.
     Returns:
-        embeddings (np.ndarray): shape (N, 384)
-        doc_ids (list[int])
-        model (SentenceTransformer)
+        embeddings (np.ndarray): shape (N, 384), memory-mapped
+        doc_ids (np.ndarray): int64, memory-mapped
+    The model is only loaded if the embeddings have to be generated.
+    """
+    if not (EMB_PATH.exists() and ID_PATH.exists()):
+        print("Generating fresh semantic embeddings...")
+        build_embeddings()
+
+    print("Loading semantic embeddings from disk...")
+    return open_embeddings()
+
+
+def open_embeddings():
+    """Memory-map the embedding store: (embeddings, doc_ids), rows aligned"""
+    embeddings = np.load(EMB_PATH, mmap_mode="r")
+    doc_ids = np.load(ID_PATH, mmap_mode="r")
+    if len(embeddings) != len(doc_ids):
+        raise ValueError(
+            f"{EMB_PATH} has {len(embeddings)} rows but {ID_PATH} has "
+            f"{len(doc_ids)} ids; rebuild with build_embeddings()"
+        )
+    return embeddings, doc_ids
+
+
+def embeddings_version():
+    """
+    Changes whenever a new embedding store is published (the mtime of the
+    ids, which are moved into place last); None if there is none.
+    """
+    try:
+        return os.stat(ID_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def build_embeddings(workers=1, dtype=STORE_DTYPE, chunk_docs=CHUNK_DOCS):
+    """
+    Encode the whole corpus into the embedding store, resumably.
+
+    The corpus is planned once (doc_ids, plus an order by text length so each
+    chunk holds texts of similar length and pads little) and encoded in
+    chunks of `chunk_docs`, by `workers` processes. Each finished chunk is
+    written into a memory-mapped matrix at its documents' rows and then
+    checkpointed, so an interrupted build resumes with the unfinished chunks.
+    The store replaces embeddings.npy / doc_ids.npy only once complete.
     """
-    emb_path = EMB_DIR / "embeddings.npy"
-    id_path = EMB_DIR / "doc_ids.npy"
+    settings = {
+        "model": MODEL_NAME,
+        "dtype": np.dtype(dtype).name,
+        "chunk_docs": chunk_docs,
+    }
+    state = _read_build_state()
+    if state is None or state["settings"] != settings:
+        state = _plan_build(settings)
+    else:
+        print(f"Resuming embedding build: {len(state['done'])} chunks already done")
 
-    model = SentenceTransformer(MODEL_NAME)
+    doc_ids = np.load(BUILD_DIR / "doc_ids.npy")
+    order = np.load(BUILD_DIR / "order.npy")
+    embeddings = np.load(BUILD_DIR / "embeddings.npy", mmap_mode="r+")
+
+    num_chunks = -(-len(doc_ids) // chunk_docs)
+    done = set(state["done"])
+    todo = [c for c in range(num_chunks) if c not in done]
+    rows = {c: order[c * chunk_docs : (c + 1) * chunk_docs] for c in todo}
+
+    start_time = time.time()
+    encoded = 0
+
+    def finish(chunk, chunk_embeddings):
+        nonlocal encoded
+        embeddings[rows[chunk]] = chunk_embeddings.astype(embeddings.dtype)
+        embeddings.flush()
+        state["done"].append(chunk)
+        _write_build_state(state)
+        encoded += len(rows[chunk])
+        print(
+            f"  chunk {len(state['done'])}/{num_chunks} done, "
+            f"{encoded / max(time.time() - start_time, 1e-9):.0f} docs/s"
+        )
+
+    if workers <= 1:
+        for chunk in todo:
+            finish(chunk, _encode_docs(doc_ids[rows[chunk]]))
+    else:
+        # spawn: forking a process that already runs torch threads can deadlock
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(max(1, (os.cpu_count() or 1) // workers),),
+        ) as pool:
+            futures = {
+                pool.submit(_encode_docs, doc_ids[rows[chunk]]): chunk for chunk in todo
+            }
+            for future in as_completed(futures):
+                finish(futures[future], future.result())
+
+    _publish_store(BUILD_DIR / "embeddings.npy", BUILD_DIR / "doc_ids.npy")
+    shutil.rmtree(BUILD_DIR, ignore_errors=True)
+    print(f"Saved {len(doc_ids)} embeddings")
+
+
+def _plan_build(settings):
+    """Start a new build: fix the doc_ids, the length order and the output file"""
+    shutil.rmtree(BUILD_DIR, ignore_errors=True)
+    BUILD_DIR.mkdir()
+
+    doc_ids, lengths = get_text_lengths()
+    # Longest first, so memory-hungry chunks fail early rather than at the end
+    order = np.argsort(-lengths, kind="stable")
+    np.save(BUILD_DIR / "doc_ids.npy", doc_ids)
+    np.save(BUILD_DIR / "order.npy", order)
+    np.lib.format.open_memmap(
+        BUILD_DIR / "embeddings.npy",
+        mode="w+",
+        dtype=settings["dtype"],
+        shape=(len(doc_ids), get_model().get_sentence_embedding_dimension()),
+    ).flush()
+
+    state = {"settings": settings, "done": []}
+    _write_build_state(state)
+    return state
+
+
+def _read_build_state():
+    try:
+        return json.loads((BUILD_DIR / "state.json").read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_build_state(state):
+    tmp_path = BUILD_DIR / "state.json.tmp"
+    tmp_path.write_text(json.dumps(state))
+    os.replace(tmp_path, BUILD_DIR / "state.json")
+
+
+def _init_worker(num_threads):
+    import torch
+
+    torch.set_num_threads(num_threads)
+
+
+def _encode_docs(doc_ids):
+    """Worker: embeddings of the given documents (float32, normalized)"""
+    return encode_texts(get_texts(doc_ids))
+
+
+def _publish_store(emb_path, id_path):
+    """
+    Move a complete store into place. Ids go last: a crash in between leaves
+    a row-count mismatch that `open_embeddings` reports.
+    """
+    os.replace(emb_path, EMB_PATH)
+    os.replace(id_path, ID_PATH)
+
+
+def rebase_embeddings(doc_ids, extra=()):
+    """
+    Rewrite the saved embeddings for a rebuilt index: keep the rows of
+    `doc_ids` and append `extra` (doc_ids, embeddings) pairs, e.g. those of
+    ingested segments that a full rebuild folded into the base segment.
+    Does nothing if embeddings were never generated.
+    """
+    if not (EMB_PATH.exists() and ID_PATH.exists()):
+        return
 
-    if emb_path.exists() and id_path.exists():
-        print("Loading semantic embeddings from disk...")
-        embeddings = np.load(emb_path)
-        doc_ids = np.load(id_path).tolist()
-        return embeddings, doc_ids, model
+    embeddings, ids = open_embeddings()
+    keep = np.isin(ids, np.asarray(doc_ids))
+    parts = [(ids[keep], embeddings[keep])]
+    for extra_ids, extra_embeddings in extra:
+        extra_ids = np.asarray(extra_ids, dtype=ids.dtype)
+        new = np.isin(extra_ids, doc_ids) & ~np.isin(extra_ids, ids)
+        parts.append((extra_ids[new], np.asarray(extra_embeddings)[new]))
 
-    print("Generating fresh semantic embeddings...")
-    docs = get_docs()  # (doc_id, title, body, site, date)
-    doc_ids = [d[0] for d in docs]
+    num_rows = sum(len(part_ids) for part_ids, _ in parts)
+    tmp_emb = EMB_DIR / "embeddings.tmp.npy"
+    out = np.lib.format.open_memmap(
+        tmp_emb,
+        mode="w+",
+        dtype=embeddings.dtype,
+        shape=(num_rows, embeddings.shape[1]),
+    )
+    start = 0
+    for _, part_embeddings in parts:
+        out[start : start + len(part_embeddings)] = part_embeddings
+        start += len(part_embeddings)
+    out.flush()
+    del out, embeddings
 
-    texts = [f"{title} {body}" for _, title, body, _, _ in docs]
+    tmp_ids = EMB_DIR / "doc_ids.tmp.npy"
+    np.save(tmp_ids, np.concatenate([part_ids for part_ids, _ in parts]))
+    _publish_store(tmp_emb, tmp_ids)
 
-    embeddings = model.encode(texts, normalize_embeddings=True)
-    np.save(emb_path, embeddings)
-    np.save(id_path, np.array(doc_ids))
 
-    print(f"Saved {len(embeddings)} embeddings")
+if __name__ == "__main__":
+    # python -m src.semantic.encoder [workers] [float16|float32]
+    import sys
 
-    return embeddings, doc_ids, model
+    build_embeddings(
+        workers=int(sys.argv[1]) if len(sys.argv) > 1 else 1,
+        dtype=sys.argv[2] if len(sys.argv) > 2 else STORE_DTYPE,
+    )
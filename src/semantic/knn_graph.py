@@ -0,0 +1,425 @@
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from src.semantic.ann import (
+    DocIdLookup,
+    doc_ids_checksum,
+    top_k_per_row,
+    write_array_dir,
+)
+from src.semantic.encoder import EMB_DIR, open_embeddings
+
+KNN_DIR = EMB_DIR / "knn"
+
+# Neighbours kept per document; /similar and /timeline asking for more fall
+# back to searching
+GRAPH_K = 32
+
+# Documents whose neighbours are computed per matrix product (one task), and
+# candidate rows scored against them at a time
+QUERY_BLOCK = 1024
+COLUMN_BLOCK = 16384
+
+# Documents added incrementally go to a delta saved beside the graph: their
+# rows plus the existing rows whose neighbours changed. Once it holds more
+# than this many rows it is folded into a rewrite of the whole graph.
+DELTA_MAX_ROWS = 50_000
+
+ARRAY_NAMES = ("doc_ids", "neighbors", "scores", "extra_vectors")
+
+# Documents appended after the saved graph's rows (doc_ids, normalized
+# vectors), and the neighbour lists of `rows` (sorted graph rows: appended
+# ones and changed saved ones) that replace those of the saved graph
+GraphDelta = namedtuple(
+    "GraphDelta", ["doc_ids", "vectors", "rows", "neighbors", "scores"]
+)
+DELTA_ARRAY_NAMES = GraphDelta._fields
+
+# Incremental updates read and extend the saved graph and delta one at a time
+_update_lock = threading.Lock()
+
+
+class KNNGraph:
+    """
+    Exact k-nearest-neighbour graph over the embeddings.
+
+    Row i is document `doc_ids[i]`; its neighbours are the graph rows
+    `neighbors[i]` (int32) with cosine similarities `scores[i]`, best first.
+    The first `num_base` rows are the rows of the embedding store; documents
+    added incrementally follow, with their vectors kept in `extra_vectors`.
+
+    Those arrays are the saved graph. Documents added since it was saved are
+    in `delta` (a GraphDelta), rows `len(doc_ids)` onwards, and the delta's
+    neighbour lists take precedence over the saved ones.
+    """
+
+    def __init__(self, doc_ids, neighbors, scores, extra_vectors, num_base, delta=None):
+        self.doc_ids = doc_ids
+        self.neighbors = neighbors
+        self.scores = scores
+        self.extra_vectors = extra_vectors
+        self.num_base = num_base
+        self.delta = delta or _empty_delta(neighbors.shape[1], extra_vectors.shape[1])
+        self.graph_id = None  # of the saved graph, which a delta refers to
+        self._lookup = DocIdLookup(doc_ids)
+        self._delta_lookup = DocIdLookup(self.delta.doc_ids)
+
+    @property
+    def k(self):
+        return self.neighbors.shape[1]
+
+    def __len__(self):
+        return len(self.doc_ids) + len(self.delta.doc_ids)
+
+    def __contains__(self, doc_id):
+        return self.row(doc_id) is not None
+
+    def row(self, doc_id):
+        """Graph row of doc_id, or None"""
+        row = int(self.rows([doc_id])[0])
+        return None if row < 0 else row
+
+    def rows(self, doc_ids):
+        """Graph rows of `doc_ids`, -1 where absent"""
+        rows = self._lookup.rows(doc_ids)
+        if len(self.delta.doc_ids):
+            added = self._delta_lookup.rows(doc_ids)
+            rows = np.where(added >= 0, len(self.doc_ids) + added, rows)
+        return rows
+
+    def ids_of(self, rows):
+        """doc_ids of graph rows"""
+        rows = np.asarray(rows, dtype=np.int64)
+        saved = rows < len(self.doc_ids)
+        ids = np.empty(len(rows), dtype=np.int64)
+        ids[saved] = self.doc_ids[rows[saved]]
+        ids[~saved] = self.delta.doc_ids[rows[~saved] - len(self.doc_ids)]
+        return ids
+
+    def lists(self, rows):
+        """(neighbours, scores) of graph rows, from the delta where it has them"""
+        rows = np.asarray(rows, dtype=np.int64)
+        neighbors = np.empty((len(rows), self.k), dtype=np.int32)
+        scores = np.empty((len(rows), self.k), dtype=np.float32)
+        saved = rows < len(self.doc_ids)
+        neighbors[saved] = self.neighbors[rows[saved]]
+        scores[saved] = self.scores[rows[saved]]
+        if len(self.delta.rows):
+            i = np.minimum(
+                np.searchsorted(self.delta.rows, rows), len(self.delta.rows) - 1
+            )
+            changed = self.delta.rows[i] == rows
+            neighbors[changed] = self.delta.neighbors[i[changed]]
+            scores[changed] = self.delta.scores[i[changed]]
+        return neighbors, scores
+
+    def neighbors_of(self, doc_id):
+        """(neighbour doc_ids, scores) of a document, best first, or None"""
+        row = self.row(doc_id)
+        if row is None:
+            return None
+        neighbors, scores = self.lists([row])
+        return self.ids_of(neighbors[0]), scores[0]
+
+    @classmethod
+    def build(cls, embeddings, doc_ids, k=GRAPH_K, workers=None):
+        """
+        Neighbours of every row of `embeddings` by blocked matrix products,
+        QUERY_BLOCK documents per task on `workers` threads (numpy releases
+        the GIL in the products and the partial sorts).
+        """
+        num_docs = len(embeddings)
+        k = max(0, min(k, num_docs - 1))
+        neighbors = np.empty((num_docs, k), dtype=np.int32)
+        scores = np.empty((num_docs, k), dtype=np.float32)
+        matrices = [(0, embeddings)]
+
+        def _block(start):
+            queries = np.asarray(embeddings[start : start + QUERY_BLOCK], np.float32)
+            rows = np.arange(start, start + len(queries))
+            block_rows, block_scores = _top_neighbors(queries, rows, matrices, k)
+            neighbors[start : start + len(queries)] = block_rows
+            scores[start : start + len(queries)] = block_scores
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            list(pool.map(_block, range(0, num_docs, QUERY_BLOCK)))
+
+        extra_vectors = np.empty((0, embeddings.shape[1]), dtype=np.float32)
+        return cls(
+            np.asarray(doc_ids, np.int64), neighbors, scores, extra_vectors, num_docs
+        )
+
+    def add(self, base_embeddings, doc_ids, vectors):
+        """
+        A new graph that also holds the documents `doc_ids` (with normalized
+        `vectors`): their neighbours are found among all rows, and existing
+        rows take a new document into their list where it scores higher.
+
+        Costs one pass over the stored vectors per call, not a rebuild. The
+        saved arrays are shared, not copied: only the new rows and the rows
+        whose lists changed go into the returned graph's delta, so saving it
+        (`save_delta`) writes those rather than the whole graph.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        new = self.rows(doc_ids) < 0
+        doc_ids, vectors = doc_ids[new], vectors[new]
+        if not len(doc_ids):
+            return self
+
+        saved = len(self.doc_ids)
+        old = [
+            (0, base_embeddings),
+            (self.num_base, self.extra_vectors),
+            (saved, self.delta.vectors),
+        ]
+        new_rows = len(self) + np.arange(len(doc_ids))
+        added_neighbors, added_scores = _top_neighbors(
+            vectors, new_rows, old + [(len(self), vectors)], self.k
+        )
+
+        changed = [(self.delta.rows, self.delta.neighbors, self.delta.scores)]
+        # With k = 0 (a graph of one document) no existing list can change
+        for first, matrix in old if self.k else []:
+            for start in range(0, len(matrix), COLUMN_BLOCK):
+                block = np.asarray(matrix[start : start + COLUMN_BLOCK], np.float32)
+                rows = first + start + np.arange(len(block))
+                new_scores = block @ vectors.T
+                # Only rows where a new document beats the current k-th change
+                neighbors, scores = self.lists(rows)
+                hit = np.flatnonzero(new_scores.max(axis=1) > scores[:, -1])
+                if not len(hit):
+                    continue
+                candidates = np.concatenate([scores[hit], new_scores[hit]], axis=1)
+                top, top_scores = top_k_per_row(candidates, self.k)
+                ids = np.concatenate(
+                    [
+                        neighbors[hit],
+                        np.broadcast_to(new_rows, (len(hit), len(new_rows))),
+                    ],
+                    axis=1,
+                )
+                changed.append(
+                    (rows[hit], np.take_along_axis(ids, top, axis=1), top_scores)
+                )
+        changed.append((new_rows, added_neighbors.astype(np.int32), added_scores))
+
+        rows = np.concatenate([c[0] for c in changed]).astype(np.int64)
+        # Later lists of a row replace earlier ones; rows come out sorted
+        _, last = np.unique(rows[::-1], return_index=True)
+        keep = len(rows) - 1 - last
+        delta = GraphDelta(
+            np.concatenate([self.delta.doc_ids, doc_ids]),
+            np.concatenate([self.delta.vectors, vectors]),
+            rows[keep],
+            np.concatenate([c[1] for c in changed]).astype(np.int32)[keep],
+            np.concatenate([c[2] for c in changed]).astype(np.float32)[keep],
+        )
+        graph = KNNGraph(
+            self.doc_ids,
+            self.neighbors,
+            self.scores,
+            self.extra_vectors,
+            self.num_base,
+            delta,
+        )
+        graph.graph_id = self.graph_id
+        return graph
+
+    def folded(self):
+        """This graph with its delta written into one set of full arrays"""
+        if not len(self.delta.rows):
+            return self
+        saved = len(self.doc_ids)
+        neighbors = np.empty((len(self), self.k), dtype=np.int32)
+        scores = np.empty((len(self), self.k), dtype=np.float32)
+        neighbors[:saved] = self.neighbors
+        scores[:saved] = self.scores
+        neighbors[self.delta.rows] = self.delta.neighbors
+        scores[self.delta.rows] = self.delta.scores
+        return KNNGraph(
+            np.concatenate([self.doc_ids, self.delta.doc_ids]),
+            neighbors,
+            scores,
+            np.concatenate([self.extra_vectors, self.delta.vectors]),
+            self.num_base,
+        )
+
+    def save(self, directory, base_doc_ids):
+        """
+        Write the graph, tied to the embedding rows of `base_doc_ids`, and
+        drop the delta saved for the previous one
+        """
+        graph = self.folded()
+        self.graph_id = time.time_ns()
+        write_array_dir(
+            directory,
+            {name: getattr(graph, name) for name in ARRAY_NAMES},
+            {
+                "k": graph.k,
+                "num_docs": len(graph),
+                "num_base": graph.num_base,
+                "doc_ids_crc": doc_ids_checksum(base_doc_ids),
+                "graph_id": self.graph_id,
+            },
+        )
+        shutil.rmtree(delta_dir(directory), ignore_errors=True)
+
+    def save_delta(self, directory):
+        """Write the delta of a graph saved in `directory`"""
+        write_array_dir(
+            delta_dir(directory),
+            {name: getattr(self.delta, name) for name in DELTA_ARRAY_NAMES},
+            {
+                "graph_id": self.graph_id,
+                "num_docs": len(self.delta.doc_ids),
+                "num_rows": len(self.delta.rows),
+            },
+        )
+
+    @classmethod
+    def open(cls, directory, base_doc_ids):
+        """
+        Memory-map a saved graph, or None if there is none or it was built
+        for other embeddings than the rows of `base_doc_ids`.
+        """
+        directory = Path(directory)
+        try:
+            manifest = json.loads((directory / "manifest.json").read_text())
+        except FileNotFoundError:
+            return None
+        if manifest["doc_ids_crc"] != doc_ids_checksum(base_doc_ids):
+            print(f"kNN graph in {directory} is stale; searching for neighbours")
+            return None
+
+        arrays = {
+            name: np.load(directory / f"{name}.npy", mmap_mode="r")
+            for name in ARRAY_NAMES
+        }
+        graph = cls(
+            num_base=manifest["num_base"],
+            delta=_open_delta(delta_dir(directory), manifest.get("graph_id")),
+            **arrays,
+        )
+        graph.graph_id = manifest.get("graph_id")
+        return graph
+
+
+def delta_dir(directory):
+    """Where the delta of the graph saved in `directory` is kept"""
+    directory = Path(directory)
+    return directory.with_name(f"{directory.name}_delta")
+
+
+def _empty_delta(k, dim):
+    return GraphDelta(
+        np.empty(0, dtype=np.int64),
+        np.empty((0, dim), dtype=np.float32),
+        np.empty(0, dtype=np.int64),
+        np.empty((0, k), dtype=np.int32),
+        np.empty((0, k), dtype=np.float32),
+    )
+
+
+def _open_delta(directory, graph_id):
+    """The saved delta of graph `graph_id`, or None"""
+    try:
+        manifest = json.loads((directory / "manifest.json").read_text())
+    except FileNotFoundError:
+        return None
+    if graph_id is None or manifest["graph_id"] != graph_id:
+        # Left over from a graph since rebuilt or folded
+        return None
+    return GraphDelta(
+        *(np.load(directory / f"{name}.npy") for name in DELTA_ARRAY_NAMES)
+    )
+
+
+def _top_neighbors(queries, query_rows, matrices, k):
+    """
+    For each query vector (graph row `query_rows[i]`), the k best other rows
+    over `matrices`, a list of (first row, matrix): (rows, scores).
+    """
+    best_rows, best_scores = [], []
+    for first, matrix in matrices:
+        for start in range(0, len(matrix), COLUMN_BLOCK):
+            block = np.asarray(matrix[start : start + COLUMN_BLOCK], np.float32)
+            scores = queries @ block.T
+            # A document is not its own neighbour
+            local = query_rows - (first + start)
+            inside = (local >= 0) & (local < len(block))
+            scores[np.flatnonzero(inside), local[inside]] = -np.inf
+            top, top_scores = top_k_per_row(scores, k)
+            best_rows.append(top + first + start)
+            best_scores.append(top_scores)
+
+    rows = np.concatenate(best_rows, axis=1)
+    top, scores = top_k_per_row(np.concatenate(best_scores, axis=1), k)
+    return np.take_along_axis(rows, top, axis=1), scores
+
+
+def build_knn_graph(k=GRAPH_K, workers=None):
+    """Compute the neighbours of every embedded document and persist them"""
+    embeddings, doc_ids = open_embeddings()
+    start_time = time.time()
+    graph = KNNGraph.build(embeddings, doc_ids, k=k, workers=workers)
+    graph.save(KNN_DIR, doc_ids)
+    print(
+        f"✓ Built kNN graph: {graph.k} neighbours for {len(graph)} documents "
+        f"in {time.time() - start_time:.1f}s"
+    )
+    return graph
+
+
+def update_knn_graph(doc_ids, vectors):
+    """
+    Add newly embedded documents to the saved graph, if there is one that
+    matches the embedding store. Returns the updated graph or None.
+    """
+    with _update_lock:
+        embeddings, base_doc_ids = open_embeddings()
+        graph = KNNGraph.open(KNN_DIR, base_doc_ids)
+        if graph is None:
+            return None
+        start_time = time.time()
+        updated = graph.add(embeddings, doc_ids, vectors)
+        if updated is graph:
+            return graph
+        if len(updated.delta.rows) > DELTA_MAX_ROWS:
+            updated.save(KNN_DIR, base_doc_ids)
+        else:
+            updated.save_delta(KNN_DIR)
+        print(
+            f"✓ Added {len(updated) - len(graph)} documents to the kNN graph "
+            f"in {time.time() - start_time:.1f}s"
+        )
+        return updated
+
+
+def update_knn_graph_in_background(doc_ids, vectors):
+    """`update_knn_graph` in a thread; updates queue up on the lock"""
+
+    def _run():
+        try:
+            update_knn_graph(doc_ids, vectors)
+        except Exception as e:
+            print(f"kNN graph update failed: {e}")
+
+    threading.Thread(target=_run, name="knn-update", daemon=True).start()
+
+
+if __name__ == "__main__":
+    # python -m src.semantic.knn_graph [k] [workers]
+    build_knn_graph(
+        k=int(sys.argv[1]) if len(sys.argv) > 1 else GRAPH_K,
+        workers=int(sys.argv[2]) if len(sys.argv) > 2 else None,
+    )
@@ -0,0 +1,295 @@
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.semantic.ann import doc_ids_checksum, write_array_dir
+from src.semantic.encoder import EMB_DIR, open_embeddings
+
+QUANT_DIR = EMB_DIR / "quantized"
+
+# Candidates from the compressed pass re-scored with full-precision vectors
+DEFAULT_RERANK = 100
+
+# Product quantization: bytes per vector (384 dims -> 4-dim subvectors, 16x
+# smaller than float32) and centroids per subspace (one byte per code)
+PQ_SUBSPACES = 96
+PQ_CENTROIDS = 256
+PQ_TRAIN_SIZE = 65536
+PQ_ITERATIONS = 12
+
+# Rows per block when scoring or encoding, bounding temporaries
+SCORE_BLOCK = 65536
+
+
+class Int8Quantizer:
+    """
+    Scalar quantization: each dimension is mapped linearly from its
+    [min, max] onto 256 int8 levels, 4x smaller than float32.
+    Scores are computed asymmetrically (float query against int8 codes).
+    """
+
+    kind = "int8"
+    array_names = ("offset", "scale", "codes")
+
+    def __init__(self, offset, scale, codes):
+        self.offset = offset
+        self.scale = scale
+        self.codes = codes
+
+    @classmethod
+    def train(cls, embeddings):
+        low = np.full(embeddings.shape[1], np.inf, dtype=np.float32)
+        high = np.full(embeddings.shape[1], -np.inf, dtype=np.float32)
+        for i in range(0, len(embeddings), SCORE_BLOCK):
+            block = np.asarray(embeddings[i : i + SCORE_BLOCK], dtype=np.float32)
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        scale = np.maximum(high - low, 1e-12) / 255
+
+        codes = np.empty(embeddings.shape, dtype=np.int8)
+        for i in range(0, len(embeddings), SCORE_BLOCK):
+            block = np.asarray(embeddings[i : i + SCORE_BLOCK], dtype=np.float32)
+            codes[i : i + SCORE_BLOCK] = np.round((block - low) / scale) - 128
+        return cls(low, scale, codes)
+
+    def scores(self, vector):
+        # x ~ offset + scale * (code + 128), so x.q splits into a per-query
+        # constant plus code . (scale * q)
+        weights = (self.scale * vector).astype(np.float32)
+        constant = float(self.offset @ vector) + 128 * float(weights.sum())
+        return np.concatenate(
+            [
+                self.codes[i : i + SCORE_BLOCK].astype(np.float32) @ weights
+                for i in range(0, len(self.codes), SCORE_BLOCK)
+            ]
+        ) + np.float32(constant)
+
+
+class ProductQuantizer:
+    """
+    Product quantization: vectors are split into `m` subvectors, each
+    replaced by the id of its nearest of PQ_CENTROIDS k-means centroids
+    (one byte). A query scores codes with asymmetric distance computation:
+    a per-query table of subvector . centroid products, summed per code.
+    """
+
+    kind = "pq"
+    array_names = ("codebooks", "codes")
+
+    def __init__(self, codebooks, codes):
+        self.codebooks = codebooks  # (m, PQ_CENTROIDS, dims per subspace)
+        self.codes = codes  # (N, m) uint8
+
+    @classmethod
+    def train(cls, embeddings, m=PQ_SUBSPACES, seed=0):
+        num_docs, dim = embeddings.shape
+        if dim % m:
+            raise ValueError(f"{dim} dimensions do not split into {m} subspaces")
+        dsub = dim // m
+
+        rng = np.random.default_rng(seed)
+        sample_size = min(num_docs, PQ_TRAIN_SIZE)
+        sample = np.asarray(
+            embeddings[np.sort(rng.choice(num_docs, sample_size, replace=False))],
+            dtype=np.float32,
+        ).reshape(sample_size, m, dsub)
+
+        num_centroids = min(PQ_CENTROIDS, sample_size)
+        codebooks = np.empty((m, num_centroids, dsub), dtype=np.float32)
+        for j in range(m):
+            codebooks[j] = _kmeans(sample[:, j], num_centroids, rng)
+
+        quantizer = cls(codebooks, np.empty((num_docs, m), dtype=np.uint8))
+        for i in range(0, num_docs, SCORE_BLOCK):
+            block = np.asarray(embeddings[i : i + SCORE_BLOCK], dtype=np.float32)
+            quantizer.codes[i : i + SCORE_BLOCK] = quantizer.encode(block)
+        return quantizer
+
+    def encode(self, vectors):
+        m, _, dsub = self.codebooks.shape
+        sub = vectors.reshape(len(vectors), m, dsub)
+        codes = np.empty((len(vectors), m), dtype=np.uint8)
+        for j in range(m):
+            codes[:, j] = _nearest_l2(sub[:, j], self.codebooks[j])
+        return codes
+
+    def scores(self, vector):
+        m, num_centroids, dsub = self.codebooks.shape
+        table = np.einsum("mkd,md->mk", self.codebooks, vector.reshape(m, dsub))
+        # Flattened table: code c of subspace j is entry j * num_centroids + c
+        table = table.astype(np.float32).ravel()
+        base = np.arange(m, dtype=np.intp) * num_centroids
+        return np.concatenate(
+            [
+                table[self.codes[i : i + SCORE_BLOCK] + base].sum(axis=1)
+                for i in range(0, len(self.codes), SCORE_BLOCK)
+            ]
+        )
+
+
+QUANTIZERS = {q.kind: q for q in (Int8Quantizer, ProductQuantizer)}
+
+
+class QuantizedIndex:
+    """
+    Two-pass search: score all compressed codes (small enough to stay in the
+    page cache, shared by every process mapping them), keep the best
+    `rerank` candidates, then re-score those with full-precision vectors read
+    from the memory-mapped embedding matrix.
+    """
+
+    def __init__(self, quantizer):
+        self.quantizer = quantizer
+
+    @property
+    def bytes_per_vector(self):
+        return self.quantizer.codes[0].nbytes
+
+    def search(self, vector, k, full_vectors, rerank=DEFAULT_RERANK, exclude=None):
+        """Top-k rows by inner product: (rows, scores), best first"""
+        scores = self.quantizer.scores(vector)
+        if exclude is not None:
+            scores[exclude] = -np.inf
+
+        num_candidates = min(max(k, rerank), len(scores))
+        if num_candidates == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        rows = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+        if rerank:
+            # Sorted rows read the memory-mapped file front to back
+            rows = np.sort(rows)
+            scores = np.asarray(full_vectors[rows], dtype=np.float32) @ vector
+        else:
+            scores = scores[rows]
+        if exclude is not None:
+            keep = np.isfinite(scores) & ~exclude[rows]
+            rows, scores = rows[keep], scores[keep]
+
+        top = np.argsort(-scores, kind="stable")[:k]
+        return rows[top], scores[top]
+
+    def save(self, directory, doc_ids):
+        """Write the codes, tied to the embedding rows of `doc_ids`"""
+        write_array_dir(
+            directory,
+            {
+                name: getattr(self.quantizer, name)
+                for name in self.quantizer.array_names
+            },
+            {
+                "kind": self.quantizer.kind,
+                "num_docs": len(doc_ids),
+                "doc_ids_crc": doc_ids_checksum(doc_ids),
+            },
+        )
+
+    @classmethod
+    def open(cls, directory, doc_ids):
+        """
+        Memory-map saved codes, or None if there are none or they were built
+        for other embeddings than the rows of `doc_ids`.
+        """
+        directory = Path(directory)
+        try:
+            manifest = json.loads((directory / "manifest.json").read_text())
+        except FileNotFoundError:
+            return None
+        if manifest["doc_ids_crc"] != doc_ids_checksum(doc_ids):
+            print(f"Quantized codes in {directory} are stale; not using them")
+            return None
+
+        quantizer = QUANTIZERS[manifest["kind"]]
+        arrays = [
+            np.load(directory / f"{n}.npy", mmap_mode="r")
+            for n in quantizer.array_names
+        ]
+        return cls(quantizer(*arrays))
+
+
+def _kmeans(vectors, num_centroids, rng, iterations=PQ_ITERATIONS):
+    """Plain (L2) k-means; returns the centroids"""
+    centroids = vectors[rng.choice(len(vectors), num_centroids, replace=False)]
+    for _ in range(iterations):
+        assign = _nearest_l2(vectors, centroids)
+        counts = np.bincount(assign, minlength=num_centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        nonempty = counts > 0
+        centroids = centroids.copy()
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        empty = np.flatnonzero(~nonempty)
+        centroids[empty] = vectors[rng.choice(len(vectors), len(empty))]
+    return centroids
+
+
+def _nearest_l2(vectors, centroids):
+    # argmin |x - c|^2 = argmax (2 x.c - |c|^2)
+    return np.argmax(2 * vectors @ centroids.T - (centroids**2).sum(axis=1), axis=1)
+
+
+def build_quantized_index(kind="int8", **params):
+    """Quantize the saved embeddings and persist the codes"""
+    embeddings, doc_ids = open_embeddings()
+    start_time = time.time()
+    index = QuantizedIndex(QUANTIZERS[kind].train(embeddings, **params))
+    index.save(QUANT_DIR, doc_ids)
+    print(
+        f"✓ Built {kind} codes: {index.bytes_per_vector} bytes per vector "
+        f"({embeddings[0].nbytes / index.bytes_per_vector:.0f}x smaller) "
+        f"in {time.time() - start_time:.1f}s"
+    )
+    return index
+
+
+def benchmark_recall(
+    index, embeddings, k=10, reranks=(0, 20, 50, 100, 200), num_queries=200, seed=0
+):
+    """
+    Recall@k against exact search, per re-rank depth, with mean query latency
+    and the memory saving. Queries are embeddings of random documents.
+    """
+    rng = np.random.default_rng(seed)
+    num_queries = min(num_queries, len(embeddings))
+    queries = np.asarray(
+        embeddings[rng.choice(len(embeddings), num_queries, replace=False)],
+        dtype=np.float32,
+    )
+    exact = [set(np.argsort(-(embeddings @ q))[:k].tolist()) for q in queries]
+
+    results = {
+        "queries": num_queries,
+        "k": k,
+        "kind": index.quantizer.kind,
+        "compression": round(embeddings[0].nbytes / index.bytes_per_vector, 1),
+    }
+    for rerank in reranks:
+        start = time.perf_counter()
+        found = [
+            set(index.search(q, k, embeddings, rerank=rerank)[0].tolist())
+            for q in queries
+        ]
+        ms = (time.perf_counter() - start) * 1000 / num_queries
+        recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])
+        results[f"rerank={rerank}"] = {
+            "recall": round(float(recall), 4),
+            "ms": round(ms, 3),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    # python -m src.semantic.quantization build [int8|pq] [m] | bench [k]
+    command = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if command == "build":
+        kind = sys.argv[2] if len(sys.argv) > 2 else "int8"
+        params = {"m": int(sys.argv[3])} if len(sys.argv) > 3 else {}
+        build_quantized_index(kind, **params)
+    else:
+        embeddings, doc_ids = open_embeddings()
+        index = QuantizedIndex.open(QUANT_DIR, doc_ids) or build_quantized_index()
+        k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        for name, value in benchmark_recall(index, embeddings, k=k).items():
+            print(f"{name}: {value}")
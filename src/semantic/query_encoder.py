@@ -0,0 +1,164 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+from src.semantic.encoder import encode_texts
+
+# A batch is encoded once it holds this many queries...
+MAX_BATCH = 32
+# ...or once its first query has waited this long
+MAX_WAIT_MS = 5.0
+
+# Encoded queries remembered (least recently used are dropped first)
+QUERY_CACHE_SIZE = 4096
+
+
+def normalize_query(query):
+    """
+    Cache key of a query. The model lowercases its input, so case and
+    whitespace differences give the same embedding.
+    """
+    return " ".join(query.split()).lower()
+
+
+class QueryEncoder:
+    """
+    Encodes search queries for concurrent requests.
+
+    Callers block in `encode` / `encode_many`; queries that are not cached go
+    to a queue, and one background thread encodes whatever has arrived within
+    MAX_WAIT_MS (at most MAX_BATCH queries) with a single model call.
+    """
+
+    def __init__(
+        self,
+        encode=encode_texts,
+        max_batch=MAX_BATCH,
+        max_wait_ms=MAX_WAIT_MS,
+        cache_size=QUERY_CACHE_SIZE,
+    ):
+        self._encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "cache_hits": 0,
+            "batches": 0,
+            "encoded": 0,
+            "max_batch_size": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "total_encode_ms": 0.0,
+        }
+
+    def encode(self, query):
+        """Normalized embedding of one query"""
+        return self.encode_many([query])[0]
+
+    def encode_many(self, queries):
+        """Embeddings of `queries`, shape (len(queries), dim)"""
+        keys = [normalize_query(q) for q in queries]
+        vectors = {}
+        with self._cache_lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    vectors[key] = self._cache[key]
+
+        pending = {
+            key: self._submit(key) for key in dict.fromkeys(keys) if key not in vectors
+        }
+        with self._stats_lock:
+            self._stats["requests"] += len(keys)
+            self._stats["cache_hits"] += sum(key in vectors for key in keys)
+        for key, future in pending.items():
+            vectors[key] = future.result()
+        return np.stack([vectors[key] for key in keys])
+
+    def stats(self):
+        """Counters plus mean batch size and wait / encode times per batch"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        batches = max(stats["batches"], 1)
+        stats["mean_batch_size"] = round(stats["encoded"] / batches, 2)
+        stats["mean_wait_ms"] = round(stats.pop("total_wait_ms") / batches, 3)
+        stats["mean_encode_ms"] = round(stats.pop("total_encode_ms") / batches, 3)
+        stats["max_wait_ms"] = round(stats["max_wait_ms"], 3)
+        stats["cache_size"] = len(self._cache)
+        return stats
+
+    def _submit(self, key):
+        future = Future()
+        self._queue.put((key, future, time.perf_counter()))
+        if self._worker is None:
+            with self._worker_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(
+                        target=self._run, name="query-encoder", daemon=True
+                    )
+                    self._worker.start()
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    batch.append(
+                        self._queue.get(timeout=timeout)
+                        if timeout > 0
+                        else self._queue.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+            self._encode_batch(batch)
+
+    def _encode_batch(self, batch):
+        start = time.perf_counter()
+        # The same query may have been submitted by several requests
+        keys = list(dict.fromkeys(key for key, _, _ in batch))
+        try:
+            vectors = dict(zip(keys, self._encode(keys)))
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        with self._cache_lock:
+            for key, vector in vectors.items():
+                self._cache[key] = vector
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        for key, future, _ in batch:
+            future.set_result(vectors[key])
+
+        end = time.perf_counter()
+        wait_ms = (start - batch[0][2]) * 1000
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["encoded"] += len(keys)
+            self._stats["max_batch_size"] = max(
+                self._stats["max_batch_size"], len(keys)
+            )
+            self._stats["total_wait_ms"] += wait_ms
+            self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+            self._stats["total_encode_ms"] += (end - start) * 1000
+
+
+# Shared by every route that encodes queries
+query_encoder = QueryEncoder()
@@ -1,38 +1,110 @@
-from src.indexer import load_indices
-from src.semantic.vector_store import SemanticVectorStore
+from src.indexer import registry
+from src.result_cache import page, result_cache
+from src.semantic.query_encoder import normalize_query
+from src.semantic.vector_store import get_store
 
-# Load once (lazy initialization)
-store = None
 
+def semantic_search(
+    query: str,
+    top_k: int = 10,
+    include_text: bool = False,
+    nprobe: int | None = None,
+    exact: bool = False,
+):
+    return semantic_search_page(
+        query, top_k, include_text=include_text, nprobe=nprobe, exact=exact
+    )[0]
 
-def semantic_search(query: str, top_k: int = 10, include_text: bool = False):
-    global store
-    if store is None:
-        store = SemanticVectorStore()
 
-    # Compute similarity
-    results = store.cosine_top_k(store.query_to_vector(query), k=top_k)
+def semantic_search_page(
+    query: str,
+    top_k: int = 10,
+    include_text: bool = False,
+    nprobe: int | None = None,
+    exact: bool = False,
+    offset: int = 0,
+):
+    """
+    Results `offset` to `offset + top_k` of a semantic search, and the offset
+    of the next page (None after the last), from the result cache.
+    """
+    ranked = semantic_ranked(query, offset + top_k, nprobe=nprobe, exact=exact)
+    scored, next_offset = page(ranked, offset, top_k)
+    return _with_fields(scored, include_text), next_offset
 
-    # Load doc_map to return metadata
-    _, _, doc_map = load_indices()
 
-    final = []
-    for doc_id, score in results:
-        d = doc_map[doc_id]
-        title, body, site, date = d[1], d[2], d[3], d[4]
-        snippet = (body[:150] + "...") if len(body) > 150 else body
+def semantic_ranked(
+    query: str, depth: int, nprobe: int | None = None, exact: bool = False
+):
+    """
+    The semantic ranking of a query, at least `depth` deep, from the result
+    cache; entries are tied to the vector store version.
+    """
+    store = get_store()
+    return result_cache.ranked(
+        ("semantic", normalize_query(query), nprobe, exact, store.version),
+        depth,
+        lambda n: store.cosine_top_k(
+            store.query_to_vector(query), k=n, nprobe=nprobe, exact=exact
+        ),
+    )
+
+
+def semantic_top_k(
+    query: str, top_k: int = 10, nprobe: int | None = None, exact: bool = False
+):
+    """[(doc_id, score)] of the semantic top-k, without document fields"""
+    return page(semantic_ranked(query, top_k, nprobe=nprobe, exact=exact), 0, top_k)[0]
+
+
+def semantic_search_batch(
+    queries,
+    top_k: int = 10,
+    include_text: bool = False,
+    nprobe: int | None = None,
+    exact: bool = False,
+):
+    """
+    Semantic search for several queries at once: one encoder call and one
+    batched vector search. Returns one result list per query.
+    """
+    batch_results = semantic_top_k_batch(queries, top_k, nprobe=nprobe, exact=exact)
+    return [_with_fields(results, include_text) for results in batch_results]
+
 
+def semantic_top_k_batch(
+    queries, top_k: int = 10, nprobe: int | None = None, exact: bool = False
+):
+    """[(doc_id, score)] top-k lists for many queries, encoded and scored together"""
+    store = get_store()
+    return store.batch_cosine_top_k(
+        store.queries_to_vectors(queries), k=top_k, nprobe=nprobe, exact=exact
+    )
+
+
+def _with_fields(results, include_text=False):
+    """Result items for [(doc_id, score)], fetching only the fields they need"""
+    docs = registry.get().docs
+    fields = ("title", "snippet", "site", "date")
+    if include_text:
+        fields += ("body",)
+
+    items = []
+    for doc_id, score in results:
+        d = docs.get(doc_id, fields)
+        if d is None:
+            # Deleted since the vector store was published
+            continue
         item = {
             "doc_id": doc_id,
-            "title": title,
-            "snippet": snippet,
-            "site": site,
-            "date": date,
+            "title": d["title"],
+            "snippet": d["snippet"],
+            "site": d["site"],
+            "date": d["date"],
             "score": score,
         }
         if include_text:
-            item["text"] = body
-
-        final.append(item)
+            item["text"] = d["body"]
 
-    return final
+        items.append(item)
+    return items
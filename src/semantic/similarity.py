@@ -1,32 +1,28 @@
-from src.semantic.vector_store import SemanticVectorStore
-from src.indexer import load_indices
+from src.semantic.vector_store import get_store
+from src.indexer import registry
 
-store = None
 
-
-def similar_articles(doc_id: int, top_k: int = 5):
-    global store
-    if store is None:
-        store = SemanticVectorStore()
-
-    results = store.similar_to_doc(doc_id, k=top_k)
+def similar_articles(
+    doc_id: int, top_k: int = 5, nprobe: int | None = None, exact: bool = False
+):
+    results = get_store().similar_to_doc(doc_id, k=top_k, nprobe=nprobe, exact=exact)
 
     # Load doc metadata
-    _, _, doc_map = load_indices()
+    docs = registry.get().docs
 
     final = []
     for sim_id, score in results:
-        d = doc_map[sim_id]
-        title, body, site, date = d[1], d[2], d[3], d[4]
-        snippet = (body[:150] + "...") if len(body) > 150 else body
-
+        d = docs.get(sim_id)
+        if d is None:
+            # Deleted since the vector store was published
+            continue
         final.append(
             {
                 "doc_id": sim_id,
-                "title": title,
-                "snippet": snippet,
-                "site": site,
-                "date": date,
+                "title": d["title"],
+                "snippet": d["snippet"],
+                "site": d["site"],
+                "date": d["date"],
                 "similarity": score,
             }
         )
@@ -1,5 +1,6 @@
 from src.semantic.similarity import similar_articles
-from src.indexer import load_indices
+from src.indexer import registry
+from src.docstore import SNIPPET_CHARS
 from datetime import datetime
 
 
@@ -11,36 +12,49 @@ def parse_date(date_str):
         return None
 
 
-def build_story_timeline(doc_id: int, top_k: int = 8):
+def timeline_snippet(snippet):
+    """Timeline snippets always end in "...", even for short bodies."""
+    return snippet if len(snippet) > SNIPPET_CHARS else snippet + "..."
+
+
+def build_story_timeline(
+    doc_id: int, top_k: int = 8, nprobe: int | None = None, exact: bool = False
+):
     """
     Builds a chronological story timeline using similar articles.
     """
     # 1. Fetch article itself + similar articles
-    _, _, doc_map = load_indices()
+    docs = registry.get().docs
 
-    main_doc = doc_map.get(doc_id)
+    main_doc = docs.get(doc_id)
     if not main_doc:
         return {"error": "Invalid doc_id"}
 
-    main_title, main_body, main_site, main_date = main_doc[1], main_doc[2], main_doc[3], main_doc[4]
+    main_title, main_snippet, main_site, main_date = (
+        main_doc["title"],
+        main_doc["snippet"],
+        main_doc["site"],
+        main_doc["date"],
+    )
 
-    similar = similar_articles(doc_id, top_k)
+    similar = similar_articles(doc_id, top_k, nprobe=nprobe, exact=exact)
 
     # 2. Parse dates
     items = []
     for art in similar:
-        d = doc_map[art["doc_id"]]
-        title, body, site, date = d[1], d[2], d[3], d[4]
+        title, site, date = art["title"], art["site"], art["date"]
         parsed = parse_date(date)
 
-        items.append({
-            "doc_id": art["doc_id"],
-            "title": title,
-            "snippet": body[:150] + "...",
-            "site": site,
-            "date": date,
-            "parsed_date": parsed,
-        })
+        items.append(
+            {
+                "doc_id": art["doc_id"],
+                "title": title,
+                "snippet": timeline_snippet(art["snippet"]),
+                "site": site,
+                "date": date,
+                "parsed_date": parsed,
+            }
+        )
 
     # 3. Sort by date
     items = [i for i in items if i["parsed_date"] is not None]
@@ -72,7 +86,7 @@ def build_story_timeline(doc_id: int, top_k: int = 8):
             "title": main_title,
             "date": main_date,
             "site": main_site,
-            "snippet": main_body[:150] + "..."
+            "snippet": timeline_snippet(main_snippet),
         },
-        "timeline": output
+        "timeline": output,
     }
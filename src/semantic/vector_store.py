@@ -1,33 +1,463 @@
+import copy
+import os
+import threading
+
 import numpy as np
-from src.semantic.encoder import load_or_create_embeddings
+from src.indexer import registry
+from src.semantic.ann import (
+    ANN_DIR,
+    DEFAULT_NPROBE,
+    DocIdLookup,
+    IVFIndex,
+    top_k_per_row,
+)
+from src.semantic.encoder import embeddings_version, load_or_create_embeddings
+from src.semantic.knn_graph import KNN_DIR, KNNGraph, delta_dir
+from src.semantic.quantization import DEFAULT_RERANK, QUANT_DIR, QuantizedIndex
+from src.semantic.query_encoder import query_encoder
+
+# Rows scored per matrix product in exact search (times the query batch size
+# bounds the temporary score matrix)
+SEARCH_BLOCK = 16384
+
+# doc_ids looked up per call when comparing the store against the kNN graph
+LOOKUP_BLOCK = 1 << 20
+
+# With a candidate mask selecting at most this many rows, only those rows
+# are scored (exactly), whatever index exists
+EXACT_CANDIDATES = 50000
 
 
 class SemanticVectorStore:
-    def __init__(self):
-        self.embeddings, self.doc_ids, self.model = load_or_create_embeddings()
+    """
+    Embeddings of all searchable documents, as of one index version.
+
+    The base rows are the memory-mapped embedding store (`embeddings`, with
+    `base_ids`); embeddings of ingested index segments are small extra rows
+    after them (`extra`, with `extra_ids`). Everything sized by the corpus
+    is memory-mapped, so processes serving the same store share its pages.
+
+    A store is never modified once built: following a new index version or
+    kNN graph makes a new one, which `VectorStoreRegistry` swaps in with a
+    single assignment. A search that takes the store once per call therefore
+    never mixes rows, deletes or graphs of different versions.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        base_ids,
+        ann,
+        quantized,
+        embeddings_version,
+        extra=None,
+        extra_ids=None,
+        live=None,
+        index_version=None,
+        base_segment=None,
+        base_lookup=None,
+    ):
+        self.embeddings = embeddings
+        self.base_ids = base_ids
+        self.base_size = len(base_ids)
+        self._base_lookup = base_lookup or DocIdLookup(base_ids)
+        self.ann = ann
+        self.quantized = quantized
+        self.extra = embeddings[:0] if extra is None else extra
+        self.extra_ids = np.empty(0, np.int64) if extra_ids is None else extra_ids
+        self._extra_rows = {  # doc_id -> row, for the extra rows
+            doc_id: self.base_size + i
+            for i, doc_id in enumerate(self.extra_ids.tolist())
+        }
+        self.live = live  # bool mask over rows, None = all live
+        self.index_version = index_version
+        self.embeddings_version = embeddings_version
+        self.base_segment = base_segment
+        # (kNN graph or None, rows the graph does not hold yet)
+        self._graph = None, np.empty(0, dtype=np.intp)
+        self.graph_mtime = None
+
+    @classmethod
+    def load(cls):
+        """The embedding store on disk (generated if missing), with its indexes"""
+        # Read first: a store published meanwhile then triggers a reload
+        version = embeddings_version()
+        embeddings, base_ids = load_or_create_embeddings()
+        if version is None:
+            # Generated just now
+            version = embeddings_version()
+        store = cls(embeddings, base_ids, *_open_base_indices(base_ids), version)
+        return store.with_graph()
+
+    def __len__(self):
+        return self.base_size + len(self.extra_ids)
+
+    @property
+    def version(self):
+        """Version of the searchable vectors: (index version, embeddings version)"""
+        return self.index_version, self.embeddings_version
+
+    def row_of(self, doc_id):
+        """Row of doc_id in the store, or None"""
+        row = self._base_lookup.row(doc_id)
+        return self._extra_rows.get(doc_id) if row is None else row
 
-        # Map: doc_id -> index in embedding matrix
-        self.id_to_index = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+    def rows_of(self, doc_ids):
+        """Rows of `doc_ids`, -1 where absent"""
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        rows = self._base_lookup.rows(doc_ids)
+        for i in np.flatnonzero(rows < 0):
+            rows[i] = self._extra_rows.get(int(doc_ids[i]), -1)
+        return rows
+
+    def ids_of(self, rows):
+        """doc_ids of `rows` (int64 array)"""
+        rows = np.asarray(rows, dtype=np.intp)
+        in_base = rows < self.base_size
+        ids = np.empty(len(rows), dtype=np.int64)
+        ids[in_base] = self.base_ids[rows[in_base]]
+        ids[~in_base] = self.extra_ids[rows[~in_base] - self.base_size]
+        return ids
+
+    def synced(self, snapshot, emb_version):
+        """
+        The store following the index segments of `snapshot`: embeddings of
+        ingested segments become extra rows and deleted documents are masked
+        out. A full rebuild (new base segment) or a newly published embedding
+        store reloads from disk.
+        """
+        segments = snapshot.bm25
+        base = next((s.name for s in segments.segments if s.base), None)
+        reload = (
+            self.base_segment is not None and base != self.base_segment
+        ) or emb_version != self.embeddings_version
+        if reload:
+            embeddings, base_ids = load_or_create_embeddings()
+            store = SemanticVectorStore(
+                embeddings, base_ids, *_open_base_indices(base_ids), emb_version
+            )
+        else:
+            store = self
+
+        extra_ids = [np.empty(0, dtype=np.int64)]
+        parts = [store.embeddings[:0]]
+        for seg_doc_ids, path in segments.segment_embeddings():
+            # Freshly generated base embeddings may already cover the segment
+            new = store._base_lookup.rows(seg_doc_ids) < 0
+            parts.append(np.load(path)[new])
+            extra_ids.append(np.asarray(seg_doc_ids[new], dtype=np.int64))
+        extra_ids = np.concatenate(extra_ids)
+        deleted = segments.deleted_doc_ids()
+        live = np.ones(store.base_size + len(extra_ids), dtype=bool)
+        if len(deleted):
+            rows = store._base_lookup.rows(deleted)
+            live[rows[rows >= 0]] = False
+            live[store.base_size :] = ~np.isin(extra_ids, deleted)
+
+        synced = SemanticVectorStore(
+            store.embeddings,
+            store.base_ids,
+            store.ann,
+            store.quantized,
+            emb_version,
+            extra=np.concatenate(parts),
+            extra_ids=extra_ids,
+            live=None if live.all() else live,
+            index_version=snapshot.version,
+            base_segment=base,
+            base_lookup=store._base_lookup,
+        )
+        if reload:
+            return synced.with_graph()
+        return synced.with_graph(self._graph[0], self.graph_mtime)
+
+    def with_graph(self, graph=None, graph_mtime=None):
+        """
+        This store with a kNN graph: `graph` (opened at `graph_mtime`), or by
+        default the graph on disk
+        """
+        store = copy.copy(self)
+        if graph_mtime is None:
+            store.graph_mtime = _graph_mtime()
+            graph = KNNGraph.open(KNN_DIR, self.base_ids)
+        else:
+            store.graph_mtime = graph_mtime
+        store._graph = graph, store._uncovered_rows(graph)
+        return store
 
     def query_to_vector(self, query: str):
-        return self.model.encode([query], normalize_embeddings=True)[0]
+        return query_encoder.encode(query)
+
+    def queries_to_vectors(self, queries):
+        """Encode several queries (batched, cached): (len(queries), dim)"""
+        return query_encoder.encode_many(queries)
 
-    def cosine_top_k(self, vector, k=10):
-        scores = self.embeddings @ vector
-        top_idx = np.argsort(scores)[::-1][:k]
+    def vector(self, row):
+        if row < self.base_size:
+            return np.asarray(self.embeddings[row], dtype=np.float32)
+        return np.asarray(self.extra[row - self.base_size], dtype=np.float32)
 
-        return [(self.doc_ids[i], float(scores[i])) for i in top_idx]
+    def candidate_mask(self, doc_ids):
+        """Bool mask over rows selecting `doc_ids` (unknown ids are ignored)"""
+        mask = np.zeros(len(self), dtype=bool)
+        rows = self.rows_of(np.asarray(list(doc_ids), dtype=np.int64))
+        mask[rows[rows >= 0]] = True
+        return mask
 
-    def similar_to_doc(self, doc_id, k=5):
-        if doc_id not in self.id_to_index:
+    def cosine_top_k(self, vector, k=10, nprobe=None, exact=False, candidates=None):
+        """
+        Top-k (doc_id, score) by cosine similarity. Unless `exact` is set,
+        uses the ANN index (probing `nprobe` lists) or else the quantized
+        codes when either was built.
+        """
+        return self.batch_cosine_top_k(
+            vector[None], k, nprobe=nprobe, exact=exact, candidates=candidates
+        )[0]
+
+    def batch_cosine_top_k(
+        self, vectors, k=10, nprobe=None, exact=False, candidates=None
+    ):
+        """
+        `cosine_top_k` for a (num_queries, dim) matrix of query vectors: one
+        list of (doc_id, score) per query. Exact scoring reads the embeddings
+        once for the whole batch. `candidates` is an optional bool mask over
+        rows restricting which documents may be returned.
+        """
+        results = self._top_rows(
+            vectors, k, nprobe=nprobe, exact=exact, candidates=candidates
+        )
+        return [
+            list(zip(self.ids_of(rows).tolist(), np.asarray(scores).tolist()))
+            for rows, scores in results
+        ]
+
+    def similar_to_doc(self, doc_id, k=5, nprobe=None, exact=False):
+        idx = self.row_of(doc_id)
+        if idx is None:
             raise ValueError(f"doc_id {doc_id} not found")
 
-        idx = self.id_to_index[doc_id]
-        target_vec = self.embeddings[idx]
+        target_vec = self.vector(idx)
+
+        # Precomputed neighbours when the graph holds enough of them
+        found = self._graph_neighbors(idx, target_vec, k)
+        if found is None:
+            # exclude itself
+            ((rows, scores),) = self._top_rows(
+                target_vec[None], k, nprobe=nprobe, exact=exact, skip=[idx]
+            )
+        else:
+            rows, scores = found
+        return list(zip(self.ids_of(rows).tolist(), np.asarray(scores).tolist()))
+
+    def _uncovered_rows(self, graph):
+        """Rows the kNN graph has no entry for"""
+        if graph is None:
+            return np.empty(0, dtype=np.intp)
+        # In blocks: the base ids may be far larger than memory should hold
+        uncovered = [
+            start
+            + np.flatnonzero(
+                graph.rows(self.base_ids[start : start + LOOKUP_BLOCK]) < 0
+            )
+            for start in range(0, self.base_size, LOOKUP_BLOCK)
+        ]
+        uncovered.append(
+            self.base_size + np.flatnonzero(graph.rows(self.extra_ids) < 0)
+        )
+        return np.concatenate(uncovered).astype(np.intp)
+
+    def _graph_neighbors(self, idx, vector, k):
+        """
+        The k best live neighbours of row `idx` from the kNN graph, plus
+        rows added since the graph was updated (scored directly), as
+        (rows, scores); None if the graph cannot answer.
+        """
+        graph, uncovered = self._graph
+        if graph is None or k > graph.k:
+            return None
+        found = graph.neighbors_of(int(self.ids_of([idx])[0]))
+        if found is None:
+            return None
+
+        neighbor_ids, scores = found
+        rows = self.rows_of(neighbor_ids)
+        keep = rows >= 0
+        if self.live is not None:
+            keep[keep] = self.live[rows[keep]]
+        if keep.sum() < k:
+            # Too many neighbours deleted: the answer may lie past the graph's k
+            return None
+
+        others = uncovered[uncovered != idx]
+        rows = np.concatenate([rows[keep], others])
+        scores = np.concatenate(
+            [np.asarray(scores, np.float32)[keep], self._gather(others) @ vector]
+        )
+        if self.live is not None:
+            scores[~self.live[rows]] = -np.inf
+        top = np.argsort(-scores, kind="stable")[:k]
+        return rows[top], scores[top]
+
+    def _top_rows(
+        self, vectors, k, nprobe=None, exact=False, candidates=None, skip=None
+    ):
+        """
+        Best k live rows per query vector: a list of (rows, scores), highest
+        first. `skip` optionally gives one row per query to leave out.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        dead = None if self.live is None else ~self.live
+        if candidates is not None:
+            dead = ~candidates if dead is None else dead | ~candidates
+        # One extra hit per query leaves room for dropping its skipped row
+        k_search = k + (skip is not None)
+
+        if candidates is not None and candidates.sum() <= EXACT_CANDIDATES:
+            # Few candidates: score just those rows instead of the whole store
+            rows = np.flatnonzero(~dead)
+            top, scores = top_k_per_row(vectors @ self._gather(rows).T, k_search)
+            results = list(zip(rows[top], scores))
+        elif exact or (self.ann is None and self.quantized is None):
+            results = self._exact_top_rows(vectors, k_search, dead)
+        else:
+            base_dead = None if dead is None else dead[: self.base_size]
+            if self.ann is not None:
+                nprobe = DEFAULT_NPROBE if nprobe is None else nprobe
+                results = [
+                    self.ann.search(v, k_search, nprobe=nprobe, exclude=base_dead)
+                    for v in vectors
+                ]
+            else:
+                results = [
+                    self.quantized.search(
+                        v,
+                        k_search,
+                        self.embeddings,
+                        rerank=DEFAULT_RERANK,
+                        exclude=base_dead,
+                    )
+                    for v in vectors
+                ]
+            if len(self.extra):
+                # Rows of ingested segments are few: score them exactly
+                extra = self._exact_top_rows(
+                    vectors, k_search, dead, matrices=[(self.base_size, self.extra)]
+                )
+                results = [_merge_top(a, b, k_search) for a, b in zip(results, extra)]
+
+        if skip is not None:
+            results = [
+                (rows[rows != s][:k], scores[rows != s][:k])
+                for (rows, scores), s in zip(results, skip)
+            ]
+        return results
+
+    def _exact_top_rows(self, vectors, k, dead, matrices=None):
+        """
+        Exact top-k per query over all rows (or the given (first row, matrix)
+        parts), scoring SEARCH_BLOCK rows at a time for the whole batch and
+        keeping each block's best k per query.
+        """
+        if matrices is None:
+            matrices = [(0, self.embeddings), (self.base_size, self.extra)]
+
+        best_rows, best_scores = [], []
+        for offset, matrix in matrices:
+            for start in range(0, len(matrix), SEARCH_BLOCK):
+                block = np.asarray(matrix[start : start + SEARCH_BLOCK], np.float32)
+                scores = vectors @ block.T
+                first = offset + start
+                if dead is not None:
+                    scores[:, dead[first : first + len(block)]] = -np.inf
+                top, scores = top_k_per_row(scores, k)
+                best_rows.append(top + first)
+                best_scores.append(scores)
+
+        if not best_rows:
+            empty = np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+            return [empty] * len(vectors)
+        rows = np.concatenate(best_rows, axis=1)
+        top, scores = top_k_per_row(np.concatenate(best_scores, axis=1), k)
+        rows = np.take_along_axis(rows, top, axis=1)
+        return [(r[np.isfinite(s)], s[np.isfinite(s)]) for r, s in zip(rows, scores)]
+
+    def _gather(self, rows):
+        """Embeddings of the given rows (ascending), as float32"""
+        split = np.searchsorted(rows, self.base_size)
+        return np.concatenate(
+            [
+                np.asarray(self.embeddings[rows[:split]], dtype=np.float32),
+                np.asarray(self.extra[rows[split:] - self.base_size], np.float32),
+            ]
+        )
+
+
+class VectorStoreRegistry:
+    """
+    The current SemanticVectorStore of this process, created on first use.
+    Like the index registry, a new version is built aside and swapped in with
+    a single assignment; readers keep the store they took.
+    """
+
+    def __init__(self):
+        self._store = None
+        self._lock = threading.Lock()
+
+    def get(self, snapshot):
+        """The store, first brought in step with the index `snapshot`"""
+        store = self._store
+        if store is None:
+            with self._lock:
+                if self._store is None:
+                    self._store = SemanticVectorStore.load()
+                store = self._store
+
+        version = (snapshot.version, embeddings_version())
+        graph_mtime = _graph_mtime()
+        if version == store.version and graph_mtime == store.graph_mtime:
+            return store
+        with self._lock:
+            store = self._store
+            if version != store.version:
+                store = store.synced(snapshot, version[1])
+            if _graph_mtime() != store.graph_mtime:
+                # The kNN graph was rebuilt or extended on disk
+                store = store.with_graph()
+            self._store = store
+        return store
+
+
+vector_stores = VectorStoreRegistry()
+
+
+def get_store():
+    """
+    The process-wide vector store shared by all semantic routes, in step
+    with the index registry. Take it once per request: the next call may
+    return a newer store.
+    """
+    return vector_stores.get(registry.get())
+
+
+def _open_base_indices(doc_ids):
+    """ANN index / compressed codes over the base rows, where built"""
+    return IVFIndex.open(ANN_DIR, doc_ids), QuantizedIndex.open(QUANT_DIR, doc_ids)
+
 
-        scores = self.embeddings @ target_vec
-        scores[idx] = -1  # exclude itself
+def _graph_mtime():
+    """Modification times of the kNN graph and of its delta (None if absent)"""
+    mtimes = []
+    for directory in (KNN_DIR, delta_dir(KNN_DIR)):
+        try:
+            mtimes.append(os.stat(directory / "manifest.json").st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return tuple(mtimes)
 
-        top_idx = np.argsort(scores)[::-1][:k]
 
-        return [(self.doc_ids[i], float(scores[i])) for i in top_idx]
+def _merge_top(a, b, k):
+    """Merge two (rows, scores) results into the best k"""
+    rows = np.concatenate([a[0], b[0]])
+    scores = np.concatenate([a[1], b[1]])
+    top = np.argsort(-scores, kind="stable")[:k]
+    return rows[top], scores[top]
@@ -0,0 +1,102 @@
+import argparse
+import os
+import time
+from pathlib import Path
+
+import uvicorn
+
+from src.indexer import INDICES_DIR, ensure_indices, index_version
+from src.segments import read_commit
+from src.semantic.encoder import EMB_DIR
+from src.sharding import ShardCoordinator
+
+# Bytes read per call when pulling index files into the page cache
+WARM_CHUNK = 16 << 20
+
+
+def shared_files():
+    """
+    Files every worker memory-maps: the segments of the current commit and
+    the semantic store (embeddings, ANN index, quantized codes, kNN graph).
+    """
+    files = []
+    for spec in read_commit(INDICES_DIR, index_version()):
+        files.extend(p for p in (INDICES_DIR / spec["name"]).rglob("*") if p.is_file())
+    if EMB_DIR.exists():
+        files.extend(
+            p
+            for p in EMB_DIR.rglob("*")
+            if p.is_file() and p.suffix == ".npy" and "build" not in p.parts
+        )
+    return files
+
+
+def warm_page_cache(files):
+    """
+    Read `files` once so their pages are resident before workers start. The
+    workers map the same files read-only and share these pages instead of
+    each loading a private copy.
+    """
+    start_time = time.time()
+    total = 0
+    for path in files:
+        with open(path, "rb", buffering=0) as f:
+            while chunk := f.read(WARM_CHUNK):
+                total += len(chunk)
+    print(
+        f"✓ Warmed {len(files)} index files ({total / 2**20:.0f} MB) "
+        f"in {time.time() - start_time:.1f}s"
+    )
+
+
+def process_memory(pid="self"):
+    """
+    Memory of a process in MB from /proc (Linux): rss counts shared pages in
+    full, pss splits them between the processes mapping them, and private
+    is what this process alone holds. Empty where /proc is unavailable.
+    """
+    try:
+        text = Path(f"/proc/{pid}/smaps_rollup").read_text()
+    except OSError:
+        return {}
+    fields = {}
+    for line in text.splitlines()[1:]:
+        name, value = line.split(":", 1)
+        fields[name] = int(value.split()[0]) / 1024  # kB -> MB
+    return {
+        "rss_mb": round(fields.get("Rss", 0), 1),
+        "pss_mb": round(fields.get("Pss", 0), 1),
+        "shared_mb": round(
+            fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0), 1
+        ),
+        "private_mb": round(
+            fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0), 1
+        ),
+    }
+
+
+def serve(host="0.0.0.0", port=8000, workers=None, warm=True):
+    """
+    Multi-worker serving. The supervisor builds whatever is missing and warms
+    the page cache once; then uvicorn starts `workers` processes that each
+    map the same files read-only, so adding a worker costs its interpreter
+    and small per-process state, not another copy of the indices.
+    """
+    workers = workers or os.cpu_count() or 1
+    if ShardCoordinator.from_env() is None:
+        # A shard coordinator (SHARDS set) holds no corpus of its own
+        ensure_indices()
+        if warm:
+            warm_page_cache(shared_files())
+    uvicorn.run("src.main:app", host=host, port=port, workers=workers)
+
+
+if __name__ == "__main__":
+    # python -m src.serve [--workers N] [--port 8000] [--no-warm]
+    parser = argparse.ArgumentParser(description="Serve the search API")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-warm", action="store_true")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, warm=not args.no_warm)
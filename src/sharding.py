@@ -0,0 +1,372 @@
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import httpx
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, HTTPException, Query
+from pydantic import BaseModel, Field
+
+from src.data_loader import get_doc_ids, iter_docs
+from src.execution import lanes
+from src.indexer import build_bm25, registry
+from src.search import bm25_top_k
+from src.segments import (
+    collection_stats,
+    open_commit,
+    remove_unreferenced,
+    write_commit,
+    write_segment,
+)
+from src.semantic.encoder import load_or_create_embeddings
+from src.semantic.vector_store import get_store
+
+SHARDS_DIR = Path("shards")
+MANIFEST_PATH = SHARDS_DIR / "manifest.json"
+
+# Shard i of a local deployment listens on SHARD_BASE_PORT + i
+SHARD_BASE_PORT = 9100
+
+# Seconds the coordinator waits for a shard before answering without it
+SHARD_TIMEOUT = float(os.getenv("SHARD_TIMEOUT", "2.0"))
+
+# Embedding rows copied into a shard's store at a time
+COPY_BLOCK = 65536
+
+# Results a shard returns per query, and so how deep the coordinator can page
+SHARD_MAX_DEPTH = 1000
+
+RESULT_FIELDS = ("title", "snippet", "site", "date")
+
+
+def shard_dir(shard):
+    return SHARDS_DIR / f"shard_{shard}"
+
+
+def build_shards(num_shards, workers=None):
+    """
+    Partition the corpus by doc_id range into `num_shards` shards, each with
+    its own BM25 index (under shards/shard_<i>/indices) and slice of the
+    embedding store (shards/shard_<i>/semantic_store).
+
+    Shards are first indexed on their own; their postings are then re-scored
+    with idf and average length over all shards together. The idf floor is
+    averaged in the same term order as a single index build, so a document
+    scores exactly as in a single index and shard top-k lists can be merged
+    by score.
+    """
+    workers = workers or os.cpu_count() or 1
+    doc_ids = get_doc_ids()
+    shard_size = max(1, -(-len(doc_ids) // num_shards))
+    ranges = [
+        (doc_ids[start], doc_ids[min(start + shard_size, len(doc_ids)) - 1])
+        for start in range(0, len(doc_ids), shard_size)
+    ]
+    embeddings, embedding_ids = load_or_create_embeddings()
+
+    start_time = time.time()
+    idf_orders = []
+    for shard, (first, last) in enumerate(ranges):
+        print(f"Building shard {shard} (doc_ids {first}-{last})...")
+        ids = doc_ids[shard * shard_size : (shard + 1) * shard_size]
+        directory = shard_dir(shard)
+        bm25 = build_bm25(ids, workers)
+        idf_orders.append(bm25.idf_order)
+        _publish_shard(directory / "indices", bm25, (first, last))
+        del bm25
+        _write_embedding_slice(
+            directory / "semantic_store", embeddings, embedding_ids, first, last
+        )
+
+    print("Binding global statistics...")
+    indexes = [
+        open_commit(
+            shard_dir(shard) / "indices",
+            (shard_dir(shard) / "indices" / "CURRENT").read_text().strip(),
+        )[0]
+        for shard in range(len(ranges))
+    ]
+    bm25s = [index.segments[0].bm25 for index in indexes]
+    idfs, avgdl = collection_stats(bm25s, idf_orders)
+    for shard, (bm25, idf) in enumerate(zip(bm25s, idfs)):
+        _publish_shard(
+            shard_dir(shard) / "indices", bm25.with_stats(idf, avgdl), ranges[shard]
+        )
+
+    MANIFEST_PATH.write_text(
+        json.dumps(
+            {
+                "num_shards": len(ranges),
+                "ranges": ranges,
+                "num_docs": len(doc_ids),
+                "avgdl": avgdl,
+            },
+            indent=2,
+        )
+    )
+    print(f"✓ Built {len(ranges)} shards in {time.time() - start_time:.1f}s")
+    return ranges
+
+
+def _publish_shard(directory, bm25, doc_id_range):
+    """Write a shard's index as its only segment"""
+    directory.mkdir(parents=True, exist_ok=True)
+    spec = write_segment(directory, bm25, iter_docs(doc_id_range), base=True)
+    write_commit(directory, [spec])
+    remove_unreferenced(directory, 1)
+
+
+def _write_embedding_slice(directory, embeddings, embedding_ids, first, last):
+    """Copy the embedding rows of doc_ids [first, last] into a shard's store"""
+    directory.mkdir(parents=True, exist_ok=True)
+    rows = np.flatnonzero((embedding_ids >= first) & (embedding_ids <= last))
+    tmp_path = directory / "embeddings.tmp.npy"
+    out = np.lib.format.open_memmap(
+        tmp_path,
+        mode="w+",
+        dtype=embeddings.dtype,
+        shape=(len(rows), embeddings.shape[1]),
+    )
+    for start in range(0, len(rows), COPY_BLOCK):
+        block = rows[start : start + COPY_BLOCK]
+        out[start : start + len(block)] = embeddings[block]
+    out.flush()
+    del out
+    np.save(directory / "doc_ids.tmp.npy", np.asarray(embedding_ids[rows], np.int64))
+    os.replace(directory / "doc_ids.tmp.npy", directory / "doc_ids.npy")
+    os.replace(tmp_path, directory / "embeddings.npy")
+
+
+# Shard server: one per shard process, run from inside the shard directory so
+# the usual relative paths (indices/, semantic_store/) resolve to the shard
+
+shard_app = FastAPI(title="News Search Shard")
+
+
+@shard_app.on_event("startup")
+async def _load_shard():
+    registry.load()
+
+
+@shard_app.on_event("shutdown")
+async def _stop_shard():
+    for lane in lanes.values():
+        lane.shutdown()
+
+
+def _with_fields(scored):
+    docs = registry.get().docs
+    results = []
+    for doc_id, score in scored:
+        fields = docs.get(doc_id, RESULT_FIELDS)
+        if fields is not None:
+            results.append({"doc_id": doc_id, "score": score, **fields})
+    return results
+
+
+def _shard_bm25(q, top_k, exhaustive):
+    return _with_fields(bm25_top_k(q, top_k, exhaustive))
+
+
+def _shard_vector_search(vector, top_k, nprobe, exact):
+    store = get_store()
+    return _with_fields(
+        store.cosine_top_k(
+            np.asarray(vector, dtype=np.float32), k=top_k, nprobe=nprobe, exact=exact
+        )
+    )
+
+
+@shard_app.get("/shard/search")
+async def shard_search(
+    q: str, top_k: int = Query(10, ge=1, le=SHARD_MAX_DEPTH), exhaustive: bool = False
+):
+    """This shard's BM25 top-k, scored with the global statistics"""
+    return {"results": await lanes["search"].run(_shard_bm25, q, top_k, exhaustive)}
+
+
+class ShardVectorRequest(BaseModel):
+    vector: List[float]
+    top_k: int = Field(10, ge=1, le=SHARD_MAX_DEPTH)
+    nprobe: Optional[int] = Field(None, ge=1)
+    exact: bool = False
+
+
+@shard_app.post("/shard/semantic_search")
+async def shard_semantic_search(req: ShardVectorRequest):
+    """This shard's cosine top-k for a query vector encoded by the coordinator"""
+    results = await lanes["semantic"].run(
+        _shard_vector_search, req.vector, req.top_k, req.nprobe, req.exact
+    )
+    return {"results": results}
+
+
+@shard_app.get("/shard/health")
+async def shard_health():
+    snapshot = registry.get()
+    return {
+        "status": "ok",
+        "version": snapshot.version,
+        "num_docs": snapshot.bm25.num_docs,
+    }
+
+
+def serve_shard(shard, port=None, host="127.0.0.1"):
+    """Serve one shard (blocking)"""
+    os.chdir(shard_dir(shard))
+    uvicorn.run(shard_app, host=host, port=port or SHARD_BASE_PORT + shard)
+
+
+def start_local_shards(num_shards=None, base_port=SHARD_BASE_PORT):
+    """
+    Start a shard server process per built shard: (processes, base URLs).
+    Pass the URLs to the coordinator through SHARDS=url,url,...
+    """
+    if num_shards is None:
+        num_shards = json.loads(MANIFEST_PATH.read_text())["num_shards"]
+    processes, urls = [], []
+    for shard in range(num_shards):
+        port = base_port + shard
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "src.sharding",
+                    "serve",
+                    str(shard),
+                    "--port",
+                    str(port),
+                ]
+            )
+        )
+        urls.append(f"http://127.0.0.1:{port}")
+    return processes, urls
+
+
+class ShardCoordinator:
+    """
+    Scatter-gather over shard servers.
+
+    A query goes to every shard at once; each shard returns its own top-k
+    with document fields, and the lists are merged by score. Shards score
+    with the same collection statistics, so their scores are comparable.
+    A shard that errors or has not answered within `timeout` seconds is left
+    out: the answer is then partial and names the missing shards. Only when
+    no shard answers is the request failed (503).
+    """
+
+    def __init__(self, urls, timeout=SHARD_TIMEOUT):
+        self.urls = [url.rstrip("/") for url in urls]
+        self.timeout = timeout
+        self._client = None
+        self.failures = [0] * len(self.urls)
+
+    @classmethod
+    def from_env(cls):
+        """Coordinator for the shard URLs in SHARDS, or None when unset"""
+        urls = [url for url in os.getenv("SHARDS", "").split(",") if url.strip()]
+        return cls([url.strip() for url in urls]) if urls else None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        return self._client
+
+    async def _call(self, shard, method, path, **kwargs):
+        response = await asyncio.wait_for(
+            self.client.request(method, self.urls[shard] + path, **kwargs),
+            self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def _gather(self, top_k, method, path, **kwargs):
+        """Merged top-k over all shards and the shards that did not answer"""
+        answers = await asyncio.gather(
+            *(self._call(i, method, path, **kwargs) for i in range(len(self.urls))),
+            return_exceptions=True,
+        )
+        results, failed = [], []
+        for shard, answer in enumerate(answers):
+            if isinstance(answer, Exception):
+                self.failures[shard] += 1
+                failed.append(shard)
+                print(f"Shard {shard} failed: {answer!r}")
+            else:
+                results.extend(answer["results"])
+        if len(failed) == len(self.urls):
+            raise HTTPException(status_code=503, detail="No shard answered")
+        merged = heapq.nsmallest(
+            top_k, results, key=lambda r: (-r["score"], r["doc_id"])
+        )
+        return merged, failed
+
+    async def search(self, q, top_k=10, exhaustive=False):
+        return await self._gather(
+            top_k,
+            "GET",
+            "/shard/search",
+            params={"q": q, "top_k": top_k, "exhaustive": exhaustive},
+        )
+
+    async def semantic_search(self, vector, top_k=10, nprobe=None, exact=False):
+        body = {"vector": np.asarray(vector).tolist(), "top_k": top_k, "exact": exact}
+        if nprobe is not None:
+            body["nprobe"] = nprobe
+        return await self._gather(top_k, "POST", "/shard/semantic_search", json=body)
+
+    async def health(self):
+        answers = await asyncio.gather(
+            *(self._call(i, "GET", "/shard/health") for i in range(len(self.urls))),
+            return_exceptions=True,
+        )
+        return [
+            {
+                "shard": shard,
+                "url": url,
+                "failures": self.failures[shard],
+                **(
+                    {"status": "down", "error": repr(answer)}
+                    if isinstance(answer, Exception)
+                    else answer
+                ),
+            }
+            for shard, (url, answer) in enumerate(zip(self.urls, answers))
+        ]
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+if __name__ == "__main__":
+    # python -m src.sharding build N | serve I [--port P] | start [N]
+    parser = argparse.ArgumentParser(description="Sharded deployment")
+    parser.add_argument("command", choices=["build", "serve", "start"])
+    parser.add_argument("shards", type=int, nargs="?", default=None)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_shards(args.shards or 2, workers=args.workers)
+    elif args.command == "serve":
+        serve_shard(args.shards or 0, port=args.port)
+    else:
+        processes, urls = start_local_shards(args.shards)
+        print(
+            f"✓ Started {len(processes)} shards; run the API with SHARDS={','.join(urls)}"
+        )
+        for process in processes:
+            process.wait()
@@ -0,0 +1,49 @@
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from src.analysis import analyzer
+from src.bm25 import BM25Index, build_partial, merge_partials
+
+
+def _corpus(num_docs=120, seed=1):
+    rng = np.random.default_rng(seed)
+    words = [f"w{i}" for i in range(300)]
+    # Skewed word frequencies: common words get a negative (floored) idf
+    weights = 1.0 / np.arange(1, len(words) + 1)
+    weights /= weights.sum()
+    return [
+        " ".join(rng.choice(words, rng.integers(5, 60), p=weights))
+        for _ in range(num_docs)
+    ]
+
+
+def _index(texts, partial_size=17):
+    """Native index built like build_indices does: partials, then a merge"""
+    partials = []
+    for start in range(0, len(texts), partial_size):
+        vocab = {}
+        chunk = texts[start : start + partial_size]
+        term_vectors = [analyzer.term_vector(text, vocab) for text in chunk]
+        doc_ids = list(range(start, start + len(chunk)))
+        partials.append(build_partial(term_vectors, vocab, doc_ids, start))
+    return merge_partials(partials)
+
+
+QUERIES = ["w0", "w1 w7 w120", "w3 w3 w250", "w299 nosuchword w2", "w5 w0 w11 w42"]
+
+
+def test_native_scores_match_bm25okapi_bit_for_bit():
+    texts = _corpus()
+    okapi = BM25Okapi([analyzer.tokenize(text) for text in texts])
+    indexes = [_index(texts), BM25Index.from_okapi(okapi, list(range(len(texts))))]
+    assert (np.diff(indexes[0].offsets) > len(texts) / 2).any()
+
+    for query in QUERIES:
+        expected = okapi.get_scores(analyzer.tokenize(query))
+        for index in indexes:
+            docs, scores = index.score(analyzer.query_term_ids(query, index.vocab))
+            assert scores.tolist() == expected[docs].tolist()
+            # Documents matching no query term score 0 in BM25Okapi
+            unmatched = np.ones(len(texts), dtype=bool)
+            unmatched[docs] = False
+            assert not expected[unmatched].any()
@@ -0,0 +1,46 @@
+import numpy as np
+
+from src.analysis import analyzer
+from src.bm25 import BLOCK_SIZE, build_partial, merge_partials
+
+
+def _index(texts, partial_size=50):
+    """Native index built like build_indices does: partials, then a merge"""
+    partials = []
+    for start in range(0, len(texts), partial_size):
+        vocab = {}
+        chunk = texts[start : start + partial_size]
+        term_vectors = [analyzer.term_vector(text, vocab) for text in chunk]
+        doc_ids = list(range(1000 + start, 1000 + start + len(chunk)))
+        partials.append(build_partial(term_vectors, vocab, doc_ids, start))
+    return merge_partials(partials)
+
+
+def test_pruned_exhaustive_and_batch_top_k_agree():
+    rng = np.random.default_rng(2)
+    words = [f"w{i}" for i in range(500)]
+    weights = 1.0 / np.arange(1, len(words) + 1)
+    weights /= weights.sum()
+    texts = [
+        " ".join(rng.choice(words, rng.integers(5, 80), p=weights)) for _ in range(600)
+    ]
+    index = _index(texts)
+    # Common terms span many blocks, so pruning has blocks to skip
+    assert np.diff(index.offsets).max() > 4 * BLOCK_SIZE
+
+    queries = [
+        analyzer.query_term_ids(" ".join(rng.choice(words, n, p=weights)), index.vocab)
+        for n in rng.integers(1, 6, 40)
+    ]
+    # Pruning skips documents: fewer are fully scored than match the query
+    scored = sum(index.top_k_pruned(term_ids, 10)[1] for term_ids in queries)
+    assert scored < sum(len(index.score(term_ids)[0]) for term_ids in queries)
+
+    for k in (1, 10, 100):
+        batch = index.top_k_batch(queries, k)
+        for term_ids, batch_top in zip(queries, batch):
+            exhaustive = index.top_k(term_ids, k, exhaustive=True)
+            pruned = index.top_k(term_ids, k)
+            assert pruned == exhaustive
+            assert [d for d, _ in batch_top] == [d for d, _ in exhaustive]
+            assert np.allclose([s for _, s in batch_top], [s for _, s in exhaustive])
@@ -0,0 +1,33 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from src.indexer import IndexRegistry
+
+
+def test_reload_requested_during_reload_loads_latest_version(monkeypatch):
+    """A commit landing while a reload runs is loaded right after it"""
+    registry = IndexRegistry()
+    on_disk = {"version": 1}
+    loading = threading.Event()
+    release = threading.Event()
+
+    def load_snapshot():
+        version = on_disk["version"]
+        loading.set()
+        release.wait(5)
+        return SimpleNamespace(version=version)
+
+    monkeypatch.setattr(registry, "_load_snapshot", load_snapshot)
+    registry._snapshot = SimpleNamespace(version=0)
+
+    registry.reload_in_background()
+    assert loading.wait(5)
+    on_disk["version"] = 2
+    registry.reload_in_background()
+    release.set()
+
+    deadline = time.time() + 5
+    while registry.get().version != 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert registry.get().version == 2
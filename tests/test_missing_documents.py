@@ -0,0 +1,103 @@
+"""
+Document ids from the vector store (and from shards) are published apart
+from the registry's DocStore, so a document can be deleted after it was
+retrieved and before its fields are read. Such results are skipped.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src import hybrid
+from src.indexer import registry
+from src.result_cache import result_cache
+from src.semantic import semantic_search, similarity
+from src.semantic.timeline import build_story_timeline
+
+DELETED = 2
+
+
+class FakeDocs:
+    def __init__(self):
+        self.records = {
+            doc_id: {
+                "title": f"Article {doc_id}",
+                "snippet": f"Body of article {doc_id}",
+                "site": "example.com",
+                "date": f"2024-01-0{doc_id}",
+                "body": f"Body of article {doc_id}",
+            }
+            for doc_id in (1, 2, 3)
+        }
+
+    def delete(self, doc_id):
+        del self.records[doc_id]
+
+    def get(self, doc_id, fields=("title", "snippet", "site", "date")):
+        record = self.records.get(doc_id)
+        if record is None:
+            return None
+        return {f: record[f] for f in fields}
+
+
+class FakeStore:
+    """Returns every document, deleting one before handing the ids back"""
+
+    version = ("test", 0)
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def _retrieve(self, doc_ids):
+        results = [(doc_id, 1.0 / doc_id) for doc_id in doc_ids]
+        self.docs.delete(DELETED)
+        return results
+
+    def query_to_vector(self, query):
+        return None
+
+    def cosine_top_k(self, vector, k=10, nprobe=None, exact=False):
+        return self._retrieve([1, 2, 3])[:k]
+
+    def similar_to_doc(self, doc_id, k=5, nprobe=None, exact=False):
+        return self._retrieve([d for d in (1, 2, 3) if d != doc_id])[:k]
+
+
+@pytest.fixture
+def docs(monkeypatch):
+    docs = FakeDocs()
+    store = FakeStore(docs)
+    snapshot = SimpleNamespace(docs=docs, version="test")
+    monkeypatch.setattr(registry, "get", lambda: snapshot)
+    monkeypatch.setattr(similarity, "get_store", lambda: store)
+    monkeypatch.setattr(semantic_search, "get_store", lambda: store)
+    result_cache.clear()
+    yield docs
+    result_cache.clear()
+
+
+def test_semantic_search_skips_deleted(docs):
+    results = semantic_search.semantic_search("article", top_k=3)
+    assert [r["doc_id"] for r in results] == [1, 3]
+
+
+def test_similar_articles_skips_deleted(docs):
+    results = similarity.similar_articles(1, top_k=5)
+    assert [r["doc_id"] for r in results] == [3]
+
+
+def test_timeline_skips_deleted(docs):
+    timeline = build_story_timeline(1, top_k=5)
+    assert timeline["main_article"]["doc_id"] == 1
+    assert [item["doc_id"] for item in timeline["timeline"]] == [3]
+
+
+def test_hybrid_search_skips_deleted(docs, monkeypatch):
+    async def fused(query, top_k, indices=None, **params):
+        docs.delete(DELETED)
+        return [(1, 0.9, 1, 1), (2, 0.8, None, 2), (3, 0.7, 2, None)]
+
+    monkeypatch.setattr(hybrid, "hybrid_top_k", fused)
+    results = asyncio.run(hybrid.hybrid_search("article", top_k=3))
+    assert [r["doc_id"] for r in results] == [1, 3]
@@ -0,0 +1,87 @@
+import numpy as np
+
+from src.analysis import analyzer
+from src.bm25 import BM25Index, build_partial, merge_partials
+from src.segments import open_commit, write_commit, write_deletes, write_segment
+
+
+def _records(num_docs=300, seed=3):
+    """(doc_id, title, body, site, date) articles with skewed word frequencies"""
+    rng = np.random.default_rng(seed)
+    words = [f"w{i}" for i in range(400)]
+    weights = 1.0 / np.arange(1, len(words) + 1)
+    weights /= weights.sum()
+    return [
+        (
+            doc_id,
+            " ".join(rng.choice(words, 4, p=weights)),
+            " ".join(rng.choice(words, rng.integers(5, 60), p=weights)),
+            "example.com",
+            "2024-01-01",
+        )
+        for doc_id in range(1, num_docs + 1)
+    ]
+
+
+def _term_vectors(records, vocab):
+    return [
+        analyzer.term_vector(f"{title} {body}", vocab)
+        for _, title, body, _, _ in records
+    ]
+
+
+def _base_index(records, partial_size=64):
+    """Built like build_indices does: partials, then a merge"""
+    partials = []
+    for start in range(0, len(records), partial_size):
+        chunk = records[start : start + partial_size]
+        vocab = {}
+        doc_ids = [record[0] for record in chunk]
+        partials.append(
+            build_partial(_term_vectors(chunk, vocab), vocab, doc_ids, start)
+        )
+    return merge_partials(partials)
+
+
+def _ingested_index(records):
+    """Built like ingest_articles does"""
+    vocab = {}
+    doc_ids = [record[0] for record in records]
+    return BM25Index.build(_term_vectors(records, vocab), doc_ids, vocab)
+
+
+def test_segments_after_ingest_and_delete_match_one_index(tmp_path):
+    records = _records()
+    deleted = {3, 50, 199, 205, 260, 261, 300}
+
+    # A full build, two ingested batches, then deletes in every segment
+    parts = [records[:200], records[200:250], records[250:]]
+    specs = [write_segment(tmp_path, _base_index(parts[0]), parts[0], base=True)]
+    write_commit(tmp_path, specs)
+    for part in parts[1:]:
+        specs.append(write_segment(tmp_path, _ingested_index(part), part))
+        write_commit(tmp_path, specs)
+    for spec, part in zip(specs, parts):
+        hits = np.array([record[0] in deleted for record in part])
+        spec["deletes"] = write_deletes(tmp_path / spec["name"], hits)
+    segmented, docs = open_commit(tmp_path, write_commit(tmp_path, specs))
+
+    # One index over every document; like segments, its statistics still
+    # count the deleted documents
+    single = _ingested_index(records)
+    single.deleted = np.isin(single.doc_ids, list(deleted))
+
+    assert len(docs) == len(records) - len(deleted)
+    assert all(docs.get(doc_id) is None for doc_id in deleted)
+
+    queries = ["w0", "w1 w5", "w2 w2 w30", "w3 w150 w7 w0", "w399 w11", "w4 w12 w9"]
+    terms = [analyzer.tokenize(query) for query in queries]
+    for k in (5, 50):
+        for query_terms, batch_top in zip(terms, segmented.top_k_batch(terms, k)):
+            term_ids = analyzer.query_term_ids(" ".join(query_terms), single.vocab)
+            expected = single.top_k(term_ids, k, exhaustive=True)
+            assert not {doc_id for doc_id, _ in expected} & deleted
+            assert segmented.top_k(query_terms, k, exhaustive=True) == expected
+            assert segmented.top_k(query_terms, k) == expected
+            assert [d for d, _ in batch_top] == [d for d, _ in expected]
+            assert np.allclose([s for _, s in batch_top], [s for _, s in expected])
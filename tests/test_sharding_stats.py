@@ -0,0 +1,38 @@
+import numpy as np
+
+from src.analysis import analyzer
+from src.bm25 import build_partial, merge_partials
+from src.segments import collection_stats
+
+
+def _index(texts, first_doc, partial_size=7):
+    """BM25 index of consecutive documents, built from several partials"""
+    partials = []
+    for start in range(0, len(texts), partial_size):
+        vocab = {}
+        chunk = texts[start : start + partial_size]
+        term_vectors = [analyzer.term_vector(text, vocab) for text in chunk]
+        doc_ids = list(range(first_doc + start, first_doc + start + len(chunk)))
+        partials.append(build_partial(term_vectors, vocab, doc_ids, start))
+    return merge_partials(partials)
+
+
+def test_shard_idfs_match_single_index_exactly():
+    rng = np.random.default_rng(0)
+    words = [f"w{i}" for i in range(400)]
+    # Skewed word frequencies: common words get a negative (floored) idf
+    weights = 1.0 / np.arange(1, len(words) + 1)
+    weights /= weights.sum()
+    texts = [" ".join(rng.choice(words, 30, p=weights)) for _ in range(90)]
+
+    single = _index(texts, 0)
+    bounds = [0, 25, 60, 90]
+    shards = [_index(texts[a:b], a) for a, b in zip(bounds, bounds[1:])]
+
+    idfs, avgdl = collection_stats(shards, [s.idf_order for s in shards])
+
+    assert avgdl == int(single.doc_lens.sum()) / len(single.doc_ids)
+    assert (np.diff(single.offsets) > len(texts) / 2).any()
+    for shard, idf in zip(shards, idfs):
+        expected = [single.idf[single.vocab[term]] for term in shard.vocab]
+        assert idf.tolist() == expected